@@ -0,0 +1,197 @@
+import argparse
+import collections
+import time
+import numpy as np
+
+import albatros_daq_utils as utils
+from fpga_config import KatcpPipeline
+
+SNAPSHOTS = ["snapshot_adc0", "snapshot_adc3"]
+# snapshot block ctrl bits, as casperfpga's Snap.arm uses them
+CTRL_ENABLE = 1
+CTRL_MAN_TRIG = 2
+CTRL_MAN_VALID = 4
+STATUS_DONE = 1 << 31
+CODES = np.arange(-128, 128) # histogram bin i holds ADC code i-128
+
+def capture(pipe, snapshots=SNAPSHOTS, timeout=1.0, interval=0.001):
+    '''
+    Trigger every snapshot together (manual trigger and valid, like read(man_valid=True, man_trig=True)),
+    wait for all of them and read them back: three round trips whatever the number of snapshots.
+    Returns a uint8 array of shape (len(snapshots), nsamples).
+    '''
+    arm = []
+    for snap in snapshots:
+        arm += [("write", (snap+"_ctrl", 0, b"\x00\x00\x00\x00")),
+                ("write", (snap+"_ctrl", 0, bytes((0, 0, 0, CTRL_ENABLE | CTRL_MAN_TRIG | CTRL_MAN_VALID))))]
+    pipe.call(arm)
+    t1 = time.monotonic()
+    while True:
+        status = pipe.read_ints([snap+"_status" for snap in snapshots])
+        if all(s & STATUS_DONE for s in status.values()):
+            break
+        if time.monotonic()-t1 > timeout:
+            raise TimeoutError("snapshots not done after {} s: {}".format(timeout, [s for s in snapshots if not status[s+"_status"] & STATUS_DONE]))
+        time.sleep(interval)
+    nbytes = min(status[snap+"_status"] & ~STATUS_DONE for snap in snapshots)
+    replies = pipe.call([("read", (snap+"_bram", 0, nbytes)) for snap in snapshots])
+    return np.frombuffer(b"".join(reply[0] for reply in replies), dtype=np.uint8).reshape(len(snapshots), nbytes)
+
+def histograms(raw, ncore=1):
+    '''
+    256-bin code histograms of raw snapshots (ninput, nsamples) of 8-bit two's complement samples,
+    per input and per interleaved ADC core (sample i comes from core i % ncore), in one bincount.
+    Returns an int64 array (ninput, ncore, 256), bin i counting code i-128.
+    '''
+    raw = np.asarray(raw)
+    ninput, nsamp = raw.shape
+    nsamp -= nsamp % ncore
+    # code+128 is the sample's bit pattern with the sign bit flipped, no masking needed
+    idx = (raw[:, :nsamp].view(np.uint8) ^ 0x80).astype(np.intp)
+    idx += 256*(np.arange(ninput)[:, None]*ncore+np.arange(nsamp) % ncore)
+    return np.bincount(idx.ravel(), minlength=ninput*ncore*256).reshape(ninput, ncore, 256)
+
+def stats_from_hist(hist):
+    '''
+    mean, rms, bits_used (log2 of the rms, 0 for a dead input), clip fraction (codes -128 and 127)
+    from histograms over the last axis. Each has the shape of hist without its last axis.
+    '''
+    hist = np.asarray(hist, dtype=np.float64)
+    n = hist.sum(axis=-1)
+    n = np.where(n > 0, n, 1)
+    mean = hist@CODES/n
+    rms = np.sqrt(hist@(CODES**2)/n)
+    bits_used = np.log2(rms, out=np.zeros_like(rms), where=rms > 0)
+    clip = (hist[..., 0]+hist[..., -1])/n
+    return mean, rms, bits_used, clip
+
+def adc_stats(raw, names=None, ncore=1, keep_raw=True):
+    '''
+    Statistics of raw snapshots (ninput, nsamples), as AlbatrosDigitizer.get_adc_stats returns
+    them plus "clip", "hist" (256 bins, code i-128 in bin i) and per-core "core_mean"/"core_rms".
+    {name: {"raw", "mean", "rms", "bits_used", "clip", "hist", "core_mean", "core_rms"}}
+    '''
+    raw = np.asarray(raw)
+    names = names if names is not None else ["adc{}".format(i) for i in range(len(raw))]
+    core_hist = histograms(raw, ncore)
+    hist = core_hist.sum(axis=1)
+    mean, rms, bits_used, clip = stats_from_hist(hist)
+    core_mean, core_rms = stats_from_hist(core_hist)[:2]
+    out = {}
+    for i, name in enumerate(names):
+        out[name] = {"mean": float(mean[i]), "rms": float(rms[i]), "bits_used": float(bits_used[i]), "clip": float(clip[i]),
+                     "hist": hist[i], "core_mean": core_mean[i], "core_rms": core_rms[i]}
+        if keep_raw:
+            out[name]["raw"] = raw[i].view(np.int8)
+    return out
+
+class AdcMonitor:
+    '''
+    Captures ADC snapshots every `interval` seconds and keeps the statistics of the last nhist
+    captures (without the raw samples), so autotune and overheating checks can look at recent
+    levels and trends without touching the FPGA.
+
+    Warns when an input clips on more than max_clip of its samples or uses fewer than min_bits.
+    '''
+    def __init__(self, pipe, snapshots=SNAPSHOTS, ncore=1, interval=10.0, nhist=360, max_clip=1e-3, min_bits=2.0, logger=None):
+        self.pipe = pipe
+        self.snapshots = list(snapshots)
+        self.names = [snap.replace("snapshot_", "") for snap in self.snapshots]
+        self.ncore = ncore
+        self.interval = interval
+        self.max_clip = max_clip
+        self.min_bits = min_bits
+        self.logger = logger
+        self.history = collections.deque(maxlen=nhist) # (time, {name: stats})
+        self.latency = collections.deque(maxlen=nhist)
+
+    def poll(self):
+        t1 = time.perf_counter()
+        raw = capture(self.pipe, self.snapshots)
+        stats = adc_stats(raw, self.names, self.ncore, keep_raw=False)
+        self.latency.append(time.perf_counter()-t1)
+        self.history.append((time.time(), stats))
+        for name, st in stats.items():
+            if st["clip"] > self.max_clip:
+                utils.lprint("AdcMonitor: {} clipping on {:.2%} of samples".format(name, st["clip"]), self.logger, 30)
+            if st["bits_used"] < self.min_bits:
+                utils.lprint("AdcMonitor: {} using only {:.2f} bits (rms {:.2f})".format(name, st["bits_used"], st["rms"]), self.logger, 30)
+        return stats
+
+    def run(self, n=None):
+        '''
+        poll() every interval seconds, n times or forever.
+        '''
+        count = 0
+        next_t = time.monotonic()
+        while n is None or count < n:
+            self.poll()
+            count += 1
+            next_t += self.interval
+            time.sleep(max(next_t-time.monotonic(), 0))
+
+    def latest(self):
+        return self.history[-1][1] if self.history else None
+
+    def trend(self, name, key):
+        '''
+        (times, values) of one statistic of one input over the history.
+        '''
+        return np.array([t for t, st in self.history]), np.array([st[name][key] for t, st in self.history])
+
+def benchmark(n=200, nsamp=8192):
+    '''
+    Seconds per call of the legacy get_adc_stats arithmetic (two masked sign fixes, mean and rms
+    per snapshot) against adc_stats() on the same two snapshots.
+    '''
+    rng = np.random.default_rng(0)
+    raw = np.clip(np.round(rng.normal(0, 8, (2, nsamp))), -128, 127).astype(np.int8).view(np.uint8)
+    out = {}
+    t1 = time.perf_counter()
+    for i in range(n):
+        for row in raw:
+            data = np.asarray(row.tolist()) # casperfpga hands back a list of unsigned samples
+            data[data > 2**7] = data[data > 2**7]-2**8
+            mean = np.mean(data)
+            rms = np.sqrt(np.mean(data**2))
+            bits_used = np.log2(rms)
+    out["legacy"] = (time.perf_counter()-t1)/n
+    t1 = time.perf_counter()
+    for i in range(n):
+        stats = adc_stats(raw)
+    out["adc_stats"] = (time.perf_counter()-t1)/n
+    t1 = time.perf_counter()
+    for i in range(n):
+        stats = adc_stats(raw, ncore=4)
+    out["adc_stats 4 cores"] = (time.perf_counter()-t1)/n
+    return out
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Capture ADC snapshots and print level statistics, once or continuously")
+    parser.add_argument("-c", "--config", type=str, default=None, help="Config file to take snap_ip and snap_port from")
+    parser.add_argument("-i", "--ip", type=str, default="127.0.0.1", help="SNAP address (overridden by the config)")
+    parser.add_argument("-p", "--port", type=int, default=7147, help="SNAP katcp port (overridden by the config)")
+    parser.add_argument("-s", "--snapshots", type=str, nargs="+", default=SNAPSHOTS, help="Snapshot blocks")
+    parser.add_argument("--ncore", type=int, default=1, help="Interleaved ADC cores per snapshot, for per-core statistics")
+    parser.add_argument("-n", "--ncapture", type=int, default=1, help="Captures (0 for forever)")
+    parser.add_argument("-t", "--interval", type=float, default=10, help="Seconds between captures")
+    parser.add_argument("--bench", action="store_true", help="Time the statistics against the legacy code and exit")
+    args = parser.parse_args()
+
+    if args.bench:
+        for what, dt in benchmark().items():
+            print("{}: {:.1f} us per call".format(what, 1e6*dt))
+    else:
+        ip, port = args.ip, args.port
+        if args.config is not None:
+            ip = utils.get_config_parameter(args.config, "snap_ip")
+            port = int(utils.get_config_parameter(args.config, "snap_port"))
+        monitor = AdcMonitor(KatcpPipeline(ip, port), args.snapshots, args.ncore, args.interval)
+        count = 0
+        while args.ncapture == 0 or count < args.ncapture:
+            if count:
+                time.sleep(args.interval)
+            for name, st in monitor.poll().items():
+                print("{}: mean {:.2f} rms {:.2f} bits {:.2f} clip {:.2e} core rms {}".format(
+                    name, st["mean"], st["rms"], st["bits_used"], st["clip"], np.round(st["core_rms"], 2)))
+            count += 1
@@ -1,14 +1,16 @@
 import numpy as np
-import subprocess
-import sys
 import math
 import operator
 import os
-import stat
 import datetime
 import time
 import re
 import configparser
+import channel_plan
+import inventory
+import hotplug
+import mount_manager
+from baseband_decode import BITS_FROM_SEL
 
 def lprint(msg, logger=None, level=20):
     '''
@@ -22,23 +24,11 @@ def lprint(msg, logger=None, level=20):
         print(msg)
 
 def get_channels_from_str(chan, nbits):
-    new_chans=np.empty(0, dtype=">H")
-    multi_chan=chan.split(" ")
-    chan_start_stop=[]
-    for single_chan in multi_chan:
-        start_stop=map(int, single_chan.split(":"))
-        chan_start_stop.extend(start_stop)
-    if nbits==1:
-        for i in range(len(chan_start_stop)//2):
-            new_chans=np.append(new_chans, np.arange(chan_start_stop[2*i], chan_start_stop[2*i+1], 2, dtype=">H"))
-    elif nbits==2:
-        for i in range(len(chan_start_stop)//2):
-            new_chans=np.append(new_chans, np.arange(chan_start_stop[2*i], chan_start_stop[2*i+1], dtype=">H"))
-    else:
-        for i in range(len(chan_start_stop)//2):
-            chans=np.arange(chan_start_stop[2*i], chan_start_stop[2*i+1], dtype=">H")
-            new_chans=np.append(new_chans, np.ravel(np.column_stack((chans, chans))))
-    return new_chans
+    '''
+    Reorder map (>H) for a config `channels` string. See channel_plan.channel_plan. A fresh copy, so
+    callers may modify it; the cached plan's array is read-only.
+    '''
+    return channel_plan.channel_plan(chan, nbits).chans.copy()
 
 def get_coeffs_from_str(coeffs):
     multi_coeff=coeffs.split(" ")
@@ -55,44 +45,18 @@ def get_coeffs_from_str(coeffs):
     return new_coeffs
 
 def get_channels_from_freq(nu=[0,30],nbit=0,nu_max=125,nchan=2048,dtype='>i2',verbose=False):
-    nseg=len(nu)//2 # int or float?
-    for j in range(nseg):
-        nu0=nu[2*j]
-        nu1=nu[2*j+1]
-        if (nu0<nu_max)&(nu1>nu_max):
-            print('frequency segment covering max native frequency not allowed')
-            return None
-        if nu0>nu_max:
-            nu0=2*nu_max-nu0
-        if nu1>nu_max:
-            nu1=2*nu_max-nu1
-        if nu0>nu1:
-            tmp=nu1
-            nu1=nu0
-            nu0=tmp
-        ch_min=np.int(np.floor(nu0*1.0/nu_max*nchan))
-        ch_max=np.int(np.ceil(nu1*1.0/nu_max*nchan))
-        mynchan=ch_max-ch_min+1
-        if verbose:
-            print(j,nu0,nu1,ch_min,ch_max,mynchan)
-        if nbit==0:
-            if mynchan&1==1:
-                if verbose:
-                    print('padding 1-bit requested data to have even # of channels')
-                mynchan=mynchan+1
-        if nbit==0:
-            myvec=np.arange(mynchan/2,dtype=dtype)*2+ch_min
-        if nbit==1:
-            myvec=np.arange(mynchan,dtype=dtype)+ch_min
-        if nbit==2:
-            myvec=np.arange(mynchan*2,dtype=dtype)/2+ch_min
-        if j==0:
-            ch_vec=myvec
-        else:
-            ch_vec=np.append(ch_vec,myvec)
-        ch_vec=np.asarray(ch_vec,dtype=dtype)
-        print(ch_vec)
-    return ch_vec
+    '''
+    Reorder map for frequency segments nu=[nu0,nu1,...] in MHz. nbit follows packetiser_sel (0:1bit, 1:2bit, 2:4bit).
+    Returns None if a segment covers nu_max. See channel_plan.freq_plan.
+    '''
+    try:
+        plan=channel_plan.freq_plan(tuple(nu), BITS_FROM_SEL[nbit], nu_max, nchan)
+    except ValueError as e:
+        print(e)
+        return None
+    if verbose:
+        print('channel ranges',plan.ranges)
+    return plan.chans.astype(dtype)
 
 def get_channels_from_freq_old(nu0=0,nu1=30,nbit=0,nu_max=125,nchan=2048,dtype='>i2'):
     mylen=1
@@ -130,28 +94,24 @@ def get_channels_from_freq_old(nu0=0,nu1=30,nbit=0,nu_max=125,nchan=2048,dtype='
     return ch_vec
 
 def get_nspec(chans,max_nbyte=1380):
-    nspec=np.int(np.floor(max_nbyte/len(chans)))
-    if nspec>30:
-        nspec=30
-    return nspec
+    '''
+    Spectra per packet for a reorder map, keeping the payload (header included) under max_nbyte.
+    Raises ValueError if the resulting stream doesn't fit on 1 GbE. See channel_plan.plan_packets.
+    '''
+    return channel_plan.plan_packets(len(chans), max_bytes_per_packet=max_nbyte).spec_per_pkt
 
 def find_emptiest_drive(tag='media'):
-    """Find the entry in df with the most free space that included tag in its path."""
-    mystr=subprocess.check_output(['df','-k']).decode('utf-8')
-    lines=mystr.split('\n')
+    """Find the mount point with the most free space that includes tag in its path."""
     best_free=0
-    for ll in lines:
-        #print(ll)
-        tags=ll.split()
-        if len(tags)>1:
-            #print(tags[-1])
-            if tags[-1].find(tag)>=0:
-                myfree=float(tags[3])
-                #print('possible drive is ',tags[-1],myfree)
-                if myfree>best_free:
-                    best_free=myfree
-                    best_dir=tags[-1]
-    #print('best directory is ',best_dir,' with ',best_free/1024./1024.,' free GB')
+    for m in inventory.mounts():
+        if m["Mounted on"].find(tag)>=0:
+            try:
+                myfree=inventory.df(m["Mounted on"])["Available"]
+            except OSError:
+                continue
+            if myfree>best_free:
+                best_free=myfree
+                best_dir=m["Mounted on"]
     if best_free>0:
         return best_dir
     else:
@@ -175,69 +135,40 @@ def get_lsblk(drive_models):
     if not isinstance(drive_models, list): # if drive_models is not list (e.g. string), attempt to make it into a list
         drive_models = parse_str2list(drive_models, delimiter=",")
 
-    lsblk = subprocess.check_output(['lsblk','-bo','NAME,SIZE,MODEL']).decode('utf-8')
-    lines = lsblk.splitlines()
     drives = []
-    for i, line in enumerate(lines):
+    for disk in inventory.block_devices():
+        line = disk["Name"]+" "+str(disk["Size"])+" "+disk["Model"] # what lsblk -bo NAME,SIZE,MODEL printed
         for drive_model in drive_models:
-            if drive_model in line:
-                tags = line.split()
-                sdx = tags[0]
-                model = " ".join(tags[2:])
-                partitions = []
-                for j in range(i+1,len(lines)):
-                    if lines[j].startswith(u'\u2514\u2500'+sdx) or lines[j].startswith(u'\u251c\u2500'+sdx):
-                        name, size = lines[j].split()
-                        # remove formatted unicode characters at beginning and extra whitespace at end of line
-                        name = name.replace(u'\u2514','')
-                        name = name.replace(u'\u2500','')
-                        name = name.replace(u'\u251c','')
-                        partitions.append({'Name': '/dev/'+name, 'Size': int(size), 'Model': model})
-                    else:
-                        break
+            if disk["Size"] > 0 and drive_model in line:
+                partitions = [{'Name': '/dev/'+part["Name"], 'Size': part["Size"], 'Model': disk["Model"]} for part in disk["Partitions"]]
                 if partitions:
                     drives.append(partitions)
     return drives
 
 def isthere(diskid):
-    stuff=subprocess.check_output(['lsblk']).decode('utf-8')
-    if diskid in stuff:
-        return True
-    else:
-        return False
+    for disk in inventory.block_devices():
+        if diskid in disk["Name"] or any(diskid in part["Name"] for part in disk["Partitions"]):
+            return True
+    return False
 
 def get_mountpoint(diskid):
     '''
-    running df to check whether the drive is there
+    Mount point of the first mounted device whose name contains diskid, or None if it isn't mounted.
     '''
-    df=subprocess.check_output(['df','-h']).decode('utf-8')
-    lines=df.splitlines()
-    for line in lines:
-        if diskid in line:
-            tags=line.split()
-            if  diskid in tags[0]:
-                ind=line.find(diskid)
-                tmp=line[ind+len(diskid):]
-                ind2=tmp.find('/')
-                mount_point=tmp[ind2:]
-                return mount_point
+    for m in inventory.mounts():
+        if diskid in m["Device"]:
+            return m["Mounted on"]
     return None #if disk is not mounted
 
 def ismounted(tag):
     '''
-    Check df to see if tag is mounted.
-    tag may be either the device name (e.g. /dev/sda1) or mountpoint (e.g. /media/pi/BASEBAND) and must exactly match the full device name or mountpoint in df.
+    Check whether tag is mounted.
+    tag may be either the device name (e.g. /dev/sda1) or mountpoint (e.g. /media/pi/BASEBAND) and must exactly match the full device name or mountpoint.
     Return True if tag is found, otherwise return False.
     '''
-    df = subprocess.check_output('df').decode('utf-8')
-    lines = df.splitlines()
-    for line in lines:
-        if tag in line:
-            s = line.split(None, 5) # set maxsplit=5 for cases when there is whitespace in mountpoint
-            dev = s[0]
-            mountpoint = s[-1]
-            if tag == dev or tag == mountpoint:
-                return True
+    for m in inventory.mounts():
+        if tag == m["Device"] or tag == m["Mounted on"]:
+            return True
     return False
 
 def rename_used_mountpoint(mount_point):
@@ -254,28 +185,23 @@ def rename_used_mountpoint(mount_point):
             mount_point = mount_point[:-len(str(c-1))] + str(c)
     return mount_point
 
-def safe_mount(device, mount_point):
+def safe_mount(device, mount_point, options=None):
     '''
-    Command to safely mount device (e.g. /dev/sda1) to mount_point.
+    Mount device (e.g. /dev/sda1) to mount_point, or to MOUNTPOINT1,2,... if mount_point is in use.
+    options default to mount_manager.MOUNT_OPTIONS for the filesystem (noatime, long journal commit).
+    Returns the mount point once it shows up in /proc/self/mountinfo; raises mount_manager.MountError on failure.
     '''
     # Rename mount_point if it is already in use by another drive.
     mp_available = rename_used_mountpoint(mount_point)
-    # If mount point directory does not exist, make it now.
-    if not os.path.isdir(mp_available):
-        os.makedirs(mp_available)
-
-    # Simple first stab at this using os.system()
-    os.system('sudo mount '+ device +' '+ mp_available)
-    # Should probably do something better that waits for return code
+    return mount_manager.manager.mount(device, mp_available, options)
 
 def safe_unmount(tag):
     '''
-    Command to safely unmount device or mount point.
+    Unmount device or mount point and wait until it's gone from /proc/self/mountinfo.
     tag may be either device name (e.g. /dev/sda1) or mount_point of drive to unmount.
+    Raises mount_manager.MountError on failure.
     '''
-    # Simple first stab at this using os.system()
-    os.system('sudo umount '+tag)
-    # Should probably do something better that safely removes or powers off drive.
+    mount_manager.manager.unmount(tag)
 
 def mount_drives(drive_models, mount_point, timeout=120, dt=2, extra_search_time=10, logger=None):
     '''
@@ -288,6 +214,7 @@ def mount_drives(drive_models, mount_point, timeout=120, dt=2, extra_search_time
     lprint("Waiting for drive(s)...", logger)
     to_mount = [] # list of found device names to mount i.e. [/dev/sda1, /dev/sdb1]
     ndrives = len(to_mount) # number of drives found to mount
+    watcher = hotplug.DriveWatcher(drive_models) # wakes the search on block device events instead of polling
     t1=time.time()
     while True:
         try:
@@ -305,113 +232,98 @@ def mount_drives(drive_models, mount_point, timeout=120, dt=2, extra_search_time
                 lprint('Waiting {:d} more seconds in case there are more drives...'.format(extra_search_time), logger)
             # If enough time has passed since last drive was found, consider drive search completed.
             if ndrives > 0:
-                if time.time()-t2 > extra_search_time:
+                left = t2+extra_search_time-time.time()
+                if left < 0:
                     lprint('Done searching for drive(s).', logger)
                     break
             # If no drives found within timeout time, return success=False
             else:
-                if time.time()-t1 > timeout:
+                left = t1+timeout-time.time()
+                if left < 0:
                     lprint('Timeout waiting for drive!', logger, 40)
+                    watcher.close()
                     return success
+            watcher.wait_event(left)
         except:
             lprint('Error finding drive!', logger, 40)
+            watcher.close()
             return success
-        time.sleep(dt)
-
-    time.sleep(dt)
+    watcher.close()
 
     for dev in to_mount:
-        # Check if drive automounted.
-        mp=get_mountpoint(dev) # mp means mount point
+        # Give an automounter up to dt to mount the drive.
+        mp=mount_manager.manager.wait_for_mount(dev, dt) # mp means mount point
         if mp is not None:
             lprint('{} automounted at {}.'.format(dev, mp), logger)
             success = True
         # Otherwise, mount drive manually.
         else:
             lprint('Mounting {}...'.format(dev), logger)
-            try:
-                safe_mount(dev, mount_point)
-            except:
-                lprint('Exception while attempting to mount drive!', logger, 30)
-                return success
             t1=time.time()
-            while True:
-                mp=get_mountpoint(dev)
-                if mp is not None:
-                    lprint('{} mounted at {} after {} s.'.format(dev, mp, round(time.time()-t1,3)), logger)
-                    success = True
-                    break
-                if time.time()-t1 > timeout:
-                    lprint('Timeout mounting drive!', logger, 40)
-                    success = False
-                    return success
-                time.sleep(dt)
+            try:
+                mp=safe_mount(dev, mount_point)
+            except mount_manager.MountError as e:
+                lprint('Failed to mount drive: {}'.format(e), logger, 40)
+                return False
+            lprint('{} mounted at {} after {} s.'.format(dev, mp, round(time.time()-t1,3)), logger)
+            success = True
     return success
 
 def list_drives_to_write_too(drive_models):
     # Find connected drives using lsblk search and allowed drive_models.
     find_drives = get_lsblk(drive_models)
     max_size_partitions = [max(drive, key=lambda x: x["Size"])["Name"] for drive in find_drives]
-    # Get more drive info from df.
-    df_output=subprocess.check_output(['df','-k', '--block-size=1']).decode('utf-8')
-    lines=df_output.splitlines()
+    # Get more drive info from statvfs, in bytes like df --block-size=1.
     drives=[]
-    for line in lines:
-        tags=line.split(None, 5) # set maxsplit=5 to avoid splitting mountpoint if it has a space
-        if tags[0] in max_size_partitions:
-            drives.append({"Partition name":tags[-1].split("/")[-1], "Device":tags[0], "Blocks":int(tags[1]), "Used":int(tags[2]), "Available":int(tags[3]), "Use%":int(tags[4][:-1]), "Mounted on":tags[5]})
-    drive_free_bytes=[]
-    for drive in drives:
-        drive_free_bytes.append(drive["Use%"])
-    new_drives=[]
-    for i in range(len(drive_free_bytes)):
-        max_index, max_value=max(enumerate(drive_free_bytes), key=operator.itemgetter(1))
-        new_drives.append(drives.pop(max_index))
-        drive_free_bytes.pop(max_index)
-    return new_drives
+    seen=set()
+    for m in inventory.mounts():
+        if m["Device"] in max_size_partitions and m["Device"] not in seen:
+            seen.add(m["Device"])
+            drive={"Partition name":m["Mounted on"].split("/")[-1], "Device":m["Device"]}
+            drive.update(inventory.df(m["Mounted on"]))
+            drive["Mounted on"]=m["Mounted on"]
+            drives.append(drive)
+    # Most used first; the sort is stable, so ties keep mount order.
+    return sorted(drives, key=operator.itemgetter("Use%"), reverse=True)
 
-def num_files_can_write(drive_path, safety, file_size):
+def write_budget(total, used, safety):
+    '''
+    Bytes that can still be written before a drive of total bytes with used bytes reaches safety percent full.
+    '''
+    return safety/100.*total-used
+
+def drive_budget(drive_path, safety):
+    '''
+    write_budget() of the filesystem at drive_path, from one statvfs. Total counts only the space
+    available to unprivileged users, like df.
+    '''
     st=os.statvfs(drive_path)
     used_bytes=st.f_blocks*st.f_bsize-st.f_bfree*st.f_bsize
     free_bytes=st.f_bsize*st.f_bavail
-    total=used_bytes+free_bytes
-    nfile_targ=int(math.floor((safety/100.*total-used_bytes)/(1.024e9*file_size)))
+    return write_budget(used_bytes+free_bytes, used_bytes, safety)
+
+def num_files_can_write(drive_path, safety, file_size):
+    nfile_targ=int(math.floor(drive_budget(drive_path, safety)/(1.024e9*file_size)))
     return nfile_targ
 
-def find_mac():
-    mystr=subprocess.check_output('ifconfig').decode('utf-8')
-    lines=mystr.splitlines()
-    targ='192.168.2.200'
-    mac=""
-    for i in range(len(lines)):
-        ll=lines[i]
-        if ll.find(targ)>0:
-            #print('found target in line ',ll)
-            #print('previous line was ',lines[i-1])
-            tags=lines[i-1].split()
-            mac='0x'+tags[0][3:-1]
-    return mac
+def find_mac(targ='192.168.2.200'):
+    '''
+    MAC address ('0x...') of the interface with IPv4 address targ, or "" if there is none.
+    '''
+    for name, info in inventory.interfaces().items():
+        if info["ip"]==targ:
+            return info["mac"]
+    return ""
 
 def read_ifconfig(interface='eth0'):
-    ip = None
-    port = None
-    mac = None
-    ifconfig = subprocess.check_output('ifconfig').decode('utf-8')
-    lines = ifconfig.split('\n') # use split('\n') rather than splitlines() because want to know when there are empty lines
-    for i, line in enumerate(lines):
-        if line.startswith(interface):
-            port = line.split('<')[0].split(interface+': flags=')[-1]
-            break
-    for j in range(i+1,len(lines)):
-        if lines[j]:
-            tags = lines[j].split()
-            if tags[0] == 'inet':
-                ip = tags[1]
-            if tags[0] == 'ether':
-                mac = '0x'+tags[1].replace(':', '')
-        else: # If string is empty, stop reading as the last ifconfig line relevant to `interface` has been reached.
-            break
-    return ip, port, mac
+    '''
+    Returns ip, flags (as a string, the number ifconfig prints after flags=) and mac ('0x...') of interface.
+    '''
+    info = inventory.interfaces().get(interface)
+    if info is None:
+        return None, None, None
+    port = str(info["flags"]) if info["flags"] is not None else None
+    return info["ip"], port, info["mac"]
 
 def gps_time_from_rtc():
     utc=datetime.datetime.now()
@@ -0,0 +1,251 @@
+import argparse
+import select
+import socket
+import threading
+import time
+import numpy as np
+
+import albatros_daq_utils as utils
+from baseband_decode import HEADER_BYTES
+from channel_plan import SPEC_RATE
+from packet_stats import PacketStats, StatsReporter
+
+# Linux returns the real datagram length with MSG_TRUNC, so oversize packets can be rejected instead of silently truncated.
+MSG_TRUNC = getattr(socket, "MSG_TRUNC", 0)
+MSG_DONTWAIT = getattr(socket, "MSG_DONTWAIT", 0)
+
+def open_socket(ip, port, rcvbuf=64*1024*1024, timeout=1.0, logger=None):
+    '''
+    Bind a UDP socket for the packetiser stream with a large kernel receive buffer.
+    SO_RCVBUFFORCE is tried first (needs CAP_NET_ADMIN), otherwise SO_RCVBUF is capped by net.core.rmem_max.
+    '''
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    try:
+        sock.setsockopt(socket.SOL_SOCKET, getattr(socket, "SO_RCVBUFFORCE", 33), rcvbuf)
+    except OSError:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, rcvbuf)
+    got = sock.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF)
+    if got < rcvbuf:
+        utils.lprint("Receive buffer is {} bytes, asked for {}. Raise net.core.rmem_max to avoid drops.".format(got, rcvbuf), logger, 30)
+    sock.bind((ip, port))
+    sock.settimeout(timeout)
+    return sock
+
+class PacketRing:
+    '''
+    Fixed-size ring of packet slots backed by one preallocated (nslots, slot_bytes) uint8 array.
+    One producer (the capture thread) advances write_count, one consumer advances read_count.
+    Filled slots can be handed straight to baseband_decode.decode_packets with no copy.
+    '''
+    def __init__(self, nslots, slot_bytes):
+        self.nslots = nslots
+        self.slot_bytes = slot_bytes
+        self.buf = np.zeros((nslots, slot_bytes), dtype=np.uint8)
+        self.spec_num = self.buf[:, :HEADER_BYTES].view(">u4")[:, 0]
+        self.slots = [memoryview(self.buf[i]) for i in range(nslots)]
+        self.write_count = 0
+        self.read_count = 0
+
+    def nused(self):
+        return self.write_count-self.read_count
+
+    def nfree(self):
+        return self.nslots-self.nused()
+
+    def peek(self, max_slots=None):
+        '''
+        Return (start, n) of the next contiguous run of filled slots, stopping at the end of the ring.
+        '''
+        start = self.read_count % self.nslots
+        n = min(self.nused(), self.nslots-start)
+        if max_slots is not None:
+            n = min(n, max_slots)
+        return start, n
+
+    def read(self, max_slots=None):
+        '''
+        Return a view of the next contiguous run of filled slots. Call release() once done with it.
+        '''
+        start, n = self.peek(max_slots)
+        return self.buf[start:start+n]
+
+    def release(self, n):
+        self.read_count += n
+
+class BasebandCapture:
+    '''
+    Receive packetiser UDP packets into a PacketRing.
+
+    Packets are received in batches: a batch starts with one poll() for the socket to become
+    readable (up to timeout), then non-blocking recvs drain it until it is empty or the batch is full.
+    (The socket is non-blocking rather than in Python timeout mode, where every recv, even with
+    MSG_DONTWAIT, first waits up to the timeout once the socket is empty.)
+    Loss, reordering and rates are tracked per batch by self.pstats (see packet_stats.PacketStats).
+
+    time_fn: optional clock (e.g. gps_time.GpsClock.now_gps) read once per batch when the socket
+    becomes readable; that time and the spectrum counter of the batch's first packet are kept in
+    self.time_anchor, so spec_time() can timestamp any spectrum.
+    '''
+    def __init__(self, ip, port, bytes_per_spec, spec_per_pkt, nslots=1 << 15, batch=256, rcvbuf=64*1024*1024, timeout=1.0, time_fn=None, logger=None):
+        self.bytes_per_spec = bytes_per_spec
+        self.spec_per_pkt = spec_per_pkt
+        self.pkt_bytes = HEADER_BYTES+bytes_per_spec*spec_per_pkt
+        self.batch = batch
+        self.logger = logger
+        self.ring = PacketRing(nslots, self.pkt_bytes)
+        self.sock = open_socket(ip, port, rcvbuf, timeout, logger)
+        self.sock.setblocking(False)
+        self.timeout = timeout
+        self._poll = select.poll()
+        self._poll.register(self.sock, select.POLLIN)
+        self._scratch = memoryview(bytearray(self.pkt_bytes))
+        self._running = False
+        self._thread = None
+        self.pstats = PacketStats(spec_per_pkt)
+        self.noverrun = 0  # packets dropped because the ring was full
+        self.nbad = 0      # packets with the wrong size
+        self.time_fn = time_fn
+        self.time_anchor = None # (spec_num, time) of the latest batch
+
+    def recv_batch(self):
+        '''
+        Receive up to self.batch packets into contiguous ring slots. Returns the number of packets stored.
+        '''
+        ring = self.ring
+        start = ring.write_count % ring.nslots
+        n = min(self.batch, ring.nfree(), ring.nslots-start)
+        if n == 0:
+            # Ring is full: keep draining the socket so the kernel buffer doesn't back up, but count the loss.
+            try:
+                self.sock.recv_into(self._scratch, 0, MSG_DONTWAIT)
+                self.noverrun += 1
+            except (BlockingIOError, socket.timeout):
+                time.sleep(1e-4)
+            return 0
+        if not self._poll.poll(1000*self.timeout):
+            return 0
+        t_first = self.time_fn() if self.time_fn is not None else None
+        recv_into = self.sock.recv_into
+        slots = ring.slots
+        pkt_bytes = self.pkt_bytes
+        i = start
+        end = start+n
+        while i < end:
+            try:
+                nbytes = recv_into(slots[i], pkt_bytes, MSG_TRUNC)
+            except BlockingIOError:
+                break
+            if nbytes != pkt_bytes:
+                self.nbad += 1
+                continue
+            i += 1
+        got = i-start
+        if got:
+            self.pstats.update_batch(ring.spec_num[start:i], got*pkt_bytes)
+            if t_first is not None:
+                self.time_anchor = (int(ring.spec_num[start]), t_first)
+            ring.write_count += got
+        return got
+
+    def run(self):
+        self._running = True
+        while self._running:
+            self.recv_batch()
+
+    def start(self):
+        self._thread = threading.Thread(target=self.run, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._running = False
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def close(self):
+        self.stop()
+        self.sock.close()
+
+    def spec_time(self, spec_num):
+        '''
+        Arrival-based time of a spectrum counter from the latest time_anchor (None without one).
+        Packets arrive a little after the spectra were taken, so this is late by the network and
+        batching delay, which is roughly constant.
+        '''
+        anchor = self.time_anchor
+        if anchor is None:
+            return None
+        dspec = ((int(spec_num)-anchor[0]+(1 << 31)) % (1 << 32))-(1 << 31) # the counter wraps at 32 bits
+        return anchor[1]+dspec/SPEC_RATE
+
+    def stats(self):
+        return {"noverrun": self.noverrun, "nbad": self.nbad, "ring_used": self.ring.nused(), "ring_slots": self.ring.nslots,
+                "time_anchor": self.time_anchor}
+
+def replay(fname, ip, port, pkt_bytes, pps=0, nloop=1):
+    '''
+    Send a file of back-to-back packetiser payloads to ip:port, pacing to pps packets/s (0 for as fast as possible).
+    Returns the number of packets sent.
+    '''
+    pkts = np.memmap(fname, dtype=np.uint8, mode="r")
+    pkts = pkts[:(len(pkts)//pkt_bytes)*pkt_bytes].reshape(-1, pkt_bytes)
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.connect((ip, port))
+    nsent = 0
+    t1 = time.perf_counter()
+    try:
+        for loop in range(nloop):
+            for pkt in pkts:
+                sock.send(pkt)
+                nsent += 1
+                if pps > 0:
+                    delay = t1+nsent/pps-time.perf_counter()
+                    if delay > 0:
+                        time.sleep(delay)
+    finally:
+        sock.close()
+    return nsent
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Capture packetiser UDP packets, or replay a capture file to a local port")
+    parser.add_argument("-i", "--ip", type=str, default="0.0.0.0", help="IP address to bind (or send to with --replay)")
+    parser.add_argument("-p", "--port", type=int, default=4321, help="UDP port")
+    parser.add_argument("-b", "--bytes-per-spec", type=int, required=True, help="Bytes per spectrum (packetiser_bytes_per_spec)")
+    parser.add_argument("-s", "--spec-per-pkt", type=int, required=True, help="Spectra per packet (packetiser_spec_per_pkt)")
+    parser.add_argument("-t", "--duration", type=float, default=10, help="Seconds to capture")
+    parser.add_argument("-o", "--output", type=str, default=None, help="Dump captured payloads back-to-back to this file")
+    parser.add_argument("-r", "--replay", type=str, default=None, help="Replay this file of payloads instead of capturing")
+    parser.add_argument("--pps", type=float, default=0, help="Replay rate in packets/s (0 for as fast as possible)")
+    parser.add_argument("--stats-interval", type=float, default=1, help="Seconds between stats reports")
+    parser.add_argument("--stats-json", type=str, default=None, help="Keep the latest stats in this JSON file")
+    parser.add_argument("--stats-port", type=int, default=None, help="Also send stats as JSON datagrams to this local UDP port")
+    args = parser.parse_args()
+
+    if args.replay is not None:
+        t1 = time.time()
+        n = replay(args.replay, args.ip, args.port, HEADER_BYTES+args.bytes_per_spec*args.spec_per_pkt, args.pps)
+        print("Sent {} packets at {:.0f} packets/s".format(n, n/(time.time()-t1)))
+    else:
+        cap = BasebandCapture(args.ip, args.port, args.bytes_per_spec, args.spec_per_pkt)
+        outf = open(args.output, "wb") if args.output else None
+        udp_addr = ("127.0.0.1", args.stats_port) if args.stats_port else None
+        reporter = StatsReporter({"packets": cap.pstats, "capture": cap.stats}, args.stats_interval, args.stats_json, udp_addr)
+        cap.start()
+        reporter.start()
+        t1 = time.time()
+        try:
+            while time.time()-t1 < args.duration:
+                block = cap.ring.read()
+                if len(block) == 0:
+                    time.sleep(1e-3)
+                else:
+                    if outf is not None:
+                        outf.write(block)
+                    cap.ring.release(len(block))
+        finally:
+            reporter.stop()
+            cap.close()
+            if outf is not None:
+                outf.close()
+        reporter.report()
@@ -0,0 +1,192 @@
+import argparse
+import time
+import numpy as np
+
+# Packetiser payload layout (what arrives in the UDP payload, see misc/view_wireshark_packets_data.ipynb):
+#   4 bytes    big-endian spectrum counter of the first spectrum in the packet (advances by spec_per_pkt)
+#   N bytes    spec_per_pkt spectra of bytes_per_spec bytes each
+# Byte layout of a spectrum depends on the bit mode set by packetiser_sel:
+#   4-bit: 2 bytes per channel (pol0, pol1), high nibble real, low nibble imag, two's complement
+#   2-bit: 1 byte per channel, bits (MSB first) re0 im0 re1 im1, levels -2 -1 1 2
+#   1-bit: 1 byte per 2 channels, nibbles (MSB first) re0 im0 re1 im1 for chan c then c+1, 0 -> -1, 1 -> +1
+HEADER_BYTES = 4
+
+# packetiser_sel register value -> bits (0:1bit, 1:2bit, 2:4bit)
+BITS_FROM_SEL = {0: 1, 1: 2, 2: 4}
+SEL_FROM_BITS = {1: 0, 2: 1, 4: 2}
+
+def _build_luts():
+    '''
+    Build lookup tables mapping every byte value to its decoded samples.
+    Tables are indexed [byte, (chan,) pol, (re/im)] with the re/im axis only on the int8 tables.
+    '''
+    b = np.arange(256, dtype=np.int16)
+    luts = {}
+    # 4-bit: one byte is one complex sample for one pol
+    re = (b >> 4) & 0xf
+    im = b & 0xf
+    re = np.where(re > 7, re - 16, re)
+    im = np.where(im > 7, im - 16, im)
+    luts[4] = np.stack([re, im], axis=-1).astype(np.int8)
+    # 2-bit: one byte holds pol0 and pol1 of a channel
+    levels2 = np.array([-2, -1, 1, 2], dtype=np.int8)
+    fields = [levels2[(b >> shift) & 3] for shift in (6, 4, 2, 0)]
+    luts[2] = np.stack(fields, axis=-1).reshape(256, 2, 2)
+    # 1-bit: one byte holds pol0 and pol1 of two channels
+    levels1 = np.array([-1, 1], dtype=np.int8)
+    fields = [levels1[(b >> shift) & 1] for shift in range(7, -1, -1)]
+    luts[1] = np.stack(fields, axis=-1).reshape(256, 2, 2, 2)
+    return luts
+
+LUTS_INT8 = _build_luts()
+LUTS_COMPLEX64 = {bits: (lut[..., 0] + 1j*lut[..., 1]).astype(np.complex64) for bits, lut in LUTS_INT8.items()}
+
+def get_nchan(bits, bytes_per_spec):
+    '''
+    Number of channels held in one spectrum of bytes_per_spec bytes.
+    '''
+    if bits == 4:
+        if bytes_per_spec % 2:
+            raise ValueError("4-bit bytes_per_spec must be even, got {}".format(bytes_per_spec))
+        return bytes_per_spec//2
+    elif bits == 2:
+        return bytes_per_spec
+    elif bits == 1:
+        return 2*bytes_per_spec
+    raise ValueError("bits must be 1, 2 or 4, got {}".format(bits))
+
+def packet_dtype(bytes_per_spec, spec_per_pkt):
+    '''
+    Structured dtype of one packetiser payload, for zero-copy np.frombuffer/np.memmap views.
+    '''
+    return np.dtype([("spec_num", ">u4"), ("data", np.uint8, (spec_per_pkt, bytes_per_spec))])
+
+def unpack_spectra(raw, bits, dtype=np.complex64):
+    '''
+    Decode raw spectra bytes into per-pol arrays.
+
+    raw: uint8 array of shape (..., bytes_per_spec)
+    bits: 1, 2 or 4
+    dtype: np.complex64 returns complex arrays of shape (..., nchan);
+           np.int8 returns arrays of shape (..., nchan, 2) with the last axis (re, im).
+
+    Returns pol0, pol1 (views into one freshly decoded array).
+    '''
+    raw = np.asarray(raw, dtype=np.uint8)
+    nchan = get_nchan(bits, raw.shape[-1])
+    if np.dtype(dtype) == np.int8:
+        lut = LUTS_INT8[bits]
+        tail = (2,)
+    elif np.dtype(dtype) == np.complex64:
+        lut = LUTS_COMPLEX64[bits]
+        tail = ()
+    else:
+        raise ValueError("dtype must be np.complex64 or np.int8")
+    out = lut[raw].reshape(raw.shape[:-1]+(nchan, 2)+tail)
+    if tail:
+        return out[..., 0, :], out[..., 1, :]
+    return out[..., 0], out[..., 1]
+
+def quantize(x, bits, scale=1.0):
+    '''
+    Quantize complex values to the packetiser levels of a bit mode, as int8 (..., nchan, 2) (re, im).
+    4-bit rounds x/scale and clips to -7..7, 2-bit maps |x/scale| < 1 to +-1 and the rest to +-2,
+    1-bit keeps the sign.
+    '''
+    x = np.asarray(x)/scale
+    v = np.stack([x.real, x.imag], axis=-1)
+    if bits == 4:
+        return np.clip(np.round(v), -7, 7).astype(np.int8)
+    sign = np.where(v < 0, -1, 1).astype(np.int8)
+    if bits == 2:
+        return sign*np.where(np.abs(v) < 1, 1, 2).astype(np.int8)
+    elif bits == 1:
+        return sign
+    raise ValueError("bits must be 1, 2 or 4, got {}".format(bits))
+
+def pack_spectra(pol0, pol1, bits):
+    '''
+    Inverse of unpack_spectra: pack per-pol samples into raw spectra bytes.
+
+    pol0, pol1: int8 arrays of shape (..., nchan, 2) holding (re, im) on the levels of the bit mode
+                (see quantize), or complex arrays of shape (..., nchan) with integer-valued levels
+    Returns a uint8 array of shape (..., bytes_per_spec).
+    '''
+    pols = []
+    for pol in (pol0, pol1):
+        pol = np.asarray(pol)
+        if np.iscomplexobj(pol):
+            pol = np.stack([pol.real, pol.imag], axis=-1)
+        pols.append(pol.astype(np.int16))
+    v = np.stack(pols, axis=-2) # (..., nchan, pol, re/im)
+    if bits == 4:
+        nib = v & 0xf
+        out = (nib[..., 0] << 4) | nib[..., 1]
+    elif bits == 2:
+        idx = v+2-(v > 0) # -2 -1 1 2 -> 0 1 2 3
+        out = (idx[..., 0, 0] << 6) | (idx[..., 0, 1] << 4) | (idx[..., 1, 0] << 2) | idx[..., 1, 1]
+    elif bits == 1:
+        if v.shape[-3] % 2:
+            raise ValueError("1-bit needs an even number of channels, got {}".format(v.shape[-3]))
+        b = (v > 0).reshape(v.shape[:-3]+(-1, 8))
+        out = np.zeros(b.shape[:-1], dtype=np.int16)
+        for i in range(8):
+            out |= b[..., i].astype(np.int16) << (7-i)
+    else:
+        raise ValueError("bits must be 1, 2 or 4, got {}".format(bits))
+    return out.reshape(v.shape[:-3]+(-1,)).astype(np.uint8)
+
+def decode_packets(buf, bits, bytes_per_spec, spec_per_pkt, dtype=np.complex64):
+    '''
+    Decode a buffer of back-to-back packetiser payloads.
+
+    buf: any bytes-like object (bytes, bytearray, memoryview, np.ndarray) holding whole packets
+    Returns spec_num (first spectrum counter of each packet), pol0, pol1.
+    pol0/pol1 have shape (npkt*spec_per_pkt, nchan) for complex output.
+    '''
+    pkts = np.frombuffer(buf, dtype=packet_dtype(bytes_per_spec, spec_per_pkt))
+    pol0, pol1 = unpack_spectra(pkts["data"], bits, dtype)
+    nspec = len(pkts)*spec_per_pkt
+    return pkts["spec_num"], pol0.reshape((nspec,)+pol0.shape[2:]), pol1.reshape((nspec,)+pol1.shape[2:])
+
+def decode_file(fname, bits, bytes_per_spec, spec_per_pkt, offset=0, npkt=None, dtype=np.complex64):
+    '''
+    Decode a file of back-to-back packetiser payloads (e.g. a raw capture dump).
+    The file is memory mapped so only the requested packets are paged in.
+
+    offset: byte offset of the first packet in the file
+    npkt: number of packets to decode (default: all whole packets in the file)
+    '''
+    pdt = packet_dtype(bytes_per_spec, spec_per_pkt)
+    pkts = np.memmap(fname, dtype=np.uint8, mode="r", offset=offset)
+    nbytes = (len(pkts)//pdt.itemsize)*pdt.itemsize
+    if npkt is not None:
+        nbytes = min(nbytes, npkt*pdt.itemsize)
+    return decode_packets(pkts[:nbytes], bits, bytes_per_spec, spec_per_pkt, dtype)
+
+def benchmark(bits=4, nchan=64, spec_per_pkt=10, npkt=10000, dtype=np.complex64, nrep=5):
+    '''
+    Time decode_packets on random packets and return decoded spectra per second (best of nrep).
+    '''
+    bytes_per_spec = {4: 2*nchan, 2: nchan, 1: nchan//2}[bits]
+    pdt = packet_dtype(bytes_per_spec, spec_per_pkt)
+    buf = np.random.randint(0, 256, size=npkt*pdt.itemsize, dtype=np.uint8).tobytes()
+    best = None
+    for i in range(nrep):
+        t1 = time.perf_counter()
+        decode_packets(memoryview(buf), bits, bytes_per_spec, spec_per_pkt, dtype)
+        dt = time.perf_counter()-t1
+        best = dt if best is None else min(best, dt)
+    return npkt*spec_per_pkt/best
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the baseband packet decoder")
+    parser.add_argument("-b", "--bits", type=int, default=4, help="Baseband bit mode (1, 2 or 4)")
+    parser.add_argument("-n", "--nchan", type=int, default=64, help="Number of channels per spectrum")
+    parser.add_argument("-s", "--spec-per-pkt", type=int, default=10, help="Spectra per packet")
+    parser.add_argument("-p", "--npkt", type=int, default=10000, help="Number of packets to decode per repeat")
+    parser.add_argument("-d", "--dtype", type=str, default="complex64", help="Output dtype (complex64 or int8)")
+    args = parser.parse_args()
+
+    rate = benchmark(args.bits, args.nchan, args.spec_per_pkt, args.npkt, np.dtype(args.dtype))
+    print("{}-bit, {} channels, {} spec/pkt, {}: {:.3e} spectra/s".format(args.bits, args.nchan, args.spec_per_pkt, args.dtype, rate))
@@ -0,0 +1,280 @@
+import os
+import struct
+import time
+import numpy as np
+
+from baseband_decode import HEADER_BYTES, get_nchan, packet_dtype, unpack_spectra
+from baseband_writer import ALIGN, BasebandWriter
+from channel_plan import SPEC_RATE, map_channels
+
+# Baseband file (<ctime>.raw) layout, all header fields little-endian:
+#   fixed header (HEADER_STRUCT below)
+#   channel map: nchan_map big-endian uint16, the same >H array written to the packetiser reorder map
+#   zero padding up to header_bytes (a multiple of ALIGN so O_DIRECT writes stay aligned)
+#   packets: back-to-back packetiser payloads of pkt_bytes each (see baseband_decode)
+#
+# Packet index (<ctime>.raw.idx), written when the file is closed:
+#   INDEX_STRUCT (magic, base_spec, spec_per_pkt, nslot)
+#   nslot little-endian int32: entry k is the packet number in the .raw file holding spectrum
+#   base_spec+k*spec_per_pkt, or -1 if that packet was lost. Looking up a spectrum is one array access.
+MAGIC = b"ALBBASE\x00"
+VERSION = 1
+# magic, version, header_bytes, bits, spec_per_pkt, bytes_per_spec, pkt_bytes, nchan_map, spec0,
+# sys_ctime, gps_ctime, gps_validity, lat, lon, alt
+HEADER_STRUCT = struct.Struct("<8sHIBHIIIQddBddd")
+INDEX_MAGIC = b"ALBIDX\x00\x00"
+INDEX_STRUCT = struct.Struct("<8sQII")
+SPEC_DT = 1/SPEC_RATE # seconds per spectrum
+
+def header_nbytes(nchan_map):
+    return -(-(HEADER_STRUCT.size+2*nchan_map)//ALIGN)*ALIGN
+
+def gps_fields(gpsread):
+    '''
+    Turn an lbtools_l.lb_read() tuple into (gps_ctime, validity, lat, lon, alt). Missing values are nan/0.
+    '''
+    if gpsread is None or gpsread[0] is None:
+        return np.nan, 0, np.nan, np.nan, np.nan
+    tstamp, (nano, validity, lon, lat, alt) = gpsread[0], gpsread[1]
+    return tstamp+nano, int(validity, 2), lat, lon, alt
+
+def pack_header(bits, chans, spec_per_pkt, spec0=0, gpsread=None, sys_ctime=None):
+    '''
+    Build the header block (header_nbytes(len(chans)) bytes) for a baseband file.
+    chans: reorder map from get_channels_from_str; bytes_per_spec is len(chans) as in config_fpga
+    gpsread: optional lbtools_l.lb_read() result taken when the file was opened
+    '''
+    chans = np.asarray(chans, dtype=">H")
+    bytes_per_spec = len(chans)
+    nbytes = header_nbytes(len(chans))
+    if sys_ctime is None:
+        sys_ctime = time.time()
+    fixed = HEADER_STRUCT.pack(MAGIC, VERSION, nbytes, bits, spec_per_pkt, bytes_per_spec,
+                               HEADER_BYTES+bytes_per_spec*spec_per_pkt, len(chans), spec0,
+                               sys_ctime, *gps_fields(gpsread))
+    header = bytearray(nbytes)
+    header[:len(fixed)] = fixed
+    header[len(fixed):len(fixed)+2*len(chans)] = chans.tobytes()
+    return bytes(header)
+
+def read_header(fname):
+    with open(fname, "rb") as f:
+        fixed = f.read(HEADER_STRUCT.size)
+        fields = HEADER_STRUCT.unpack(fixed)
+        if fields[0] != MAGIC:
+            raise ValueError("{} is not a baseband file".format(fname))
+        keys = ("magic", "version", "header_bytes", "bits", "spec_per_pkt", "bytes_per_spec", "pkt_bytes", "nchan_map",
+                "spec0", "sys_ctime", "gps_ctime", "gps_validity", "lat", "lon", "alt")
+        header = dict(zip(keys, fields))
+        header["chans"] = np.frombuffer(f.read(2*header["nchan_map"]), dtype=">H")
+    return header
+
+def build_index(spec_num, spec_per_pkt):
+    '''
+    Dense spectrum -> packet number map for one file. Returns (base_spec, index).
+    '''
+    spec = np.asarray(spec_num, dtype=np.int64)
+    base_spec = int(spec.min())
+    slots = (spec-base_spec)//spec_per_pkt
+    index = np.full(int(slots.max())+1, -1, dtype="<i4")
+    index[slots] = np.arange(len(spec), dtype="<i4")
+    return base_spec, index
+
+def write_index(fname, spec_num, spec_per_pkt):
+    base_spec, index = build_index(spec_num, spec_per_pkt)
+    with open(fname, "wb") as f:
+        f.write(INDEX_STRUCT.pack(INDEX_MAGIC, base_spec, spec_per_pkt, len(index)))
+        f.write(index.tobytes())
+
+def read_index(fname):
+    with open(fname, "rb") as f:
+        magic, base_spec, spec_per_pkt, nslot = INDEX_STRUCT.unpack(f.read(INDEX_STRUCT.size))
+        if magic != INDEX_MAGIC:
+            raise ValueError("{} is not a packet index".format(fname))
+        index = np.frombuffer(f.read(4*nslot), dtype="<i4")
+    return base_spec, index
+
+class BasebandRecorder:
+    '''
+    Write ring blocks of packets to baseband files with header and packet index.
+
+    Files are rotated after a whole number of packets, and early when the spectrum counter jumps
+    backwards by more than max_rewind packets (e.g. after in_packet_reset) or forwards by more than
+    max_gap packets, so that each file's index stays small.
+
+    gps_fn: optional callable returning an lbtools_l.lb_read()-style tuple, called once per file
+    spec_time_fn: optional callable spectrum counter -> GPS time, e.g. BasebandCapture.spec_time with
+        a GpsClock time_fn. When it gives a time, the header's gps_ctime is that of the file's first
+        spectrum; otherwise it is the gps_fn time when the file is opened, which lags the data by the
+        ring and spill backlog (tens of seconds while DriveScheduler drains its RAM spill).
+    writer_kwargs: passed on to BasebandWriter (buf_bytes, nbuf, direct, logger)
+    '''
+    def __init__(self, directory, file_size, bits, chans, spec_per_pkt, gps_fn=None, spec_time_fn=None, max_rewind=64, max_gap=1 << 16, **writer_kwargs):
+        self.bits = bits
+        self.chans = np.asarray(chans, dtype=">H")
+        self.spec_per_pkt = spec_per_pkt
+        self.bytes_per_spec = len(self.chans)
+        self.pkt_bytes = HEADER_BYTES+self.bytes_per_spec*spec_per_pkt
+        self.gps_fn = gps_fn
+        self.spec_time_fn = spec_time_fn
+        self.max_rewind = max_rewind
+        self.max_gap = max_gap
+        self.writer = BasebandWriter(directory, file_size, header_fn=self._header, on_close=self._on_close, **writer_kwargs)
+        self.pkts_per_file = (self.writer.file_bytes-header_nbytes(len(self.chans)))//self.pkt_bytes
+        if self.pkts_per_file < 1:
+            raise ValueError("file_size too small for one packet")
+        self._spec = None   # spectrum counters of packets in the current file
+        self._npkt = 0
+        self._spec0 = 0
+        self._pending = {}  # fname -> spectrum counters, handed to the writer thread for the index
+
+    def _header(self, fname):
+        gpsread = self.gps_fn() if self.gps_fn is not None else None
+        t = self.spec_time_fn(self._spec0) if self.spec_time_fn is not None else None
+        if t is not None and not np.isnan(t):
+            tstamp = int(np.floor(t))
+            aux = gpsread[1] if gpsread is not None and gpsread[0] is not None else (0.0, "0000", np.nan, np.nan, np.nan)
+            gpsread = (tstamp, (t-tstamp,)+tuple(aux[1:]), None)
+        return pack_header(self.bits, self.chans, self.spec_per_pkt, self._spec0, gpsread)
+
+    def _on_close(self, fname, nbytes):
+        spec = self._pending.pop(fname, None)
+        if spec is not None and len(spec):
+            write_index(fname+".idx", spec, self.spec_per_pkt)
+
+    def _next_file(self, spec0):
+        if self._spec is not None:
+            self._pending[self.writer.fname] = self._spec[:self._npkt]
+        self._spec0 = spec0
+        self._spec = np.empty(self.pkts_per_file, dtype=np.int64)
+        self._npkt = 0
+        self.writer.next_file()
+
+    def _split(self, spec):
+        '''
+        Packet offsets in a block where a new file has to start because of a counter discontinuity.
+        '''
+        step = np.diff(spec)
+        last = self._spec[self._npkt-1] if self._spec is not None and self._npkt else None
+        if last is not None:
+            step = np.concatenate([[spec[0]-last], step])
+            offset = 0
+        else:
+            offset = 1
+        bad = (step < -self.max_rewind*self.spec_per_pkt) | (step > self.max_gap*self.spec_per_pkt)
+        return np.nonzero(bad)[0]+offset
+
+    def write(self, block):
+        '''
+        Write a (npkt, pkt_bytes) uint8 array of whole packets, e.g. from PacketRing.read().
+        '''
+        block = np.asarray(block, dtype=np.uint8).reshape(-1, self.pkt_bytes)
+        if len(block) == 0:
+            return
+        spec = block[:, :HEADER_BYTES].view(">u4")[:, 0].astype(np.int64)
+        cuts = set(self._split(spec).tolist())
+        i = 0
+        while i < len(block):
+            if self._spec is None or self._npkt == self.pkts_per_file or i in cuts:
+                self._next_file(int(spec[i]))
+            n = min(len(block)-i, self.pkts_per_file-self._npkt)
+            later = [c for c in cuts if c > i]
+            if later:
+                n = min(n, min(later)-i)
+            self._spec[self._npkt:self._npkt+n] = spec[i:i+n]
+            self._npkt += n
+            self.writer.write(block[i:i+n])
+            i += n
+
+    def close(self):
+        if self._spec is not None:
+            self._pending[self.writer.fname] = self._spec[:self._npkt]
+            self._spec = None
+        self.writer.close()
+
+class BasebandFile:
+    '''
+    Lazy reader for a baseband file. Packets are memory mapped, so only what is read gets paged in.
+
+    channels: channel number of every decoded column
+    read()/read_time() select by spectrum or time range and by channel range and decode only that.
+    '''
+    def __init__(self, fname):
+        self.fname = fname
+        self.header = read_header(fname)
+        h = self.header
+        self.bits = h["bits"]
+        self.spec_per_pkt = h["spec_per_pkt"]
+        self.bytes_per_spec = h["bytes_per_spec"]
+        self.chans = h["chans"]
+        self.nchan = get_nchan(self.bits, self.bytes_per_spec)
+        self.channels = map_channels(self.chans, self.bits)
+        npkt = (os.path.getsize(fname)-h["header_bytes"])//h["pkt_bytes"]
+        self.packets = np.memmap(fname, dtype=packet_dtype(self.bytes_per_spec, self.spec_per_pkt), mode="r",
+                                 offset=h["header_bytes"], shape=(npkt,))
+        if os.path.exists(fname+".idx"):
+            self.base_spec, self.index = read_index(fname+".idx")
+        else:
+            # no index (e.g. file not closed cleanly): rebuild it from the packet headers, which touches the whole file
+            self.base_spec, self.index = build_index(self.packets["spec_num"], self.spec_per_pkt)
+
+    def packet_of(self, spec):
+        '''
+        Packet number holding spectrum counter spec, or -1 if it isn't in the file.
+        '''
+        k = (spec-self.base_spec)//self.spec_per_pkt
+        if k < 0 or k >= len(self.index):
+            return -1
+        return int(self.index[k])
+
+    def _byte_range(self, chan_start, chan_stop):
+        cols = np.nonzero((self.channels >= chan_start) & (self.channels < chan_stop))[0]
+        if len(cols) == 0:
+            raise ValueError("no channels in [{}, {})".format(chan_start, chan_stop))
+        bytes_per_col = {4: 2, 2: 1, 1: 0.5}[self.bits]
+        b0 = int(cols[0]*bytes_per_col)
+        b1 = int(np.ceil((cols[-1]+1)*bytes_per_col))
+        return b0, b1, cols-int(b0/bytes_per_col)
+
+    def read(self, spec_start=None, spec_stop=None, chan_start=None, chan_stop=None, dtype=np.complex64):
+        '''
+        Decode the packets covering spectrum counters [spec_start, spec_stop) and channels [chan_start, chan_stop).
+        Returns spec_num of every decoded spectrum, pol0, pol1 (lost packets are skipped).
+        '''
+        k0 = 0 if spec_start is None else max(0, (spec_start-self.base_spec)//self.spec_per_pkt)
+        k1 = len(self.index) if spec_stop is None else min(len(self.index), -(-(spec_stop-self.base_spec)//self.spec_per_pkt))
+        pkts = self.index[k0:k1]
+        pkts = pkts[pkts >= 0]
+        if len(pkts) and np.all(np.diff(pkts) == 1):
+            sel = self.packets[pkts[0]:pkts[-1]+1] # contiguous: keep it a slice of the memmap
+        else:
+            sel = self.packets[pkts]
+        data = sel["data"]
+        cols = None
+        if chan_start is not None or chan_stop is not None:
+            b0, b1, cols = self._byte_range(-1 if chan_start is None else chan_start, np.inf if chan_stop is None else chan_stop)
+            data = data[..., b0:b1]
+        pol0, pol1 = unpack_spectra(data, self.bits, dtype)
+        nspec = len(sel)*self.spec_per_pkt
+        pol0 = pol0.reshape((nspec,)+pol0.shape[2:])
+        pol1 = pol1.reshape((nspec,)+pol1.shape[2:])
+        if cols is not None:
+            pol0 = pol0[:, cols]
+            pol1 = pol1[:, cols]
+        spec_num = (np.asarray(sel["spec_num"], dtype=np.int64)[:, None]+np.arange(self.spec_per_pkt)).ravel()
+        if spec_start is not None or spec_stop is not None:
+            keep = np.ones(nspec, dtype=bool)
+            if spec_start is not None:
+                keep &= spec_num >= spec_start
+            if spec_stop is not None:
+                keep &= spec_num < spec_stop
+            spec_num, pol0, pol1 = spec_num[keep], pol0[keep], pol1[keep]
+        return spec_num, pol0, pol1
+
+    def read_time(self, t_start, t_stop, chan_start=None, chan_stop=None, dtype=np.complex64):
+        '''
+        Like read() with times in seconds since the file's first spectrum.
+        '''
+        s0 = self.header["spec0"]+int(np.floor(t_start/SPEC_DT))
+        s1 = self.header["spec0"]+int(np.ceil(t_stop/SPEC_DT))
+        return self.read(s0, s1, chan_start, chan_stop, dtype)
@@ -0,0 +1,237 @@
+import argparse
+import ctypes
+import ctypes.util
+import mmap
+import os
+import queue
+import threading
+import time
+
+import albatros_daq_utils as utils
+
+ALIGN = 4096 # O_DIRECT needs buffer address, length and file offset aligned to the logical block size
+
+_libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+_fallocate = getattr(_libc, "fallocate64", None) or getattr(_libc, "fallocate", None)
+if _fallocate is not None:
+    _fallocate.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.c_int64, ctypes.c_int64]
+
+def fallocate(fd, nbytes):
+    '''
+    Reserve nbytes for fd with fallocate(2). Returns False if the filesystem can't do it (e.g. vfat).
+    Unlike os.posix_fallocate this never falls back to writing zeros, which would take minutes on a USB drive.
+    '''
+    if _fallocate is None:
+        return False
+    return _fallocate(fd, 0, 0, nbytes) == 0
+
+def baseband_fname(directory, ctime=None):
+    '''
+    Path of a new baseband file: directory/<first 5 digits of ctime>/<ctime>.raw
+    '''
+    if ctime is None:
+        ctime = time.time()
+    ctime = str(int(ctime))
+    return os.path.join(directory, ctime[:5], ctime+".raw")
+
+class BasebandWriter:
+    '''
+    Write a stream of bytes to a rotating series of baseband files of file_size GB each.
+
+    The caller fills one aligned buffer while a background thread writes the previously filled one,
+    so capture only stalls if every buffer is waiting on the drive. Whole write() calls are never
+    split across files, so write one or more whole packets at a time.
+
+    directory: where files go (see baseband_fname)
+    file_size: file size in GB, same convention as num_files_can_write (1.024e9 bytes per GB)
+    buf_bytes: size of each buffer, rounded up to a multiple of ALIGN
+    nbuf: number of buffers (2 for plain double buffering)
+    direct: open files with O_DIRECT to bypass the page cache
+    header_fn: optional callable(fname) returning bytes to put at the start of every file
+    on_close: optional callable(fname, nbytes) run in the writer thread after a file is closed
+    '''
+    def __init__(self, directory, file_size=0.5, buf_bytes=4*1024*1024, nbuf=2, direct=False, header_fn=None, on_close=None, logger=None):
+        self.directory = directory
+        self.file_bytes = int(1.024e9*file_size)
+        self.buf_bytes = -(-buf_bytes//ALIGN)*ALIGN
+        self.direct = direct and hasattr(os, "O_DIRECT")
+        self.header_fn = header_fn
+        self.on_close = on_close
+        self.logger = logger
+        self._bufs = [mmap.mmap(-1, self.buf_bytes) for i in range(nbuf)] # anonymous mmaps are page aligned
+        self._views = [memoryview(b) for b in self._bufs]
+        self._free = queue.Queue()
+        for i in range(nbuf):
+            self._free.put(i)
+        self._jobs = queue.Queue()
+        self._cur = None
+        self._fill = 0
+        self._file_used = None # bytes assigned to the current file by the caller, None if no file is open
+        self._last_ctime = 0
+        self.fname = None
+        # writer thread state
+        self._fd = None
+        self._wname = None
+        self._wbytes = 0
+        self._warned_fallocate = False
+        # stats
+        self.nfiles = 0
+        self.bytes_written = 0
+        self.write_time = 0.0
+        self.max_write_time = 0.0
+        self.stall_time = 0.0
+        self.queue_hwm = 0
+        self._t0 = time.time()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    # ---- caller side ----
+    def write(self, data):
+        data = memoryview(data).cast("B")
+        n = len(data)
+        if self._file_used is None or self._file_used+n > self.file_bytes:
+            self.next_file()
+        self._copy(data)
+        self._file_used += n
+
+    def next_file(self, fname=None):
+        '''
+        Close the current file (if any) and start a new one.
+        '''
+        if self._file_used is not None:
+            self._submit()
+            self._jobs.put(("close",))
+        if fname is None:
+            # file names have 1 s resolution, so never reuse a ctime when files rotate quickly
+            self._last_ctime = max(int(time.time()), self._last_ctime+1)
+            fname = baseband_fname(self.directory, self._last_ctime)
+        self.fname = fname
+        self._jobs.put(("open", self.fname))
+        self._file_used = 0
+        if self.header_fn is not None:
+            header = memoryview(self.header_fn(self.fname)).cast("B")
+            self._copy(header)
+            self._file_used += len(header)
+
+    def close(self):
+        if self._file_used is not None:
+            self._submit()
+            self._jobs.put(("close",))
+            self._file_used = None
+        self._jobs.put(("stop",))
+        self._thread.join()
+
+    def _copy(self, data):
+        pos = 0
+        n = len(data)
+        while pos < n:
+            if self._cur is None:
+                t1 = time.perf_counter()
+                self._cur = self._free.get()
+                self.stall_time += time.perf_counter()-t1
+                self._fill = 0
+            k = min(n-pos, self.buf_bytes-self._fill)
+            self._views[self._cur][self._fill:self._fill+k] = data[pos:pos+k]
+            self._fill += k
+            pos += k
+            if self._fill == self.buf_bytes:
+                self._submit()
+
+    def _submit(self):
+        if self._cur is None:
+            return
+        self._jobs.put(("write", self._cur, self._fill))
+        self._cur = None
+        self.queue_hwm = max(self.queue_hwm, len(self._bufs)-self._free.qsize())
+
+    # ---- writer thread ----
+    def _run(self):
+        while True:
+            job = self._jobs.get()
+            try:
+                if job[0] == "write":
+                    self._write(job[1], job[2])
+                elif job[0] == "open":
+                    self._open(job[1])
+                elif job[0] == "close":
+                    self._close()
+                elif job[0] == "stop":
+                    break
+            except OSError as e:
+                utils.lprint("BasebandWriter: {} failed on {}: {}".format(job[0], self._wname, e), self.logger, 40)
+
+    def _open(self, fname):
+        os.makedirs(os.path.dirname(fname), exist_ok=True)
+        flags = os.O_WRONLY | os.O_CREAT | os.O_TRUNC
+        if self.direct:
+            flags |= os.O_DIRECT
+        self._fd = os.open(fname, flags, 0o644)
+        self._wname = fname
+        self._wbytes = 0
+        if not fallocate(self._fd, self.file_bytes) and not self._warned_fallocate:
+            utils.lprint("BasebandWriter: fallocate not supported for {}, writing without preallocation".format(fname), self.logger, 30)
+            self._warned_fallocate = True
+
+    def _write(self, idx, nbytes):
+        try:
+            if self._fd is None or nbytes == 0:
+                return
+            n = nbytes
+            if self.direct and n % ALIGN:
+                n = -(-n//ALIGN)*ALIGN # pad the final buffer, the padding is truncated away on close
+            view = self._views[idx]
+            t1 = time.perf_counter()
+            pos = 0
+            while pos < n:
+                pos += os.write(self._fd, view[pos:n])
+            dt = time.perf_counter()-t1
+            self.write_time += dt
+            self.max_write_time = max(self.max_write_time, dt)
+            self._wbytes += nbytes
+            self.bytes_written += nbytes
+        finally:
+            self._free.put(idx)
+
+    def _close(self):
+        if self._fd is None:
+            return
+        os.ftruncate(self._fd, self._wbytes) # drop unused preallocation and O_DIRECT padding
+        os.fdatasync(self._fd)
+        os.close(self._fd)
+        self._fd = None
+        self.nfiles += 1
+        if self.on_close is not None:
+            self.on_close(self._wname, self._wbytes)
+
+    def stats(self):
+        '''
+        write_MBps is the rate while inside write() (what the drive sustains); stall_s is time the caller
+        spent waiting for a free buffer. Stalls with queue_hwm == nbuf mean the drive is the bottleneck.
+        '''
+        return {"nfiles": self.nfiles,
+                "bytes_written": self.bytes_written,
+                "write_MBps": self.bytes_written/self.write_time/1e6 if self.write_time > 0 else 0.0,
+                "wall_MBps": self.bytes_written/(time.time()-self._t0)/1e6,
+                "max_write_s": self.max_write_time,
+                "stall_s": self.stall_time,
+                "queue_hwm": self.queue_hwm}
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the baseband writer by writing dummy packets as fast as possible")
+    parser.add_argument("directory", type=str, help="Directory to write files to")
+    parser.add_argument("-f", "--file-size", type=float, default=0.5, help="File size in GB")
+    parser.add_argument("-b", "--buf-mb", type=float, default=4, help="Buffer size in MB")
+    parser.add_argument("-n", "--nbuf", type=int, default=2, help="Number of buffers")
+    parser.add_argument("-k", "--pkt-bytes", type=int, default=1284, help="Bytes per write() call")
+    parser.add_argument("-t", "--duration", type=float, default=10, help="Seconds to write for")
+    parser.add_argument("--direct", action="store_true", help="Use O_DIRECT")
+    args = parser.parse_args()
+
+    writer = BasebandWriter(args.directory, args.file_size, int(args.buf_mb*1024*1024), args.nbuf, args.direct)
+    pkt = os.urandom(args.pkt_bytes)
+    t1 = time.time()
+    while time.time()-t1 < args.duration:
+        for i in range(1000):
+            writer.write(pkt)
+    writer.close()
+    print(writer.stats())
@@ -0,0 +1,216 @@
+import argparse
+import functools
+from dataclasses import dataclass
+import numpy as np
+
+NCHAN = 2048 # channels out of the PFB
+NU_MAX = 125 # MHz, top of the first Nyquist zone at 250 MHz sampling
+SPEC_RATE = 250e6/(2*NCHAN) # spectra per second
+PKT_HEADER_BYTES = 4 # spectrum counter at the start of each payload
+WIRE_OVERHEAD_BYTES = 8+20+14+4+8+12 # UDP, IPv4, Ethernet header+FCS, preamble, inter-frame gap
+MTU = 1500
+IP_UDP_HEADER_BYTES = 20+8
+MAX_UDP_PAYLOAD = MTU-IP_UDP_HEADER_BYTES
+LINK_BPS = 1e9
+MAX_SPEC_PER_PKT = 30 # limit of the packetiser buffer, as in the old get_nspec
+# bytes of the packetiser_<n>_bit_reorder_map1 BRAM per bit mode (2 bytes per >H map entry)
+REORDER_MAP_BYTES = {1: 2*2048, 2: 2*2048, 4: 2*4096}
+
+@dataclass(frozen=True, eq=False)
+class ChannelPlan:
+    '''
+    Validated, immutable description of which channels go into the baseband packets.
+
+    ranges: ((start, stop), ...) channel ranges, stop exclusive
+    bits: 1, 2 or 4
+    chans: the >H reorder map written to the packetiser BRAM (read-only array);
+           one entry per byte of a spectrum, so bytes_per_spec == len(chans)
+    channels: channel number of every decoded column, in packet order (read-only array)
+    '''
+    ranges: tuple
+    bits: int
+    chans: np.ndarray
+    channels: np.ndarray
+
+    @property
+    def nchan(self):
+        return len(self.channels)
+
+    @property
+    def bytes_per_spec(self):
+        return len(self.chans)
+
+def _readonly(arr):
+    arr.flags.writeable = False
+    return arr
+
+def _ranges_to_array(starts, stops, step, dtype):
+    '''
+    Concatenation of np.arange(start, stop, step) over all ranges, built without a Python loop.
+    '''
+    starts = np.asarray(starts, dtype=np.int64)
+    stops = np.asarray(stops, dtype=np.int64)
+    lengths = np.maximum(-(-(stops-starts)//step), 0)
+    offsets = np.cumsum(lengths)-lengths
+    pos = np.arange(lengths.sum())-np.repeat(offsets, lengths)
+    return (np.repeat(starts, lengths)+step*pos).astype(dtype)
+
+def map_channels(chans, bits):
+    '''
+    Channel number of every decoded column for a reorder map (see baseband_decode for the byte layouts).
+    '''
+    chans = np.asarray(chans, dtype=np.int64)
+    if bits == 4:
+        return chans[::2]
+    elif bits == 2:
+        return chans
+    elif bits == 1:
+        return np.ravel(np.column_stack((chans, chans+1)))
+    raise ValueError("bits must be 1, 2 or 4, got {}".format(bits))
+
+def parse_channel_str(chan):
+    '''
+    Parse a config `channels` string like "256:512 600:640" into ((256, 512), (600, 640)).
+    '''
+    ranges = []
+    for single_chan in chan.split():
+        try:
+            start, stop = map(int, single_chan.split(":"))
+        except ValueError:
+            raise ValueError("bad channel range {!r} in {!r}, expected start:stop".format(single_chan, chan))
+        ranges.append((start, stop))
+    return tuple(ranges)
+
+def validate_ranges(ranges, nchan=NCHAN):
+    if len(ranges) == 0:
+        raise ValueError("no channel ranges given")
+    for start, stop in ranges:
+        if not 0 <= start < stop <= nchan:
+            raise ValueError("channel range {}:{} must satisfy 0 <= start < stop <= {}".format(start, stop, nchan))
+
+def check_reorder_map(nentries, bits):
+    '''
+    Raise ValueError if a reorder map of nentries doesn't fit the packetiser BRAM for bits.
+    '''
+    if bits not in REORDER_MAP_BYTES:
+        raise ValueError("bits must be 1, 2 or 4, got {}".format(bits))
+    if 2*nentries > REORDER_MAP_BYTES[bits]:
+        raise ValueError("{}-bit reorder map of {} entries doesn't fit the {} byte packetiser BRAM (at most {} entries)".format(
+            bits, nentries, REORDER_MAP_BYTES[bits], REORDER_MAP_BYTES[bits]//2))
+
+def _build(ranges, bits):
+    validate_ranges(ranges)
+    starts, stops = zip(*ranges)
+    if bits == 1:
+        # one byte carries two adjacent channels, so odd-length ranges are padded by one channel
+        chans = _ranges_to_array(starts, stops, 2, ">H")
+    elif bits == 2:
+        chans = _ranges_to_array(starts, stops, 1, ">H")
+    elif bits == 4:
+        # one byte per pol, so every channel appears twice
+        chans = np.repeat(_ranges_to_array(starts, stops, 1, ">H"), 2)
+    else:
+        raise ValueError("bits must be 1, 2 or 4, got {}".format(bits))
+    check_reorder_map(len(chans), bits)
+    return ChannelPlan(ranges, bits, _readonly(chans), _readonly(map_channels(chans, bits)))
+
+@functools.lru_cache(maxsize=64)
+def channel_plan(chan, bits):
+    '''
+    Cached ChannelPlan for a config `channels` string (or a tuple of (start, stop) ranges) and bit mode.
+    '''
+    ranges = parse_channel_str(chan) if isinstance(chan, str) else tuple(tuple(map(int, r)) for r in chan)
+    return _build(ranges, bits)
+
+def freq_to_ranges(nu, nbits, nu_max=NU_MAX, nchan=NCHAN):
+    '''
+    Convert frequency segments [nu0, nu1, nu2, nu3, ...] in MHz into channel ranges.
+    Frequencies above nu_max are folded back into the first Nyquist zone. Segments are inclusive of
+    both edge channels, and padded to an even number of channels in 1-bit mode.
+    '''
+    ranges = []
+    for j in range(len(nu)//2):
+        nu0, nu1 = nu[2*j], nu[2*j+1]
+        if nu0 < nu_max < nu1:
+            raise ValueError("frequency segment {}-{} covers the max native frequency {}".format(nu0, nu1, nu_max))
+        if nu0 > nu_max:
+            nu0 = 2*nu_max-nu0
+        if nu1 > nu_max:
+            nu1 = 2*nu_max-nu1
+        if nu0 > nu1:
+            nu0, nu1 = nu1, nu0
+        ch_min = int(np.floor(nu0*1.0/nu_max*nchan))
+        ch_max = int(np.ceil(nu1*1.0/nu_max*nchan))
+        mynchan = ch_max-ch_min+1
+        if nbits == 1 and mynchan & 1:
+            mynchan += 1
+        ranges.append((ch_min, ch_min+mynchan))
+    return tuple(ranges)
+
+@functools.lru_cache(maxsize=64)
+def freq_plan(nu, bits, nu_max=NU_MAX, nchan=NCHAN):
+    '''
+    Cached ChannelPlan for a tuple of frequency segment edges in MHz (see freq_to_ranges).
+    '''
+    ranges = freq_to_ranges(nu, bits, nu_max, nchan)
+    # freq segments may run past the last channel by one because both edges are inclusive
+    return _build(tuple((start, min(stop, nchan)) for start, stop in ranges), bits)
+
+@dataclass(frozen=True)
+class PacketGeometry:
+    '''
+    Packetiser settings for a channel plan and what they cost on the 1 GbE link.
+    '''
+    bytes_per_spec: int
+    spec_per_pkt: int
+    pkt_bytes: int       # UDP payload bytes
+    pkt_rate: float      # packets per second
+    data_rate: float     # payload bytes per second
+    link_util: float     # fraction of the link used, including all per-packet overhead
+    overhead_frac: float # fraction of wire bytes that isn't baseband data
+
+def packet_geometry(bytes_per_spec, spec_per_pkt):
+    pkt_bytes = PKT_HEADER_BYTES+bytes_per_spec*spec_per_pkt
+    pkt_rate = SPEC_RATE/spec_per_pkt
+    wire_bytes = pkt_bytes+WIRE_OVERHEAD_BYTES
+    return PacketGeometry(bytes_per_spec, spec_per_pkt, pkt_bytes, pkt_rate, pkt_rate*pkt_bytes,
+                          pkt_rate*wire_bytes*8/LINK_BPS, 1-bytes_per_spec*spec_per_pkt/wire_bytes)
+
+def plan_packets(bytes_per_spec, max_bytes_per_packet=MAX_UDP_PAYLOAD, max_spec_per_pkt=MAX_SPEC_PER_PKT, max_link_util=0.95, mtu=MTU, bits=None):
+    '''
+    Pick spectra per packet for bytes_per_spec (len of the reorder map, or a ChannelPlan).
+    With bits (taken from a ChannelPlan), the reorder map is also checked against the packetiser BRAM.
+
+    Packet rate and per-packet overhead both fall as spec_per_pkt grows, so the largest value that
+    keeps the payload under max_bytes_per_packet (and the mtu) and within the packetiser buffer wins.
+    Raises ValueError if no spectrum fits in a packet or the stream would need more than
+    max_link_util of the 1 GbE link, so bad plans are caught before the board is touched.
+    '''
+    if isinstance(bytes_per_spec, ChannelPlan):
+        bits = bytes_per_spec.bits
+        bytes_per_spec = bytes_per_spec.bytes_per_spec
+    if bits is not None:
+        check_reorder_map(bytes_per_spec, bits)
+    max_payload = min(max_bytes_per_packet, mtu-IP_UDP_HEADER_BYTES)
+    spec_per_pkt = min((max_payload-PKT_HEADER_BYTES)//bytes_per_spec, max_spec_per_pkt)
+    if spec_per_pkt < 1:
+        raise ValueError("{} bytes per spectrum doesn't fit in a {} byte packet".format(bytes_per_spec, max_payload))
+    geom = packet_geometry(bytes_per_spec, spec_per_pkt)
+    if geom.link_util > max_link_util:
+        raise ValueError("{} bytes per spectrum needs {:.0f}% of 1 GbE ({:.0f} packets/s of {} bytes), limit is {:.0f}%".format(
+            bytes_per_spec, 100*geom.link_util, geom.pkt_rate, geom.pkt_bytes, 100*max_link_util))
+    return geom
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Show the channel plan and packet geometry for a channels string")
+    parser.add_argument("channels", type=str, help="Channel ranges, e.g. \"256:512 600:640\"")
+    parser.add_argument("-b", "--bits", type=int, default=4, help="Baseband bit mode (1, 2 or 4)")
+    parser.add_argument("-m", "--max-bytes-per-packet", type=int, default=MAX_UDP_PAYLOAD, help="Max UDP payload bytes")
+    parser.add_argument("--mtu", type=int, default=MTU, help="Interface MTU (9000 for jumbo frames)")
+    args = parser.parse_args()
+
+    plan = channel_plan(args.channels, args.bits)
+    print("{} channels in {} range(s), {} bytes per spectrum".format(plan.nchan, len(plan.ranges), plan.bytes_per_spec))
+    geom = plan_packets(plan, args.max_bytes_per_packet, mtu=args.mtu)
+    print("{} spectra per packet, {} byte payload, {:.0f} packets/s, {:.1f} MB/s, {:.1f}% of 1 GbE, {:.1f}% overhead".format(
+        geom.spec_per_pkt, geom.pkt_bytes, geom.pkt_rate, geom.data_rate/1e6, 100*geom.link_util, 100*geom.overhead_frac))
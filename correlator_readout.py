@@ -0,0 +1,198 @@
+import argparse
+import collections
+import struct
+import time
+import numpy as np
+
+import albatros_daq_utils as utils
+from fpga_config import KatcpPipeline
+
+POLS = ["pol00", "pol11", "pol01i", "pol01r"]
+REGISTERS = ["sync_cnt", "pfb_fft_of", "acc_cnt"]
+NCHAN = 2048
+DTYPE = ">q" # correlator BRAMs hold big-endian signed 64-bit accumulations
+
+class TornReadError(RuntimeError):
+    pass
+
+class CorrelatorReadout:
+    '''
+    Read the correlator pols and registers of one accumulation in a single katcp round trip,
+    replacing AlbatrosDigitizer.read_pols/read_registers (one request per pol and per register,
+    each decoded with struct.unpack into a tuple).
+
+    Every readout is one batch: acc_cnt, all pol BRAMs, the other registers, then acc_cnt again.
+    If the two acc_cnt values differ, an accumulation landed mid-read and the pols may mix two
+    dumps, so the batch is repeated (up to max_retries times, then TornReadError). The pols are
+    np.frombuffer views of the reply bytes in the BRAM's big-endian dtype, so nothing is copied
+    or converted until the caller does arithmetic on them.
+
+    stream() waits for each new accumulation and reads it right away. The accumulation period is
+    measured from acc_cnt, so after a dump it sleeps until just before the next one is due and
+    then polls acc_cnt, which keeps up with short accumulation_length settings without hammering
+    the board the rest of the time.
+    '''
+    def __init__(self, pipe, pols=POLS, registers=REGISTERS, nchan=NCHAN, dtype=DTYPE, max_retries=3, nhist=256, logger=None):
+        self.pipe = pipe
+        self.pols = list(pols)
+        self.registers = [r for r in registers if r != "acc_cnt"]
+        self.nchan = nchan
+        self.dtype = np.dtype(dtype)
+        self.max_retries = max_retries
+        self.logger = logger
+        self.batch = [("read", ("acc_cnt", 0, 4))]
+        self.batch += [("read", (pol, 0, nchan*self.dtype.itemsize)) for pol in self.pols]
+        self.batch += [("read", (reg, 0, 4)) for reg in self.registers]
+        self.batch += [("read", ("acc_cnt", 0, 4))]
+        self.period = None # seconds per accumulation, once measured
+        self._last = None  # (acc_cnt, time it was first seen)
+        self.nread = 0
+        self.ntorn = 0
+        self.nmissed = 0
+        self.latency = collections.deque(maxlen=nhist)
+
+    def read(self):
+        '''
+        One untorn readout: {"acc_cnt": int, "time": unix time, "pols": {pol: array}, "registers": {reg: int}}.
+        "registers" includes acc_cnt.
+        '''
+        for attempt in range(self.max_retries+1):
+            t1 = time.perf_counter()
+            tstamp = time.time()
+            replies = self.pipe.call(self.batch)
+            self.latency.append(time.perf_counter()-t1)
+            before = struct.unpack(">I", replies[0][0])[0]
+            after = struct.unpack(">I", replies[-1][0])[0]
+            if before == after:
+                break
+            self.ntorn += 1
+            self._seen(after)
+        else:
+            raise TornReadError("acc_cnt changed during {} reads in a row, accumulation too short to read".format(self.max_retries+1))
+        self._seen(after)
+        self.nread += 1
+        npol = len(self.pols)
+        pols = {pol: np.frombuffer(reply[0], dtype=self.dtype) for pol, reply in zip(self.pols, replies[1:1+npol])}
+        regs = {reg: struct.unpack(">I", reply[0])[0] for reg, reply in zip(self.registers, replies[1+npol:-1])}
+        regs["acc_cnt"] = after
+        return {"acc_cnt": after, "time": tstamp, "pols": pols, "registers": regs}
+
+    def _seen(self, acc):
+        # time the first sighting of each acc_cnt, for the period estimate
+        now = time.monotonic()
+        if self._last is not None and acc == self._last[0]:
+            return
+        if self._last is not None and (acc-self._last[0]) & 0xffffffff == 1:
+            dt = now-self._last[1]
+            self.period = dt if self.period is None else 0.8*self.period+0.2*dt
+        self._last = (acc, now)
+
+    def wait_next(self, acc, timeout=None, interval=None):
+        '''
+        Wait until acc_cnt moves past acc and return the new readout. Sleeps through most of the
+        measured period and polls acc_cnt for the rest (every interval seconds, default period/32).
+        Returns None on timeout.
+        '''
+        t1 = time.monotonic()
+        if self.period is not None and self._last is not None and self._last[0] == acc:
+            wake = self._last[1]+0.9*self.period
+            if timeout is not None:
+                wake = min(wake, t1+timeout)
+            time.sleep(max(wake-time.monotonic(), 0))
+        if interval is None:
+            interval = min(self.period/32, 0.05) if self.period is not None else 0.01
+        while True:
+            now = self.pipe.read_ints(["acc_cnt"])["acc_cnt"]
+            self._seen(now)
+            if now != acc:
+                return self.read()
+            if timeout is not None and time.monotonic()-t1 > timeout:
+                return None
+            time.sleep(interval)
+
+    def stream(self, n=None, timeout=None):
+        '''
+        Yield a readout for every new accumulation (n of them, or forever). Accumulations skipped
+        because the caller fell behind are counted in self.nmissed and logged.
+        '''
+        data = self.read()
+        acc = data["acc_cnt"]
+        count = 0
+        while n is None or count < n:
+            data = self.wait_next(acc, timeout)
+            if data is None:
+                utils.lprint("CorrelatorReadout: no new accumulation after {} s".format(timeout), self.logger, 30)
+                return
+            missed = ((data["acc_cnt"]-acc) & 0xffffffff)-1
+            if missed > 0:
+                self.nmissed += missed
+                utils.lprint("CorrelatorReadout: missed {} accumulations before acc_cnt {}".format(missed, data["acc_cnt"]), self.logger, 30)
+            acc = data["acc_cnt"]
+            count += 1
+            yield data
+
+    def stats(self):
+        lat = np.array(self.latency) if self.latency else np.zeros(1)
+        return {"nread": self.nread, "ntorn": self.ntorn, "nmissed": self.nmissed, "period_s": self.period,
+                "read_mean_ms": 1e3*float(lat.mean()), "read_max_ms": 1e3*float(lat.max())}
+
+def benchmark(n=50, rtt=0.001, acc_period=0.05):
+    '''
+    Time a readout done like AlbatrosDigitizer.read_pols/read_registers (a round trip and a
+    struct.unpack per pol and register) against CorrelatorReadout.read(), on a katcp_sim server,
+    then stream n accumulations of acc_period seconds. Returns a dict of results.
+    '''
+    from katcp_sim import KatcpSim
+    sim = KatcpSim(port=0, rtt=rtt, acc_period=acc_period).start()
+    try:
+        rng = np.random.default_rng(1)
+        for pol in POLS:
+            sim.devices[pol][:] = rng.integers(-1 << 40, 1 << 40, NCHAN).astype(DTYPE).tobytes()
+        pipe = KatcpPipeline(sim.host, sim.port)
+        out = {}
+        t1 = time.perf_counter()
+        for i in range(n):
+            pols = {pol: np.array(struct.unpack(">{}q".format(NCHAN), pipe.call([("read", (pol, 0, 8*NCHAN))])[0][0]), dtype="int64") for pol in POLS}
+            regs = {reg: pipe.read_ints([reg])[reg] for reg in REGISTERS}
+        out["per_request_ms"] = 1e3*(time.perf_counter()-t1)/n
+        readout = CorrelatorReadout(pipe)
+        t1 = time.perf_counter()
+        for i in range(n):
+            data = readout.read()
+        out["batched_ms"] = 1e3*(time.perf_counter()-t1)/n
+        assert all(np.array_equal(data["pols"][pol], pols[pol]) for pol in POLS)
+        readout = CorrelatorReadout(pipe)
+        accs = [data["acc_cnt"] for data in readout.stream(n, timeout=10*acc_period)]
+        out["streamed"] = len(accs)
+        out.update(readout.stats())
+        out["nrequest_per_read"] = len(readout.batch)
+        pipe.close()
+    finally:
+        sim.stop()
+    return out
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Read correlator spectra from the SNAP, one round trip per accumulation")
+    parser.add_argument("-c", "--config", type=str, default=None, help="Config file to take snap_ip, snap_port, pols and registers from")
+    parser.add_argument("-i", "--ip", type=str, default="127.0.0.1", help="SNAP address (overridden by the config)")
+    parser.add_argument("-p", "--port", type=int, default=7147, help="SNAP katcp port (overridden by the config)")
+    parser.add_argument("-n", "--nacc", type=int, default=10, help="Accumulations to read")
+    parser.add_argument("--bench", action="store_true", help="Benchmark against a simulated SNAP instead")
+    parser.add_argument("--rtt", type=float, default=0.001, help="Simulated network round trip in seconds (for --bench)")
+    parser.add_argument("--acc-period", type=float, default=0.05, help="Simulated accumulation period in seconds (for --bench)")
+    args = parser.parse_args()
+
+    if args.bench:
+        for what, value in benchmark(args.nacc, args.rtt, args.acc_period).items():
+            print("{}: {}".format(what, value))
+    else:
+        ip, port, pols, regs = args.ip, args.port, POLS, REGISTERS
+        if args.config is not None:
+            ip = utils.get_config_parameter(args.config, "snap_ip")
+            port = int(utils.get_config_parameter(args.config, "snap_port"))
+            pols = utils.get_config_parameter(args.config, "pols").split()
+            regs = utils.get_config_parameter(args.config, "registers").split()
+        readout = CorrelatorReadout(KatcpPipeline(ip, port), pols, regs)
+        for data in readout.stream(args.nacc):
+            print("acc_cnt {} {}".format(data["acc_cnt"], " ".join("{}={}".format(r, v) for r, v in data["registers"].items() if r != "acc_cnt")))
+        print(readout.stats())
@@ -0,0 +1,204 @@
+import argparse
+import json
+import math
+import mmap
+import os
+import time
+import numpy as np
+
+import albatros_daq_utils as utils
+import inventory
+from baseband_writer import ALIGN, fallocate
+
+RESULTS_PATH = os.path.join(os.path.expanduser("~"), ".drive_bench.json")
+BUF_SIZES = [256*1024, 1024*1024, 4*1024*1024, 16*1024*1024]
+# cache: page cache, fdatasync once per file (what BasebandWriter does without O_DIRECT)
+# periodic: page cache, fdatasync every sync_bytes as well, so dirty pages never pile up
+# direct: O_DIRECT, fdatasync once per file
+STRATEGIES = ["cache", "periodic", "direct"]
+
+def write_file(fname, nbytes, buf, strategy="cache", sync_bytes=64*1024*1024):
+    '''
+    Write nbytes to fname in len(buf) writes with the given sync strategy.
+    Returns (seconds in total, per-write seconds, per-fdatasync seconds).
+    '''
+    flags = os.O_WRONLY | os.O_CREAT | os.O_TRUNC
+    if strategy == "direct":
+        flags |= os.O_DIRECT
+    bs = len(buf)
+    nwrite = -(-nbytes//bs)
+    lat = np.empty(nwrite)
+    syncs = []
+    t0 = time.perf_counter()
+    fd = os.open(fname, flags, 0o644)
+    try:
+        fallocate(fd, nwrite*bs)
+        since_sync = 0
+        for i in range(nwrite):
+            t1 = time.perf_counter()
+            pos = 0
+            while pos < bs:
+                pos += os.write(fd, buf[pos:])
+            lat[i] = time.perf_counter()-t1
+            since_sync += bs
+            if strategy == "periodic" and since_sync >= sync_bytes:
+                t1 = time.perf_counter()
+                os.fdatasync(fd)
+                syncs.append(time.perf_counter()-t1)
+                since_sync = 0
+        t1 = time.perf_counter()
+        os.fdatasync(fd)
+        syncs.append(time.perf_counter()-t1)
+    finally:
+        os.close(fd)
+    return time.perf_counter()-t0, lat, np.array(syncs)
+
+def bench_drive(directory, file_size=0.5, nfile=2, buf_sizes=BUF_SIZES, strategies=STRATEGIES, logger=None):
+    '''
+    Write nfile files of file_size GB into directory for every buffer size and sync strategy,
+    deleting them afterwards. Returns a list of result dicts.
+    '''
+    nbytes = int(1.024e9*file_size)
+    buf = mmap.mmap(-1, max(buf_sizes)) # page aligned, as O_DIRECT needs
+    buf.write(os.urandom(len(buf)))
+    view = memoryview(buf)
+    os.makedirs(directory, exist_ok=True)
+    results = []
+    for strategy in strategies:
+        if strategy == "direct" and not hasattr(os, "O_DIRECT"):
+            continue
+        for bs in buf_sizes:
+            bs = -(-bs//ALIGN)*ALIGN
+            total = 0.0
+            lats = []
+            syncs = []
+            try:
+                for i in range(nfile):
+                    fname = os.path.join(directory, "drive_bench_{}.tmp".format(i))
+                    try:
+                        dt, lat, sync = write_file(fname, nbytes, view[:bs], strategy)
+                    finally:
+                        if os.path.exists(fname):
+                            os.remove(fname)
+                    total += dt
+                    lats.append(lat)
+                    syncs.append(sync)
+            except OSError as e:
+                utils.lprint("drive_bench: {} with {} byte writes failed on {}: {}".format(strategy, bs, directory, e), logger, 30)
+                continue
+            lat = np.concatenate(lats)
+            sync = np.concatenate(syncs)
+            res = {"strategy": strategy, "buf_bytes": bs, "MBps": len(lat)*bs/total/1e6,
+                   "write_p50_ms": 1e3*float(np.percentile(lat, 50)), "write_p99_ms": 1e3*float(np.percentile(lat, 99)),
+                   "write_p999_ms": 1e3*float(np.percentile(lat, 99.9)), "write_max_ms": 1e3*float(lat.max()),
+                   "fsync_mean_ms": 1e3*float(sync.mean()), "fsync_max_ms": 1e3*float(sync.max()), "file_size": file_size, "nfile": nfile}
+            utils.lprint("drive_bench: {} {:>6} kB: {:.1f} MB/s, write p99 {:.1f} ms max {:.1f} ms, fsync {:.0f} ms".format(
+                strategy, bs//1024, res["MBps"], res["write_p99_ms"], res["write_max_ms"], res["fsync_mean_ms"]), logger)
+            results.append(res)
+    return results
+
+def best_settings(results, data_rate=None):
+    '''
+    BasebandWriter kwargs (buf_bytes, nbuf, direct) for the fastest writer-compatible result. Among
+    results within 5% of the fastest, the one with the lowest p99.9 write latency wins. BasebandWriter
+    fdatasyncs every file on its writer thread, so the buffers have to ride out the worst write or
+    fsync stall, whichever is longer, while baseband keeps arriving at data_rate (bytes/s). Without
+    data_rate the drive's own rate is used, which over-provisions.
+    '''
+    results = [r for r in results if r["strategy"] in ("cache", "direct")]
+    if not results:
+        return None
+    fastest = max(r["MBps"] for r in results)
+    best = min((r for r in results if r["MBps"] >= 0.95*fastest), key=lambda r: r["write_p999_ms"])
+    if data_rate is None:
+        data_rate = best["MBps"]*1e6
+    stall = 1e-3*max(best["write_max_ms"], best.get("fsync_max_ms", 0.0))
+    nbuf = math.ceil(stall*data_rate/best["buf_bytes"])+1
+    return {"buf_bytes": best["buf_bytes"], "nbuf": min(max(nbuf, 2), 64), "direct": best["strategy"] == "direct"}
+
+def load_results(path=RESULTS_PATH):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def save_results(model, results, path=RESULTS_PATH, data_rate=None):
+    '''
+    Store results for a drive model (replacing earlier ones) with its best settings at data_rate.
+    '''
+    table = load_results(path)
+    table[model] = {"updated": time.time(), "results": results, "best": best_settings(results, data_rate)}
+    tmp = path+".tmp"
+    with open(tmp, "w") as f:
+        json.dump(table, f, indent=1, sort_keys=True)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+    return table[model]
+
+def recommend(model, data_rate=None, path=RESULTS_PATH):
+    '''
+    Benchmarked BasebandWriter kwargs for a drive model, or {} if it hasn't been benchmarked. With
+    data_rate (bytes/s of baseband) nbuf is sized for that rate from the stored results.
+    '''
+    entry = load_results(path).get(model, {})
+    if data_rate is not None and entry.get("results"):
+        return best_settings(entry["results"], data_rate) or {}
+    return entry.get("best") or {}
+
+def model_at(mount_point):
+    '''
+    Model of the drive mounted at mount_point, "" if unknown.
+    '''
+    disk = inventory.disk_of(inventory.device_at(mount_point) or "")
+    return inventory.disk_model(disk) if disk else ""
+
+def bench_connected(drive_models, file_size=0.5, nfile=2, buf_sizes=BUF_SIZES, strategies=STRATEGIES, path=RESULTS_PATH, data_rate=None, logger=None):
+    '''
+    Benchmark every mounted drive matching drive_models (as found by list_drives_to_write_too) and
+    store the results per model. Returns {model: stored entry}.
+    '''
+    out = {}
+    for drive in utils.list_drives_to_write_too(drive_models):
+        mp = drive["Mounted on"]
+        model = model_at(mp) or drive["Device"]
+        utils.lprint("drive_bench: {} ({}) at {}".format(model, drive["Device"], mp), logger)
+        if drive["Available"] < 2*1.024e9*file_size:
+            utils.lprint("drive_bench: not enough room on {}, skipping".format(mp), logger, 30)
+            continue
+        results = bench_drive(os.path.join(mp, "drive_bench"), file_size, nfile, buf_sizes, strategies, logger)
+        try:
+            os.rmdir(os.path.join(mp, "drive_bench"))
+        except OSError:
+            pass
+        out[model] = save_results(model, results, path, data_rate)
+    return out
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark sequential baseband writes on connected drives and store the best writer settings per model")
+    parser.add_argument("-c", "--config", type=str, default=None, help="Config file to take drive_models and file_size from")
+    parser.add_argument("-m", "--models", type=str, default=None, help="Comma separated drive models (overrides the config)")
+    parser.add_argument("-d", "--directory", type=str, default=None, help="Benchmark this directory instead of discovering drives")
+    parser.add_argument("-f", "--file-size", type=float, default=None, help="File size in GB (default from config, else 0.5)")
+    parser.add_argument("-n", "--nfile", type=int, default=2, help="Files per buffer size and strategy")
+    parser.add_argument("-b", "--buf-kb", type=int, nargs="+", default=[b//1024 for b in BUF_SIZES], help="Buffer sizes in kB")
+    parser.add_argument("-s", "--strategies", type=str, nargs="+", default=STRATEGIES, choices=STRATEGIES, help="Sync strategies")
+    parser.add_argument("-r", "--rate", type=float, default=None, help="Baseband data rate in MB/s to size the buffers for (default: the drive's own rate)")
+    parser.add_argument("-o", "--output", type=str, default=RESULTS_PATH, help="Results file")
+    parser.add_argument("--section", type=str, default="albatros2", help="Config section")
+    args = parser.parse_args()
+
+    file_size = args.file_size
+    if file_size is None:
+        file_size = float(utils.get_config_parameter(args.config, "file_size", args.section)) if args.config else 0.5
+    buf_sizes = [1024*kb for kb in args.buf_kb]
+    data_rate = 1e6*args.rate if args.rate is not None else None
+    if args.directory is not None:
+        results = bench_drive(args.directory, file_size, args.nfile, buf_sizes, args.strategies)
+        model = model_at(args.directory) or args.directory
+        print("{}: {}".format(model, save_results(model, results, args.output, data_rate)["best"]))
+    else:
+        models = args.models if args.models is not None else utils.get_config_parameter(args.config, "drive_models", args.section)
+        for model, entry in bench_connected(models, file_size, args.nfile, buf_sizes, args.strategies, args.output, data_rate).items():
+            print("{}: {}".format(model, entry["best"]))
@@ -0,0 +1,393 @@
+import argparse
+import os
+import threading
+import time
+import numpy as np
+
+import albatros_daq_utils as utils
+import drive_bench
+import inventory
+from baseband_capture import PacketRing
+from baseband_decode import HEADER_BYTES
+from baseband_format import BasebandRecorder
+from channel_plan import SPEC_RATE
+from drive_space import SpaceAllocator
+
+SWITCH_BINS = [0, 1, 2, 5, 10, 15, 20, 30, 45, 60, 90, 120, 300, 3600] # seconds, for the switch gap histogram
+
+class DriveScheduler:
+    '''
+    Record baseband to the drives on the mux one at a time, switching before the current one fills.
+
+    The mux only connects one drive at a time, so the next drive can't be spun up while the current
+    one records. Instead the next target is picked as soon as a drive is mounted, from the fill
+    levels kept by a drive_space.SpaceAllocator (self.space), and the switch itself (flush, unmount, power off, select, spin up, mount)
+    runs in a background thread. Packets that arrive meanwhile go to a RAM spill ring. Once the new
+    drive is mounted, the spill is drained into it at up to `catchup` times the incoming rate. That
+    way write() never blocks the capture consumer for a whole switch.
+
+    Every switch's gap, phases and spill high water mark (including the backlog drained after the
+    new drive is ready) are recorded. stats() gives a gap histogram and the spill high water mark,
+    and headroom() the spill RAM to provision, i.e. how much the switches actually needed.
+
+    drive_ids: mux ids to use, tried in this order while their fill levels are unknown
+    safety, file_size: as in num_files_can_write (file_size in GB)
+    margin: files kept in hand on each drive for early rotations on spectrum counter jumps
+    spill_bytes: size of the RAM spill ring
+    mount_fn(id, drive_models, mount_point, logger=...) -> mount point or None, and free_fn(dev) (dev
+        None after a failed mount): default to muxtools.mount_drive and muxtools.free_drive
+    budget_fn(mount_point) -> bytes that can still be written; default utils.drive_budget(mount_point, safety)
+    state: optional drive_state.DriveStateTable. Fill levels of drives not yet mounted this run come
+        from it, so full drives are skipped without spinning them up, and it is updated after every file.
+    tune: use the writer settings (buf_bytes, nbuf, direct) stored by drive_bench for each drive's
+        model, unless given in recorder_kwargs
+    recorder_kwargs: passed on to BasebandRecorder (gps_fn, spec_time_fn, buf_bytes, nbuf, direct, ...)
+    '''
+    def __init__(self, drive_models, mount_point, file_size, bits, chans, spec_per_pkt, drive_ids=range(16), safety=99, margin=1,
+                 spill_bytes=512*1024*1024, catchup=4, mount_fn=None, free_fn=None, budget_fn=None, state=None, tune=True, logger=None, **recorder_kwargs):
+        self.drive_models = drive_models
+        self.mount_point = mount_point
+        self.file_size = file_size
+        self.recorder_args = (file_size, bits, chans, spec_per_pkt)
+        self.recorder_kwargs = recorder_kwargs
+        self.tune = tune
+        self.drive_ids = list(drive_ids)
+        self.margin = margin
+        self.catchup = catchup
+        if mount_fn is None or free_fn is None:
+            import muxtools # needs RPi.GPIO, only on the Pi
+            mount_fn = mount_fn if mount_fn is not None else muxtools.mount_drive
+            free_fn = free_fn if free_fn is not None else muxtools.free_drive
+        self.mount_fn = mount_fn
+        self.free_fn = free_fn
+        self.state = state
+        self.logger = logger
+        self.pkt_bytes = HEADER_BYTES+len(chans)*spec_per_pkt
+        self.data_rate = self.pkt_bytes*SPEC_RATE/spec_per_pkt # bytes/s
+        self.spill = PacketRing(max(spill_bytes//self.pkt_bytes, 1), self.pkt_bytes)
+        self.space = SpaceAllocator(safety, file_size, budget_fn=budget_fn) # drives without a budget have never been seen
+        if state is not None:
+            for i in self.drive_ids:
+                rec = state.by_mux_id(i)
+                if rec is not None and "total" in rec:
+                    self.space.set_budget(i, utils.write_budget(rec["total"], rec["used"], safety))
+        self.bad = set()     # ids that failed to mount
+        self.current = None
+        self.next_id = None
+        self.recorder = None
+        self._mp = None
+        self._serial = None
+        self._nfile = 0      # files closed on the current drive so far
+        self._nbytes = 0     # bytes in those files
+        self._budget = 0     # packets the current drive may still take
+        self._npkt = 0       # packets written to the current drive
+        self._thread = None
+        self._ready = threading.Event()
+        self._t_switch = None
+        self._phases = None
+        # stats
+        self.gaps = []       # seconds from switch start until the new drive was ready
+        self.catchups = []   # seconds from switch start until the spill was drained
+        self.phase_log = []  # {"close", "free", "mount", "ntry"} per switch
+        self.spill_hwm = 0
+        self.switch_hwm = [] # spill high water mark (packets) of each switch, until drained or the next switch
+        self._peak = 0
+        self.ndrop = 0
+        self.npkt_in = 0
+        self._t_in = None    # (first, last) time write() was called
+
+    def _pick(self):
+        '''
+        Next drive to use: unseen drives in order, then the one with the most room. None if all are full.
+        '''
+        for i in self.drive_ids:
+            if i != self.current and i not in self.bad and i not in self.space.budget:
+                return i
+        return self.space.best(exclude=self.bad | {self.current}, min_files=self.margin+1)
+
+    def _mount_next(self):
+        '''
+        Mount drives starting from next_id until one has room, and open a recorder on it. Returns the
+        number of drives tried, with self.recorder None if none worked.
+        '''
+        ntry = 0
+        drive = self.next_id if self.next_id is not None else self._pick()
+        while drive is not None:
+            ntry += 1
+            utils.lprint("DriveScheduler: switching to drive {}".format(drive), self.logger)
+            mp = self.mount_fn(drive, self.drive_models, self.mount_point, logger=self.logger)
+            if mp is None:
+                self.bad.add(drive)
+                self.free_fn(None) # mount_drive leaves the mux powered when it fails
+            else:
+                self.space.mount(drive, mp)
+                nfile = self.space.files_left(drive)
+                if self.state is not None:
+                    self._serial = self.state.mounted(drive, mp)
+                if nfile > self.margin:
+                    self.current = drive
+                    self._mp = mp
+                    kwargs = self.recorder_kwargs
+                    if self.tune:
+                        kwargs = dict(drive_bench.recommend(drive_bench.model_at(mp), self.data_rate), **kwargs)
+                    self.recorder = BasebandRecorder(mp, *self.recorder_args, logger=self.logger, **kwargs)
+                    self._budget = (nfile-self.margin)*self.recorder.pkts_per_file
+                    self._npkt = 0
+                    self._nfile = 0
+                    self._nbytes = 0
+                    self.next_id = self._pick()
+                    utils.lprint("DriveScheduler: drive {} at {} has room for {} files, next is {}".format(drive, mp, nfile, self.next_id), self.logger)
+                    return ntry
+                utils.lprint("DriveScheduler: drive {} is full".format(drive), self.logger, 30)
+                self.space.unmount(drive)
+                self.free_fn(inventory.device_at(mp))
+            drive = self._pick()
+        self.current = None
+        self.recorder = None
+        self.next_id = None
+        utils.lprint("DriveScheduler: no drive with room left!", self.logger, 40)
+        return ntry
+
+    def start(self):
+        '''
+        Mount the first drive. Returns False if no drive could be mounted.
+        '''
+        self._mount_next()
+        return self.recorder is not None
+
+    def _switch(self):
+        t1 = time.time()
+        self.recorder.close()
+        self._account(force=True)
+        self.space.unmount(self.current)
+        t2 = time.time()
+        self.free_fn(inventory.device_at(self._mp))
+        self.recorder = None
+        t3 = time.time()
+        ntry = self._mount_next()
+        self._phases = {"close": t2-t1, "free": t3-t2, "mount": time.time()-t3, "ntry": ntry}
+        self._ready.set()
+
+    def _account(self, force=False):
+        '''
+        If files were closed since last time, take their bytes off the current drive's budget and
+        refresh its record in the state table.
+        '''
+        writer = self.recorder.writer
+        nfile = writer.nfiles
+        if nfile == self._nfile and not force:
+            return
+        nbytes = writer.bytes_written
+        self.space.commit(self.current, nbytes-self._nbytes)
+        if self.state is not None and self._serial is not None:
+            self.state.update_from_statvfs(self._serial, self._mp, nfile-self._nfile)
+            if force:
+                self.state.save(force=True)
+        self._nfile = nfile
+        self._nbytes = nbytes
+
+    def _begin_switch(self):
+        if self._t_switch is not None:
+            # the last switch's backlog hasn't drained yet and now adds to this one's
+            self.switch_hwm.append(self._peak)
+            self._peak = self.spill.nused()
+        self._t_switch = time.time()
+        self._ready.clear()
+        self._thread = threading.Thread(target=self._switch, daemon=True)
+        self._thread.start()
+
+    def _finish_switch(self):
+        self._thread.join()
+        self._thread = None
+        if self.recorder is None:
+            # nowhere left to write, so what was spilled is lost
+            self.ndrop += self.spill.nused()
+            self.spill.release(self.spill.nused())
+            self._t_switch = None
+            return
+        self.gaps.append(time.time()-self._t_switch)
+        self.phase_log.append(self._phases)
+        utils.lprint("DriveScheduler: switch took {:.1f} s ({}), {:.1f} MB spilled".format(self.gaps[-1],
+                     ", ".join("{} {:.1f} s".format(k, v) for k, v in self._phases.items() if k != "ntry"),
+                     self.spill.nused()*self.pkt_bytes/1e6), self.logger)
+
+    def _spill(self, block):
+        ring = self.spill
+        n = min(len(block), ring.nfree())
+        self.ndrop += len(block)-n
+        i = 0
+        while i < n:
+            start = ring.write_count % ring.nslots
+            k = min(n-i, ring.nslots-start)
+            ring.buf[start:start+k] = block[i:i+k]
+            ring.write_count += k
+            i += k
+        self.spill_hwm = max(self.spill_hwm, ring.nused())
+        self._peak = max(self._peak, ring.nused())
+
+    def _write(self, block):
+        '''
+        Write to the current drive, starting a switch (and returning the packets not written) once it's full.
+        '''
+        n = min(len(block), self._budget-self._npkt)
+        if n > 0:
+            self.recorder.write(block[:n])
+            self._npkt += n
+            self._account()
+        if n < len(block):
+            self._begin_switch()
+        return block[max(n, 0):]
+
+    def _drain(self, npkt):
+        while npkt > 0 and self.spill.nused() and self._thread is None:
+            run = self.spill.read(npkt)
+            rest = self._write(run)
+            self.spill.release(len(run)-len(rest))
+            npkt -= len(run)-len(rest)
+        if not self.spill.nused() and self._t_switch is not None:
+            self.catchups.append(time.time()-self._t_switch)
+            self.switch_hwm.append(self._peak)
+            self._peak = 0
+            self._t_switch = None
+
+    def write(self, block):
+        '''
+        Write a (npkt, pkt_bytes) uint8 array of whole packets, e.g. from PacketRing.read().
+        Returns as soon as the packets are in a writer buffer or the spill ring.
+        '''
+        block = np.asarray(block, dtype=np.uint8).reshape(-1, self.pkt_bytes)
+        now = time.time()
+        self._t_in = (now, now) if self._t_in is None else (self._t_in[0], now)
+        self.npkt_in += len(block)
+        if self._thread is not None:
+            if not self._ready.is_set():
+                self._spill(block)
+                return
+            self._finish_switch()
+        if self.recorder is None:
+            self.ndrop += len(block)
+            return
+        if self.spill.nused():
+            self._spill(block)
+            self._drain(self.catchup*len(block))
+            return
+        rest = self._write(block)
+        if len(rest):
+            self._spill(rest)
+
+    def close(self):
+        '''
+        Finish any switch, write out the spill and close the current file. The drive stays mounted.
+        '''
+        if self._thread is not None:
+            self._ready.wait()
+            self._finish_switch()
+        while self.recorder is not None and self.spill.nused():
+            self._drain(self.spill.nused())
+            if self._thread is not None:
+                self._ready.wait()
+                self._finish_switch()
+        if self.recorder is not None:
+            self.recorder.close()
+            self._account(force=True)
+
+    def stats(self):
+        gaps = np.array(self.gaps)
+        out = {"current": self.current, "next": self.next_id, "files_left": {i: self.space.files_left(i) for i in self.space.ranked()},
+               "hours_to_full": self.space.time_to_full(self.current)/3600, "bad": sorted(self.bad),
+               "nswitch": len(gaps), "ndrop": self.ndrop, "spill_hwm_MB": self.spill_hwm*self.pkt_bytes/1e6,
+               "spill_MB": self.spill.nslots*self.pkt_bytes/1e6, "rate_in_MBps": (self.rate_in() or 0)/1e6}
+        if len(gaps):
+            out.update({"gap_p50_s": float(np.percentile(gaps, 50)), "gap_p90_s": float(np.percentile(gaps, 90)), "gap_max_s": float(gaps.max()),
+                        "gap_hist": dict(zip(SWITCH_BINS[:-1], np.histogram(gaps, SWITCH_BINS)[0].tolist()))})
+            for phase in ("close", "free", "mount"):
+                out[phase+"_mean_s"] = float(np.mean([p[phase] for p in self.phase_log]))
+        if self.catchups:
+            out["catchup_max_s"] = max(self.catchups)
+        if self.switch_hwm:
+            out["switch_spill_max_MB"] = max(self.switch_hwm)*self.pkt_bytes/1e6
+        return out
+
+    def rate_in(self):
+        '''
+        Measured incoming data rate in bytes/s, None before two writes.
+        '''
+        if self._t_in is None or self._t_in[1] <= self._t_in[0]:
+            return None
+        return self.npkt_in*self.pkt_bytes/(self._t_in[1]-self._t_in[0])
+
+    def headroom(self, rate_Bps=None, quantile=100):
+        '''
+        Spill bytes needed for the given quantile of switches: each switch's spill high water mark,
+        which includes the backlog still draining after the new drive is ready, not just the gap.
+        With rate_Bps, scaled from the measured incoming rate to that rate (gaps and catch-up factor
+        staying the same).
+        '''
+        if not self.switch_hwm:
+            return None
+        nbytes = float(np.percentile(self.switch_hwm, quantile))*self.pkt_bytes
+        rate = self.rate_in()
+        return nbytes*rate_Bps/rate if rate_Bps is not None and rate else nbytes
+
+def simulate(root, ndrive=4, files_per_drive=3, file_size=0.002, rate_MBps=20, duration=10, mount_s=(0.5, 2.0), spill_MB=128, seed=0):
+    '''
+    Run the scheduler against directories standing in for mux drives (root/drive<i>) with random
+    mount delays, feeding synthetic packets at rate_MBps. Returns the scheduler.
+    '''
+    rng = np.random.default_rng(seed)
+    chans = np.arange(64)
+    spec_per_pkt = 16
+    pkt_bytes = HEADER_BYTES+len(chans)*spec_per_pkt
+
+    def mount(drive, drive_models, mount_point, logger=None):
+        time.sleep(rng.uniform(*mount_s))
+        mp = os.path.join(root, "drive{}".format(drive))
+        os.makedirs(mp, exist_ok=True)
+        return mp
+
+    def budget(mp):
+        # a simulated drive holds exactly files_per_drive baseband files plus their indices. Only
+        # finished files (with an index) count: the scheduler takes each file off the budget when it
+        # closes, so counting the open one too would take it off twice.
+        nfile = sum(f.endswith(".raw.idx") for d, dirs, files in os.walk(mp) for f in files)
+        return (files_per_drive-nfile)*1.024e9*file_size
+
+    sched = DriveScheduler("sim", root, file_size, 4, chans, spec_per_pkt, drive_ids=range(ndrive), margin=0,
+                           spill_bytes=int(spill_MB*1e6), mount_fn=mount, free_fn=lambda dev: None, budget_fn=budget)
+    sched.start()
+    npkt = max(int(rate_MBps*1e6/pkt_bytes/100), 1) # packets per 10 ms block
+    block = rng.integers(0, 256, (npkt, pkt_bytes), dtype=np.uint8)
+    spec = block[:, :HEADER_BYTES].view(">u4")
+    t1 = time.time()
+    k = 0
+    while time.time()-t1 < duration:
+        spec[:, 0] = spec_per_pkt*(k+np.arange(npkt))
+        sched.write(block)
+        k += npkt
+        delay = t1+k/npkt*0.01-time.time()
+        if delay > 0:
+            time.sleep(delay)
+    sched.close()
+    return sched
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Simulate mux drive switching to size the RAM spill buffer")
+    parser.add_argument("root", type=str, help="Directory to create the simulated drives in")
+    parser.add_argument("-n", "--ndrive", type=int, default=4, help="Number of simulated drives")
+    parser.add_argument("-f", "--files-per-drive", type=int, default=3, help="Files that fit on each drive")
+    parser.add_argument("-s", "--file-size", type=float, default=0.002, help="File size in GB")
+    parser.add_argument("-r", "--rate", type=float, default=20, help="Data rate in MB/s")
+    parser.add_argument("-t", "--duration", type=float, default=10, help="Seconds to run")
+    parser.add_argument("--mount-s", type=float, nargs=2, default=(0.5, 2.0), help="Range of simulated mount times in seconds")
+    parser.add_argument("--spill-mb", type=float, default=128, help="Spill ring size in MB")
+    args = parser.parse_args()
+
+    sched = simulate(args.root, args.ndrive, args.files_per_drive, args.file_size, args.rate, args.duration, args.mount_s, args.spill_mb)
+    for key, value in sched.stats().items():
+        print("{}: {}".format(key, value))
+    need = sched.headroom(args.rate*1e6)
+    if need is None:
+        print("no drive switches, run longer or with fewer files per drive")
+    else:
+        print("spill needed for the worst switch at {} MB/s: {:.0f} MB{}".format(args.rate, need/1e6,
+              " (the spill ring filled up, so at least that)" if sched.spill_hwm >= sched.spill.nslots else ""))
@@ -0,0 +1,186 @@
+import argparse
+import collections
+import heapq
+import math
+import time
+
+import albatros_daq_utils as utils
+
+class SpaceAllocator:
+    '''
+    In-memory free space accounting for recording drives, so rotation decisions don't statvfs per file.
+
+    Each drive (any hashable key, e.g. a mux id or mount point) has a byte budget: what can be
+    written before it reaches drive_safety percent full (utils.write_budget). The budget is read
+    with one statvfs when the drive is mounted. After that, commit() takes off the bytes of every
+    file the writer finishes. Mounted drives are re-synced from statvfs every resync_interval
+    seconds or resync_files commits, which catches the index files and filesystem overhead the
+    byte count misses. Drives known only from elsewhere (e.g. a drive_state.DriveStateTable) can be
+    given a budget with set_budget().
+
+    Drives are ranked with a heap of budgets, with lazy deletion of stale entries. The data rate is
+    averaged over the last `window` commits (or set with set_rate()) and gives time_to_full().
+
+    budget_fn(mount_point) -> bytes: default utils.drive_budget(mount_point, safety)
+    '''
+    def __init__(self, safety, file_size, resync_interval=300.0, resync_files=16, window=8, budget_fn=None):
+        self.safety = safety
+        self.file_bytes = 1.024e9*file_size # same convention as num_files_can_write
+        self.resync_interval = resync_interval
+        self.resync_files = resync_files
+        self.budget_fn = budget_fn if budget_fn is not None else (lambda mp: utils.drive_budget(mp, safety))
+        self.budget = {}       # key -> bytes left
+        self.mount_points = {} # key -> mount point, for mounted drives
+        self._synced = {}      # key -> (time, commits) of the last statvfs
+        self._heap = []        # (-budget, version, key)
+        self._version = {}
+        self.rate = 0.0        # bytes/s
+        self._commits = collections.deque(maxlen=window+1) # (time, total bytes committed)
+        self._committed = 0
+        self.nsync = 0
+        self.ncommit = 0
+
+    def _push(self, key):
+        version = self._version.get(key, 0)+1
+        self._version[key] = version
+        heapq.heappush(self._heap, (-self.budget[key], version, key))
+        if len(self._heap) > 4*len(self._version)+16:
+            # too many stale entries, rebuild
+            self._heap = [(-self.budget[k], v, k) for k, v in self._version.items() if k in self.budget]
+            heapq.heapify(self._heap)
+
+    def set_budget(self, key, nbytes):
+        self.budget[key] = nbytes
+        self._push(key)
+
+    def sync(self, key):
+        '''
+        Re-read the budget of a mounted drive from statvfs.
+        '''
+        self.set_budget(key, self.budget_fn(self.mount_points[key]))
+        self._synced[key] = (time.monotonic(), self.ncommit)
+        self.nsync += 1
+
+    def mount(self, key, mount_point):
+        self.mount_points[key] = mount_point
+        self.sync(key)
+
+    def unmount(self, key):
+        '''
+        Take a final reading and forget the mount point. The budget is kept for ranking.
+        '''
+        if key in self.mount_points:
+            self.sync(key)
+            del self.mount_points[key]
+
+    def commit(self, key, nbytes):
+        '''
+        Account for nbytes written to drive key (call once per finished file).
+        '''
+        now = time.monotonic()
+        self._committed += nbytes
+        self._commits.append((now, self._committed))
+        t0, b0 = self._commits[0]
+        if now > t0:
+            self.rate = (self._committed-b0)/(now-t0)
+        self.ncommit += 1
+        synced = self._synced.get(key)
+        if key in self.mount_points and (synced is None or now-synced[0] > self.resync_interval or self.ncommit-synced[1] >= self.resync_files):
+            self.sync(key)
+        else:
+            self.set_budget(key, self.budget[key]-nbytes)
+
+    def set_rate(self, rate_Bps):
+        self.rate = rate_Bps
+
+    def files_left(self, key):
+        '''
+        As num_files_can_write, from the budget. None for an unknown drive.
+        '''
+        nbytes = self.budget.get(key)
+        return None if nbytes is None else int(math.floor(nbytes/self.file_bytes))
+
+    def time_to_full(self, key, rate_Bps=None):
+        '''
+        Seconds until drive key reaches its safety limit at rate_Bps (default the measured rate), inf if unknown.
+        '''
+        rate = rate_Bps if rate_Bps is not None else self.rate
+        nbytes = self.budget.get(key)
+        if nbytes is None or rate <= 0:
+            return math.inf
+        return max(nbytes, 0)/rate
+
+    def best(self, exclude=(), min_files=1):
+        '''
+        Drive with the largest budget not in exclude and with at least min_files files left, or None.
+        '''
+        skipped = []
+        found = None
+        while self._heap:
+            neg, version, key = self._heap[0]
+            if self._version.get(key) != version:
+                heapq.heappop(self._heap) # stale
+                continue
+            if -neg < min_files*self.file_bytes:
+                break # everything below is smaller
+            if key in exclude:
+                skipped.append(heapq.heappop(self._heap))
+                continue
+            found = key
+            break
+        for entry in skipped:
+            heapq.heappush(self._heap, entry)
+        return found
+
+    def ranked(self):
+        '''
+        Known drives, largest budget first.
+        '''
+        return sorted(self.budget, key=lambda key: -self.budget[key])
+
+    def stats(self):
+        return {"rate_MBps": self.rate/1e6, "nsync": self.nsync, "ncommit": self.ncommit,
+                "drives": {key: {"GB_left": self.budget[key]/1e9, "files_left": self.files_left(key),
+                                 "hours_to_full": self.time_to_full(key)/3600, "mounted": key in self.mount_points}
+                           for key in self.ranked()}}
+
+def benchmark(mount_point, n=10000, file_size=0.5, safety=99):
+    '''
+    Seconds per call of num_files_can_write against the allocator's files_left() and best() (over 16 drives).
+    '''
+    out = {}
+    t1 = time.perf_counter()
+    for i in range(n):
+        utils.num_files_can_write(mount_point, safety, file_size)
+    out["num_files_can_write"] = (time.perf_counter()-t1)/n
+    alloc = SpaceAllocator(safety, file_size)
+    for key in range(16):
+        alloc.set_budget(key, key*1e9)
+    alloc.mount("cur", mount_point)
+    t1 = time.perf_counter()
+    for i in range(n):
+        alloc.files_left("cur")
+    out["files_left"] = (time.perf_counter()-t1)/n
+    t1 = time.perf_counter()
+    for i in range(n):
+        alloc.best(exclude=("cur",))
+    out["best"] = (time.perf_counter()-t1)/n
+    return out
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Show free space accounting for mounted drives and time it against statvfs per file")
+    parser.add_argument("mount_points", type=str, nargs="+", help="Mounted drives")
+    parser.add_argument("-s", "--safety", type=float, default=99, help="Drive safety percentage")
+    parser.add_argument("-f", "--file-size", type=float, default=0.5, help="File size in GB")
+    parser.add_argument("-r", "--rate", type=float, default=30, help="Data rate in MB/s, for time to full")
+    parser.add_argument("-n", "--ncall", type=int, default=10000, help="Calls to time")
+    args = parser.parse_args()
+
+    alloc = SpaceAllocator(args.safety, args.file_size)
+    alloc.set_rate(args.rate*1e6)
+    for mp in args.mount_points:
+        alloc.mount(mp, mp)
+    for key, info in alloc.stats()["drives"].items():
+        print("{}: {:.1f} GB, {} files, {:.1f} h to full at {} MB/s".format(key, info["GB_left"], info["files_left"], info["hours_to_full"], args.rate))
+    for what, dt in benchmark(args.mount_points[0], args.ncall, args.file_size, args.safety).items():
+        print("{}: {:.2f} us per call".format(what, 1e6*dt))
@@ -0,0 +1,158 @@
+import argparse
+import json
+import math
+import os
+import time
+
+import albatros_daq_utils as utils
+import inventory
+
+DEFAULT_PATH = os.path.join(os.path.expanduser("~"), ".drive_state.json")
+
+class DriveStateTable:
+    '''
+    Persistent table of what is known about each recording drive, keyed by drive serial number,
+    replacing the drivestates.txt rewrite of the old muxtools scan.
+
+    Each record holds the drive's mux id, model, sizes from its last statvfs (bytes: "total",
+    "used", "avail"), "nfile" (files written through this table), "updated" (unix time) and "bad"
+    (failed to mount). Saves write a temporary file, fsync it and rename it over the old one, so a
+    crash or power cut leaves either the previous table or the new one, never a partial one.
+
+    Updates while recording are incremental: update_from_statvfs() after every file refreshes one
+    record, and saves are rate limited to one per min_interval seconds (save(force=True) to flush).
+    Scheduling then needs only the table, and a full scan of every drive (scan()) runs only on demand.
+    '''
+    def __init__(self, path=DEFAULT_PATH, min_interval=10.0, logger=None):
+        self.path = path
+        self.min_interval = min_interval
+        self.logger = logger
+        self.drives = {}
+        self._dirty = False
+        self._saved = 0.0
+        self.load()
+
+    def load(self):
+        try:
+            with open(self.path) as f:
+                self.drives = json.load(f)["drives"]
+        except FileNotFoundError:
+            self.drives = {}
+        except (ValueError, KeyError) as e:
+            utils.lprint("DriveStateTable: can't read {} ({}), starting empty".format(self.path, e), self.logger, 30)
+            self.drives = {}
+        self._dirty = False
+
+    def save(self, force=False):
+        '''
+        Write the table if it changed, at most once per min_interval unless force. Returns True if written.
+        '''
+        if not self._dirty or (not force and time.time()-self._saved < self.min_interval):
+            return False
+        directory = os.path.dirname(os.path.abspath(self.path))
+        tmp = self.path+".tmp"
+        with open(tmp, "w") as f:
+            json.dump({"version": 1, "saved": time.time(), "drives": self.drives}, f, indent=1, sort_keys=True)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.path)
+        fd = os.open(directory, os.O_RDONLY)
+        try:
+            os.fsync(fd) # make the rename itself durable
+        finally:
+            os.close(fd)
+        self._dirty = False
+        self._saved = time.time()
+        return True
+
+    def update(self, serial, **fields):
+        '''
+        Merge fields into the record of drive serial (creating it) and save if due. Returns the record.
+        '''
+        rec = self.drives.setdefault(serial, {"serial": serial, "nfile": 0, "bad": False})
+        rec.update(fields)
+        rec["updated"] = time.time()
+        self._dirty = True
+        self.save()
+        return rec
+
+    def update_from_statvfs(self, serial, mount_point, nfile=0, **fields):
+        '''
+        Refresh the sizes of drive serial from statvfs of its mount point, adding nfile to its file count.
+        '''
+        st = inventory.df(mount_point)
+        nfile += self.drives.get(serial, {}).get("nfile", 0)
+        return self.update(serial, total=st["Used"]+st["Available"], used=st["Used"], avail=st["Available"], nfile=nfile, **fields)
+
+    def by_mux_id(self, mux_id):
+        '''
+        Most recently updated record for mux position mux_id, or None.
+        '''
+        recs = [rec for rec in self.drives.values() if rec.get("mux_id") == mux_id]
+        return max(recs, key=lambda rec: rec["updated"]) if recs else None
+
+    def files_left(self, rec, safety, file_size):
+        '''
+        num_files_can_write() from a record instead of a mounted drive, None if the sizes are unknown.
+        '''
+        if rec is None or "total" not in rec:
+            return None
+        return int(math.floor(utils.write_budget(rec["total"], rec["used"], safety)/(1.024e9*file_size)))
+
+    def mounted(self, mux_id, mount_point, **fields):
+        '''
+        Record that mux drive mux_id is mounted at mount_point: look up its serial and model and
+        refresh its sizes. Returns the serial, or None if it can't be identified.
+        '''
+        disk = inventory.disk_of(inventory.device_at(mount_point) or "")
+        serial = inventory.disk_serial(disk) if disk else None
+        if serial is None:
+            utils.lprint("DriveStateTable: no serial number for the drive at {}".format(mount_point), self.logger, 30)
+            return None
+        # another drive that used to be at this mux position has been moved or swapped out
+        for rec in self.drives.values():
+            if rec.get("mux_id") == mux_id and rec["serial"] != serial:
+                rec["mux_id"] = None
+        self.update_from_statvfs(serial, mount_point, mux_id=mux_id, model=inventory.disk_model(disk), bad=False, **fields)
+        return serial
+
+    def scan(self, drive_models, mount_point, drive_ids=range(16), mount_fn=None, free_fn=None):
+        '''
+        Mount every drive in turn and refresh its record. Slow (each drive spins up), so only run on demand.
+        Returns {mux_id: serial or None}.
+        free_fn(dev) is called after every drive, with dev None if it didn't mount.
+        '''
+        import muxtools # needs RPi.GPIO, only on the Pi
+        mount_fn = mount_fn if mount_fn is not None else muxtools.mount_drive
+        free_fn = free_fn if free_fn is not None else muxtools.free_drive
+        out = {}
+        for mux_id in drive_ids:
+            mp = mount_fn(mux_id, drive_models, mount_point, logger=self.logger)
+            if mp is None:
+                free_fn(None) # mount_drive leaves the mux powered when it fails
+                rec = self.by_mux_id(mux_id)
+                if rec is not None:
+                    self.update(rec["serial"], bad=True)
+                out[mux_id] = None
+                continue
+            out[mux_id] = self.mounted(mux_id, mp)
+            free_fn(inventory.device_at(mp))
+        self.save(force=True)
+        return out
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Show the drive state table, or rebuild it by scanning every mux drive")
+    parser.add_argument("-f", "--file", type=str, default=DEFAULT_PATH, help="State table path")
+    parser.add_argument("--scan", action="store_true", help="Mount every mux drive in turn and refresh the table")
+    parser.add_argument("-m", "--models", type=str, default="", help="Comma separated drive models (for --scan)")
+    parser.add_argument("--mount-point", type=str, default="/media/pi/BASEBAND", help="Where to mount drives (for --scan)")
+    parser.add_argument("--safety", type=float, default=99, help="Drive safety percentage, for files left")
+    parser.add_argument("--file-size", type=float, default=0.5, help="File size in GB, for files left")
+    args = parser.parse_args()
+
+    table = DriveStateTable(args.file)
+    if args.scan:
+        table.scan([m.strip() for m in args.models.split(",")], args.mount_point)
+    for serial, rec in sorted(table.drives.items(), key=lambda kv: (kv[1].get("mux_id") is None, kv[1].get("mux_id") or 0, kv[0])):
+        print("{:>4} {:24} {:24} {:>8.1f} GB free {:>6} files left {}".format(str(rec.get("mux_id")), serial, rec.get("model", ""),
+              rec.get("avail", 0)/1e9, str(table.files_left(rec, args.safety, args.file_size)), "BAD" if rec["bad"] else ""))
@@ -0,0 +1,285 @@
+import socket
+import struct
+import time
+import numpy as np
+
+# katcp escapes for binary arguments (same set tcpborphserver and casperfpga use)
+_ESCAPES = {b"\\"[0]: b"\\\\", b" "[0]: b"\\_", 0: b"\\0", b"\n"[0]: b"\\n", b"\r"[0]: b"\\r", 0x1b: b"\\e", b"\t"[0]: b"\\t"}
+_UNESCAPES = {b"\\": b"\\", b"_": b" ", b"0": b"\x00", b"n": b"\n", b"r": b"\r", b"e": b"\x1b", b"t": b"\t", b"@": b""}
+
+class KatcpError(RuntimeError):
+    pass
+
+class ConfigVerifyError(RuntimeError):
+    pass
+
+def katcp_escape(data):
+    if isinstance(data, str):
+        data = data.encode()
+    if len(data) == 0:
+        return b"\\@"
+    data = bytes(data).replace(b"\\", b"\\\\") # backslash first, the other escapes add more
+    for b, esc in _ESCAPES.items():
+        if b != b"\\"[0]:
+            data = data.replace(bytes((b,)), esc)
+    return data
+
+def katcp_unescape(arg):
+    # Every backslash starts a two-byte escape and only "\\\\" has a backslash as its second byte,
+    # so splitting on "\\\\" leaves pieces whose escapes can be replaced independently. This
+    # keeps the work in bytes.replace, which matters for 16 kB correlator BRAM reads.
+    if b"\\" not in arg:
+        return arg
+    pieces = arg.split(b"\\\\")
+    for i, piece in enumerate(pieces):
+        if b"\\" in piece:
+            for c, b in _UNESCAPES.items():
+                if c != b"\\":
+                    piece = piece.replace(b"\\"+c, b)
+            pieces[i] = piece
+    return b"\\".join(pieces)
+
+def format_request(name, *args):
+    return b" ".join([b"?"+name.encode()]+[katcp_escape(a if isinstance(a, (bytes, bytearray)) else str(a)) for a in args])+b"\n"
+
+class KatcpPipeline:
+    '''
+    Minimal katcp client that sends a whole batch of requests in one go and then collects the replies.
+    The server handles requests on a connection in order, so a batch costs one network round trip
+    instead of one per request.
+    '''
+    def __init__(self, host, port=7147, timeout=5.0):
+        self.sock = socket.create_connection((host, port), timeout)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self._rbuf = b""
+        self.nround = 0 # round trips so far
+        self.nrequest = 0 # requests so far
+
+    def close(self):
+        self.sock.close()
+
+    def _readline(self):
+        while b"\n" not in self._rbuf:
+            chunk = self.sock.recv(65536)
+            if not chunk:
+                raise KatcpError("connection closed by server")
+            self._rbuf += chunk
+        line, self._rbuf = self._rbuf.split(b"\n", 1)
+        return line.rstrip(b"\r")
+
+    def call(self, requests):
+        '''
+        Send [(name, args), ...] and return the reply arguments of each, after the status.
+        Raises KatcpError on the first request that didn't reply ok.
+        '''
+        if not requests:
+            return []
+        self.sock.sendall(b"".join(format_request(name, *args) for name, args in requests))
+        self.nround += 1
+        self.nrequest += len(requests)
+        replies = []
+        while len(replies) < len(requests):
+            line = self._readline()
+            if line.startswith(b"!"):
+                replies.append(line.split(b" "))
+        for (name, args), reply in zip(requests, replies):
+            if reply[0] != b"!"+name.encode():
+                raise KatcpError("expected reply to ?{}, got {!r}".format(name, reply[0]))
+            if len(reply) < 2 or reply[1] != b"ok":
+                raise KatcpError("?{} {} failed: {}".format(name, " ".join(map(str, args[:2])), b" ".join(reply[1:]).decode(errors="replace")))
+        return [[katcp_unescape(a) for a in reply[2:]] for reply in replies]
+
+    def read_ints(self, regs):
+        '''
+        Read 32-bit unsigned registers in one round trip. Returns {reg: value}.
+        '''
+        replies = self.call([("read", (reg, 0, 4)) for reg in regs])
+        return {reg: struct.unpack(">I", reply[0])[0] for reg, reply in zip(regs, replies)}
+
+    def poll(self, reg, cond, timeout=5.0, interval=0.01):
+        '''
+        Read reg until cond(value) is true instead of sleeping a fixed time. Returns (ok, last value).
+        '''
+        t1 = time.time()
+        while True:
+            value = self.read_ints([reg])[reg]
+            if cond(value):
+                return True, value
+            if time.time()-t1 > timeout:
+                return False, value
+            time.sleep(interval)
+
+class ConfigPlan:
+    '''
+    Ordered list of register and BRAM writes that is sent as one batch and then verified with one
+    batch of reads.
+
+    Consecutive writes to the same BRAM whose ranges touch or overlap are merged into one write
+    (later data wins), e.g. the 256 ARP table entries become one 2 KB write. Register writes are
+    never merged, so pulses like in_sw_sync 0 -> 1 -> 0 keep their order.
+    '''
+    def __init__(self):
+        self.ops = [] # [device, offset, bytearray, verify, mergeable]
+
+    def write_int(self, reg, value, signed=False, verify=True):
+        self.ops.append([reg, 0, bytearray(struct.pack(">i" if signed else ">I", value)), verify, False])
+        return self
+
+    def pulse(self, reg, values=(0, 1, 0)):
+        for value in values[:-1]:
+            self.write_int(reg, value, verify=False)
+        return self.write_int(reg, values[-1])
+
+    def write(self, dev, data, offset=0, verify=True):
+        data = bytearray(data)
+        if self.ops:
+            last = self.ops[-1]
+            if last[4] and last[0] == dev and last[1] <= offset+len(data) and offset <= last[1]+len(last[2]):
+                start = min(last[1], offset)
+                merged = bytearray(max(last[1]+len(last[2]), offset+len(data))-start)
+                merged[last[1]-start:last[1]-start+len(last[2])] = last[2]
+                merged[offset-start:offset-start+len(data)] = data
+                last[1], last[2], last[3] = start, merged, last[3] or verify
+                return self
+        self.ops.append([dev, offset, data, verify, True])
+        return self
+
+    def expected(self):
+        '''
+        (device, offset, data) to read back: verified writes not overwritten by a later write in the plan.
+        '''
+        return _expected(self.ops)
+
+    def _delta(self, shadow):
+        # BRAM writes cut down to what differs from the shadow. The shadow is updated as each op is
+        # diffed, so a later write to the same BRAM is compared with what the earlier one left.
+        ops = []
+        for dev, offset, data, verify, mergeable in self.ops:
+            if not mergeable:
+                ops.append([dev, offset, data, verify, mergeable])
+                continue
+            for off, chunk in shadow.diff(dev, data, offset):
+                ops.append([dev, off, bytearray(chunk), verify, True])
+            shadow.update(dev, data, offset)
+        return ops
+
+    def run(self, pipe, verify=True, shadow=None):
+        '''
+        Send all writes in one round trip, then read back everything verifiable in a second one.
+        Raises ConfigVerifyError listing every region that didn't read back as written.
+
+        With a BramShadow, BRAM writes only send (and read back) the words that changed since the
+        last write through that shadow. Register writes are always sent. Returns the
+        (device, offset, data) writes that were sent.
+        '''
+        ops = self.ops if shadow is None else self._delta(shadow)
+        writes = [(dev, offset, bytes(data)) for dev, offset, data, v, m in ops]
+        try:
+            pipe.call([("write", w) for w in writes])
+            if verify:
+                exp = _expected(ops)
+                replies = pipe.call([("read", (dev, offset, len(data))) for dev, offset, data in exp])
+                bad = [(dev, offset) for (dev, offset, data), reply in zip(exp, replies) if reply[0] != data]
+                if bad:
+                    raise ConfigVerifyError("readback mismatch on " + ", ".join("{}+0x{:x}".format(d, o) for d, o in bad))
+        except Exception:
+            if shadow is not None:
+                for dev, offset, data, v, mergeable in self.ops:
+                    if mergeable:
+                        shadow.invalidate(dev) # unknown what the BRAM holds now
+            raise
+        return writes
+
+def _expected(ops):
+    out = []
+    for i, (dev, offset, data, verify, mergeable) in enumerate(ops):
+        if not verify:
+            continue
+        end = offset+len(data)
+        if any(d == dev and o < end and offset < o+len(x) for d, o, x, v, m in ops[i+1:]):
+            continue
+        out.append((dev, offset, bytes(data)))
+    return out
+
+class BramShadow:
+    '''
+    Last image written to each BRAM, so rewriting a reorder map or coefficient table only sends
+    the words that changed (pass it to ConfigPlan.run, or use write()).
+
+    diff() compares new data with the image in one NumPy pass and returns the changed byte ranges
+    widened to whole `word`-byte words, with runs less than max_gap words apart merged (each
+    katcp request costs about as much as a few dozen bytes of payload). Bytes never written or
+    loaded through the shadow always count as changed. Call invalidate() if a BRAM may have been
+    written behind the shadow's back, e.g. after reprogramming the FPGA.
+    '''
+    def __init__(self, word=4, max_gap=64):
+        self.word = word
+        self.max_gap = max_gap
+        self.images = {} # device -> (uint8 image, bool mask of known bytes)
+        self.nsent = 0    # bytes diff() asked to send
+        self.nskipped = 0 # bytes diff() found unchanged
+
+    def _image(self, dev, size):
+        img, known = self.images.get(dev, (np.zeros(0, dtype=np.uint8), np.zeros(0, dtype=bool)))
+        if len(img) < size:
+            img = np.concatenate((img, np.zeros(size-len(img), dtype=np.uint8)))
+            known = np.concatenate((known, np.zeros(size-len(known), dtype=bool)))
+            self.images[dev] = (img, known)
+        return img, known
+
+    def diff(self, dev, data, offset=0):
+        '''
+        [(offset, bytes), ...] of data (to be written at offset) that differ from the image.
+        '''
+        new = np.frombuffer(bytes(data), dtype=np.uint8)
+        end = offset+len(new)
+        img, known = self._image(dev, end)
+        idx = np.flatnonzero(~known[offset:end] | (img[offset:end] != new))
+        out = []
+        if len(idx):
+            words = (idx+offset)//self.word
+            breaks = np.flatnonzero(np.diff(words) > self.max_gap+1)
+            for first, last in zip(np.concatenate(([words[0]], words[breaks+1])), np.concatenate((words[breaks], [words[-1]]))):
+                start = max(int(first)*self.word, offset)
+                stop = min((int(last)+1)*self.word, end)
+                out.append((start, new[start-offset:stop-offset].tobytes()))
+        nsent = sum(len(chunk) for off, chunk in out)
+        self.nsent += nsent
+        self.nskipped += len(new)-nsent
+        return out
+
+    def update(self, dev, data, offset=0):
+        new = np.frombuffer(bytes(data), dtype=np.uint8)
+        img, known = self._image(dev, offset+len(new))
+        img[offset:offset+len(new)] = new
+        known[offset:offset+len(new)] = True
+
+    def invalidate(self, dev=None):
+        if dev is None:
+            self.images.clear()
+        else:
+            self.images.pop(dev, None)
+
+    def load(self, pipe, dev, nbytes, offset=0):
+        '''
+        Seed the image of dev from the FPGA (one read), so the first write is already a delta.
+        Returns the bytes read.
+        '''
+        data = pipe.call([("read", (dev, offset, nbytes))])[0][0]
+        self.update(dev, data, offset)
+        return data
+
+    def write(self, pipe, dev, data, offset=0, verify=True):
+        '''
+        Write data to dev as a minimal set of range writes in one round trip (plus one to read
+        back the touched ranges if verify). Returns the (device, offset, data) writes sent.
+        '''
+        return ConfigPlan().write(dev, data, offset, verify).run(pipe, verify, self)
+
+def arp_table(mac, nentries=256):
+    '''
+    one_gbe ARP table (offset 0x3000) with every entry set to mac, as one block of 8-byte >Q words.
+    '''
+    if isinstance(mac, str):
+        mac = int(mac, 16)
+    return struct.pack(">Q", mac)*nentries
@@ -0,0 +1,178 @@
+import argparse
+import collections
+import datetime
+import math
+import threading
+import time
+import numpy as np
+
+import albatros_daq_utils as utils
+import lbtools_l
+
+class GpsClock:
+    '''
+    Background thread that reads NAV-PVT continuously and keeps a linear fit of GPS (UTC) time
+    against time.monotonic(), using the nano field so each fix is good to well under a millisecond
+    instead of the whole seconds set_clock_lb uses.
+
+    The fit is over the last npoint fixes with outliers (late USB deliveries) rejected, and is
+    published as one immutable tuple, so now_gps() is a single attribute read plus arithmetic and
+    needs no lock in the capture path.
+
+    gps: a lbtools_l.LeoBodnarGPS (or anything with read_pvt() returning ubx.NavPvt)
+    latency: seconds from the navigation epoch to the end of the USB read, subtracted from each fix.
+        The receiver sends NAV-PVT only after it has computed the solution, and the USB read adds
+        its own delay, so this is tens of milliseconds and never zero: with latency=0 every time
+        from now_gps() is early by that delay. Measure it once per receiver and USB setup with
+        calibrate_latency() and pass it in.
+    '''
+    def __init__(self, gps=None, npoint=64, min_points=3, latency=0.0, max_resid=1e-3, logger=None):
+        self.gps = gps if gps is not None else lbtools_l.LeoBodnarGPS()
+        self.min_points = min_points
+        self.latency = latency
+        self.max_resid = max_resid
+        self.logger = logger
+        self._points = collections.deque(maxlen=npoint) # (monotonic, gps - monotonic)
+        self._fit = None # (mono_ref, offset at mono_ref, rate error, rms residual, npoint used)
+        self.last = None # last NavPvt with valid time
+        self.nfix = 0
+        self.ninvalid = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def add(self, mono, gps_time):
+        '''
+        Add one fix (monotonic time it refers to, GPS time) and refit.
+        '''
+        self._points.append((mono, gps_time-mono))
+        self.nfix += 1
+        if len(self._points) >= self.min_points:
+            self._refit()
+
+    def _refit(self):
+        pts = np.array(self._points)
+        mono_ref = pts[-1, 0]
+        x = pts[:, 0]-mono_ref
+        y = pts[:, 1]
+        for i in range(2):
+            d, c = np.polyfit(x, y, 1)
+            resid = y-(c+d*x)
+            # USB delivery delay only ever makes a fix late, so clip on the worst residuals and fit again
+            good = np.abs(resid) <= max(3*1.4826*np.median(np.abs(resid)), self.max_resid)
+            if good.all() or good.sum() < self.min_points:
+                break
+            x, y = x[good], y[good]
+        rms = float(np.sqrt(np.mean(resid**2)))
+        self._fit = (mono_ref, float(c), float(d), rms, len(resid))
+
+    def now_gps(self, mono=None):
+        '''
+        GPS (UTC) time in seconds since 1970 for monotonic time mono (default now), nan before the first fit.
+        '''
+        fit = self._fit
+        if fit is None:
+            return math.nan
+        if mono is None:
+            mono = time.monotonic()
+        return mono+fit[1]+fit[2]*(mono-fit[0])
+
+    def gpsread(self):
+        '''
+        lbtools_l.lb_read()-style tuple for now, e.g. as BasebandRecorder's gps_fn.
+        nano holds the fraction of the second so baseband_format.gps_fields recovers the full time.
+        '''
+        t = self.now_gps()
+        rec = self.last
+        if math.isnan(t) or rec is None:
+            return None, None, None
+        tstamp = math.floor(t)
+        validity = "{0:b}".format(rec.valid)
+        validity = (4-len(validity))*'0'+validity
+        return tstamp, (t-tstamp, validity, rec.lon, rec.lat, rec.alt), datetime.datetime(1970, 1, 1)+datetime.timedelta(seconds=tstamp)
+
+    def poll(self):
+        '''
+        Read one NAV-PVT and add it to the fit if its time is valid. Returns the record or None.
+        '''
+        rec = self.gps.read_pvt()
+        mono = time.monotonic()
+        if rec is None:
+            return None
+        if not rec.time_valid:
+            self.ninvalid += 1
+            return rec
+        self.last = rec
+        self.add(mono-self.latency, rec.unix_time())
+        return rec
+
+    def calibrate_latency(self, n=30):
+        '''
+        Estimate the NAV-PVT delivery delay from n fixes as the median of system time at the end of
+        the read minus the fix time. Needs the system clock to be NTP-disciplined (to a few ms) while
+        it runs. Sets and returns self.latency; points already in the fit are dropped.
+        '''
+        delays = []
+        while len(delays) < n:
+            rec = self.gps.read_pvt()
+            now = time.time()
+            if rec is None:
+                break
+            if rec.time_valid:
+                delays.append(now-rec.unix_time())
+        if not delays:
+            raise RuntimeError("no valid NAV-PVT fixes to calibrate the latency from")
+        self.latency = float(np.median(delays))
+        self._points.clear()
+        self._fit = None
+        utils.lprint("GpsClock: NAV-PVT latency {:.1f} ms (spread {:.1f} ms over {} fixes)".format(
+            1e3*self.latency, 1e3*(np.percentile(delays, 90)-np.percentile(delays, 10)), len(delays)), self.logger)
+        return self.latency
+
+    def _run(self):
+        while not self._stop.is_set():
+            if self.poll() is None:
+                self._stop.wait(1.0)
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def stats(self):
+        fit = self._fit
+        if fit is None:
+            return {"nfix": self.nfix, "ninvalid": self.ninvalid, "locked": False}
+        return {"nfix": self.nfix, "ninvalid": self.ninvalid, "locked": True, "npoint": fit[4],
+                "rate_ppm": 1e6*fit[2], "resid_us": 1e6*fit[3], "age_s": time.monotonic()-fit[0],
+                "gps_minus_sys_ms": 1e3*(self.now_gps()-time.time())}
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Discipline a monotonic clock to the Leo Bodnar GPS and report the fit")
+    parser.add_argument("-t", "--duration", type=float, default=60, help="Seconds to run")
+    parser.add_argument("-i", "--interval", type=float, default=5, help="Seconds between reports")
+    parser.add_argument("-l", "--latency", type=float, default=0.0, help="Seconds from the GPS epoch to the USB read")
+    parser.add_argument("--calibrate", type=int, default=0, help="Measure the latency against the (NTP-synced) system clock from this many fixes first")
+    args = parser.parse_args()
+
+    clock = GpsClock(latency=args.latency)
+    if args.calibrate:
+        clock.calibrate_latency(args.calibrate)
+    clock.start()
+    t1 = time.time()
+    try:
+        while time.time()-t1 < args.duration:
+            time.sleep(args.interval)
+            utils.lprint("{}".format(clock.stats()))
+        n = 100000
+        t2 = time.perf_counter()
+        for i in range(n):
+            clock.now_gps()
+        utils.lprint("now_gps: {:.2f} us per call".format(1e6*(time.perf_counter()-t2)/n))
+    finally:
+        clock.stop()
+        clock.gps.close()
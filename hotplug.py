@@ -0,0 +1,398 @@
+import argparse
+import ctypes
+import ctypes.util
+import json
+import os
+import select
+import socket
+import struct
+import time
+
+import inventory
+
+# Block device hotplug events, so mount logic wakes as soon as a drive and its partitions show up
+# instead of polling lsblk every few seconds. Sources, best first:
+#   UeventMonitor   kernel uevents on a NETLINK_KOBJECT_UEVENT socket (no root needed)
+#   InotifyMonitor  inotify on /dev/disk/by-id, if netlink isn't available
+#   PollMonitor     plain timed polling of the inventory
+#   ReplayMonitor   events recorded with record(), for testing without hardware
+# All have wait(timeout) -> list of events, each a dict of uevent properties (ACTION, DEVPATH,
+# SUBSYSTEM, DEVNAME, DEVTYPE, ...). Recorded events also carry X_MODEL and X_SIZE, read from sysfs
+# at record time, so a replay doesn't depend on the machine it runs on.
+NETLINK_KOBJECT_UEVENT = 15
+UEVENT_KERNEL = 1 # multicast group of raw kernel events (group 2 is udev's, only there if udevd runs)
+UDEV_MAGIC = 0xfeedcafe
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+IN_MOVED_TO = 0x80
+IN_NONBLOCK = os.O_NONBLOCK
+
+def parse_uevent(msg):
+    '''
+    Parse a kernel ("add@/devices/...\\0KEY=VAL\\0...") or libudev netlink message into a dict.
+    '''
+    if msg.startswith(b"libudev\x00"):
+        magic, = struct.unpack_from(">I", msg, 8)
+        if magic != UDEV_MAGIC:
+            return None
+        header_size, off, length = struct.unpack_from("=III", msg, 12)
+        fields = msg[off:off+length].split(b"\x00")
+    else:
+        fields = msg.split(b"\x00")[1:]
+    event = {}
+    for field in fields:
+        key, sep, value = field.partition(b"=")
+        if sep:
+            event[key.decode(errors="replace")] = value.decode(errors="replace")
+    return event
+
+class UeventMonitor:
+    def __init__(self, groups=UEVENT_KERNEL, rcvbuf=1 << 20):
+        self.sock = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW | socket.SOCK_NONBLOCK, NETLINK_KOBJECT_UEVENT)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, rcvbuf)
+        self.sock.bind((0, groups))
+
+    def wait(self, timeout):
+        if not select.select([self.sock], [], [], max(timeout, 0))[0]:
+            return []
+        events = []
+        while True:
+            try:
+                msg = self.sock.recv(65536)
+            except BlockingIOError:
+                return events
+            event = parse_uevent(msg)
+            if event:
+                events.append(event)
+
+    def close(self):
+        self.sock.close()
+
+class InotifyMonitor:
+    '''
+    Events are {"ACTION": "add"/"remove", "SUBSYSTEM": "inotify", "NAME": link name}; the device
+    itself has to be looked up in the inventory.
+    '''
+    def __init__(self, path="/dev/disk/by-id"):
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        self.fd = libc.inotify_init1(IN_NONBLOCK)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        if libc.inotify_add_watch(self.fd, path.encode(), IN_CREATE | IN_DELETE | IN_MOVED_TO) < 0:
+            os.close(self.fd)
+            raise OSError(ctypes.get_errno(), "inotify_add_watch {} failed".format(path))
+
+    def wait(self, timeout):
+        if not select.select([self.fd], [], [], max(timeout, 0))[0]:
+            return []
+        events = []
+        try:
+            buf = os.read(self.fd, 65536)
+        except BlockingIOError:
+            return events
+        pos = 0
+        while pos+16 <= len(buf):
+            wd, mask, cookie, length = struct.unpack_from("iIII", buf, pos)
+            name = buf[pos+16:pos+16+length].rstrip(b"\x00").decode(errors="replace")
+            events.append({"ACTION": "remove" if mask & IN_DELETE else "add", "SUBSYSTEM": "inotify", "NAME": name})
+            pos += 16+length
+        return events
+
+    def close(self):
+        os.close(self.fd)
+
+class PollMonitor:
+    def __init__(self, dt=2.0):
+        self.dt = dt
+
+    def wait(self, timeout):
+        time.sleep(max(min(self.dt, timeout), 0))
+        return [{"ACTION": "poll", "SUBSYSTEM": "poll"}]
+
+    def close(self):
+        pass
+
+class ReplayMonitor:
+    '''
+    Play back (t, event) pairs, or a file written by record(), at `speed` times real time
+    (speed=0 delivers everything immediately).
+    '''
+    def __init__(self, events, speed=1.0):
+        if isinstance(events, str):
+            with open(events) as f:
+                events = [(rec["t"], rec["event"]) for rec in map(json.loads, f)]
+        self.events = list(events)
+        self.speed = speed
+        self.t0 = time.monotonic()
+        self.pos = 0
+
+    def _due(self, j):
+        return self.t0+(self.events[j][0]/self.speed if self.speed else 0)
+
+    def wait(self, timeout):
+        if self.pos >= len(self.events):
+            time.sleep(max(timeout, 0))
+            return []
+        delay = self._due(self.pos)-time.monotonic()
+        if delay > timeout:
+            time.sleep(max(timeout, 0))
+            return []
+        if delay > 0:
+            time.sleep(delay)
+        now = time.monotonic()
+        out = []
+        while self.pos < len(self.events) and self._due(self.pos) <= now:
+            out.append(self.events[self.pos][1])
+            self.pos += 1
+        return out
+
+    def close(self):
+        pass
+
+def open_monitor():
+    for make in (UeventMonitor, InotifyMonitor):
+        try:
+            return make()
+        except OSError:
+            pass
+    return PollMonitor()
+
+def _sysfs(devpath, name):
+    try:
+        with open("/sys"+devpath+"/"+name) as f:
+            return f.read().strip()
+    except OSError:
+        return None
+
+class DriveWatcher:
+    '''
+    Keep a table of block devices up to date from hotplug events and wait for a drive matching
+    drive_models (as in get_lsblk) to appear with its partitions.
+
+    Create the watcher before powering the drive so no event is missed. Drives already in the table
+    then (e.g. the previous mux slot's, whose removal hasn't come through yet) are stale: by default
+    wait_for_drive() only takes a drive once it has been added, or been seen gone, since, or after
+    accept_present() declared the leftovers gone. Monitors
+    without device details (inotify, polling) trigger a rescan of the inventory instead. With live
+    monitors a partition only counts once its /dev node exists, since the kernel event comes before
+    udev creates it.
+
+    disks: initial device table (as in self.disks); default from the inventory, or empty for a replay
+    '''
+    def __init__(self, drive_models, monitor=None, settle=0.1, disks=None):
+        if not isinstance(drive_models, list):
+            drive_models = [m.strip() for m in drive_models.split(",")]
+        self.drive_models = drive_models
+        self.monitor = monitor if monitor is not None else open_monitor()
+        self.replay = isinstance(self.monitor, ReplayMonitor)
+        self.settle = settle # quiet time before a match is final, and recheck interval while waiting for /dev nodes
+        self.disks = {} # name -> {"Size", "Model", "Partitions": {name: size}}
+        self.nevent = 0
+        self._stale = set()
+        if disks is not None:
+            self.disks = disks
+        elif not self.replay:
+            self._rescan()
+        self._stale = set(self.disks) # disks present at construction and not added or removed since
+
+    def close(self):
+        self.monitor.close()
+
+    def _rescan(self):
+        inventory.invalidate()
+        old = self.disks
+        self.disks = {d["Name"]: {"Size": d["Size"], "Model": d["Model"], "Partitions": {p["Name"]: p["Size"] for p in d["Partitions"]}}
+                      for d in inventory.block_devices()}
+        for name in list(self._stale):
+            new = self.disks.get(name)
+            if new is None or (new["Size"], new["Model"]) != (old[name]["Size"], old[name]["Model"]):
+                self._stale.discard(name)
+        return self.disks != old
+
+    def apply(self, event):
+        '''
+        Update the device table from one event. Returns True if block devices may have changed.
+        '''
+        self.nevent += 1
+        subsystem = event.get("SUBSYSTEM")
+        if subsystem in ("inotify", "poll"):
+            return self._rescan()
+        if subsystem != "block" or "DEVNAME" not in event:
+            return False
+        inventory.invalidate()
+        name = os.path.basename(event["DEVNAME"])
+        action = event.get("ACTION")
+        devpath = event.get("DEVPATH", "")
+        if event.get("DEVTYPE") == "partition":
+            disk = self.disks.get(os.path.basename(os.path.dirname(devpath)))
+            if disk is None:
+                return True
+            if action == "remove":
+                disk["Partitions"].pop(name, None)
+            else:
+                size = event.get("X_SIZE") or _sysfs(devpath, "size") or "0"
+                disk["Partitions"][name] = int(size)*inventory.SECTOR_BYTES
+        elif action == "remove":
+            self.disks.pop(name, None)
+            self._stale.discard(name)
+        else:
+            self._stale.discard(name)
+            model = event.get("X_MODEL")
+            if model is None:
+                model = _sysfs(devpath, "device/model") or event.get("ID_MODEL", "").replace("_", " ")
+            size = event.get("X_SIZE") or _sysfs(devpath, "size") or "0"
+            old = self.disks.get(name, {}).get("Partitions", {})
+            self.disks[name] = {"Size": int(size)*inventory.SECTOR_BYTES, "Model": " ".join(model.split()), "Partitions": old}
+        return True
+
+    def accept_present(self):
+        '''
+        Apply queued events, then stop treating the drives still present as stale. Call once the
+        previous mux slot's drive has had time to go (e.g. after selecting the new slot), so a drive
+        that was already attached and powered counts without a power cycle.
+        '''
+        while self.wait_event(0):
+            pass
+        self._stale.clear()
+
+    def match(self, fresh=False):
+        '''
+        Partitions of the first matching drive, as in one entry of get_lsblk(), or None.
+        Second value is True if a drive matched but its /dev nodes aren't there yet.
+        With fresh, stale drives (see the class docstring) are skipped.
+        '''
+        pending = False
+        for name in sorted(self.disks):
+            if fresh and name in self._stale:
+                continue
+            disk = self.disks[name]
+            line = name+" "+str(disk["Size"])+" "+disk["Model"]
+            if disk["Size"] > 0 and disk["Partitions"] and any(m in line for m in self.drive_models):
+                parts = [{"Name": "/dev/"+p, "Size": size, "Model": disk["Model"]} for p, size in sorted(disk["Partitions"].items())]
+                if self.replay or all(os.path.exists(p["Name"]) for p in parts):
+                    return parts, False
+                pending = True
+        return None, pending
+
+    def wait_event(self, timeout):
+        '''
+        Wait up to timeout for hotplug events and apply them. Returns True if block devices may have changed.
+        '''
+        changed = False
+        for event in self.monitor.wait(timeout):
+            changed |= self.apply(event)
+        return changed
+
+    def wait_for_drive(self, timeout=120, fresh=True):
+        '''
+        Block until a drive matching drive_models has partitions, or timeout. Returns the partition
+        list (as in get_lsblk) or None. Events already queued are applied first, and with fresh
+        only a drive added since the watcher was created counts.
+        '''
+        t1 = time.monotonic()
+        while self.wait_event(0):
+            pass
+        while True:
+            parts, pending = self.match(fresh)
+            left = t1+timeout-time.monotonic()
+            if parts is not None:
+                # the kernel adds partitions one by one right after the disk; take them all
+                while self.wait_event(self.settle):
+                    pass
+                return self.match(fresh)[0] or parts
+            if left <= 0:
+                return None
+            self.wait_event(min(left, self.settle) if pending else left)
+
+    def wait_for_removal(self, name, timeout=30):
+        '''
+        Block until disk `name` (e.g. "sda") is gone. Returns True if it went away in time.
+        '''
+        name = os.path.basename(name)
+        t1 = time.monotonic()
+        while name in self.disks:
+            left = t1+timeout-time.monotonic()
+            if left <= 0:
+                return False
+            self.wait_event(left)
+        return True
+
+def record(fname, duration, monitor=None):
+    '''
+    Record hotplug events for duration seconds to fname as JSON lines {"t": seconds, "event": {...}},
+    adding X_MODEL and X_SIZE for block devices from sysfs.
+    '''
+    monitor = monitor if monitor is not None else UeventMonitor()
+    t1 = time.monotonic()
+    n = 0
+    with open(fname, "w") as f:
+        while True:
+            left = t1+duration-time.monotonic()
+            if left <= 0:
+                break
+            for event in monitor.wait(left):
+                if event.get("SUBSYSTEM") == "block" and event.get("ACTION") != "remove":
+                    devpath = event.get("DEVPATH", "")
+                    size = _sysfs(devpath, "size")
+                    if size is not None:
+                        event["X_SIZE"] = size
+                    if event.get("DEVTYPE") == "disk":
+                        event["X_MODEL"] = _sysfs(devpath, "device/model") or ""
+                f.write(json.dumps({"t": time.monotonic()-t1, "event": event})+"\n")
+                n += 1
+    return n
+
+def synth_events(model="My Book 25EE", disk="sda", nparts=1, sectors=1 << 33, t0=0.5, dt=0.02):
+    '''
+    Event sequence of a USB drive being plugged in (usb, scsi, then disk and partitions), as
+    (t, event) pairs for ReplayMonitor.
+    '''
+    usb = "/devices/platform/scb/fd500000.pcie/pci0000:00/0000:00:00.0/0000:01:00.0/usb2/2-1"
+    blk = usb+"/2-1:1.0/host0/target0:0:0/0:0:0:0/block/"+disk
+    events = [{"ACTION": "add", "DEVPATH": usb, "SUBSYSTEM": "usb", "DEVTYPE": "usb_device"},
+              {"ACTION": "add", "DEVPATH": usb+"/2-1:1.0/host0/target0:0:0/0:0:0:0", "SUBSYSTEM": "scsi", "DEVTYPE": "scsi_device"},
+              {"ACTION": "add", "DEVPATH": blk, "SUBSYSTEM": "block", "DEVNAME": disk, "DEVTYPE": "disk",
+               "X_MODEL": model, "X_SIZE": str(sectors)}]
+    for j in range(nparts):
+        events.append({"ACTION": "add", "DEVPATH": blk+"/"+disk+str(j+1), "SUBSYSTEM": "block", "DEVNAME": disk+str(j+1),
+                       "DEVTYPE": "partition", "PARTN": str(j+1), "X_SIZE": str(sectors//nparts-2048)})
+    return [(t0+j*dt, event) for j, event in enumerate(events)]
+
+def selftest(speed=1.0):
+    '''
+    Replay a synthetic plug-in and check the watcher finds the largest partition of the right drive
+    and ignores others. Returns the seconds from the last partition event to detection.
+    '''
+    events = synth_events("Other Drive", "sdb", 1, t0=0.1) + synth_events("My Book 25EE", "sda", 2, t0=0.3)
+    watcher = DriveWatcher(["My Book"], ReplayMonitor(events, speed))
+    t1 = time.monotonic()
+    parts = watcher.wait_for_drive(timeout=5)
+    dt = time.monotonic()-t1
+    assert parts is not None, "drive not found"
+    assert [p["Name"] for p in parts] == ["/dev/sda1", "/dev/sda2"], parts
+    assert parts[0]["Model"] == "My Book 25EE"
+    watcher.monitor = ReplayMonitor([(0.01, {"ACTION": "remove", "SUBSYSTEM": "block", "DEVNAME": "sda", "DEVTYPE": "disk", "DEVPATH": "/x/block/sda"})], speed)
+    assert watcher.wait_for_removal("sda", timeout=1)
+    last = events[-1][0]/speed if speed else 0
+    return dt-last
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Watch, record or replay block device hotplug events")
+    parser.add_argument("-m", "--models", type=str, default="", help="Comma separated drive models to wait for")
+    parser.add_argument("-t", "--timeout", type=float, default=60, help="Seconds to watch or record")
+    parser.add_argument("--record", type=str, default=None, help="Record events to this file")
+    parser.add_argument("--replay", type=str, default=None, help="Replay events from this file instead of watching")
+    parser.add_argument("--speed", type=float, default=1.0, help="Replay speed (0 for instant)")
+    parser.add_argument("--selftest", action="store_true", help="Replay a synthetic plug-in and check detection")
+    args = parser.parse_args()
+
+    if args.selftest:
+        print("selftest ok, detected {:.1f} ms after the last event".format(1e3*selftest(args.speed)))
+    elif args.record is not None:
+        print("recorded {} events".format(record(args.record, args.timeout)))
+    else:
+        monitor = ReplayMonitor(args.replay, args.speed) if args.replay else None
+        watcher = DriveWatcher(args.models, monitor)
+        t1 = time.monotonic()
+        parts = watcher.wait_for_drive(args.timeout)
+        print("found {} after {:.3f} s ({} events)".format(parts, time.monotonic()-t1, watcher.nevent) if parts else "timeout")
@@ -0,0 +1,231 @@
+import argparse
+import fcntl
+import functools
+import os
+import re
+import socket
+import struct
+import subprocess
+import time
+
+# Drive, mount and network inventory read straight from /proc and /sys (plus statvfs), so the
+# albatros_daq_utils helpers don't fork df/lsblk/ifconfig. Results are cached for a short TTL;
+# call invalidate() after anything that changes them (mount, umount, drive power).
+TTL = 1.0 # seconds
+SECTOR_BYTES = 512 # /sys/block/*/size is always in 512-byte sectors
+SIOCGIFFLAGS = 0x8913
+SIOCGIFADDR = 0x8915
+ARPHRD_ETHER = 1 # /sys/class/net/*/type of interfaces with an ethernet MAC
+
+_caches = []
+
+def cached(fn):
+    '''
+    Memoize fn(*args) for TTL seconds.
+    '''
+    cache = {}
+    _caches.append(cache)
+
+    @functools.wraps(fn)
+    def wrapper(*args):
+        now = time.monotonic()
+        hit = cache.get(args)
+        if hit is not None and now-hit[0] < TTL:
+            return hit[1]
+        value = fn(*args)
+        cache[args] = (now, value)
+        return value
+    return wrapper
+
+def invalidate():
+    for cache in _caches:
+        cache.clear()
+
+def _unescape(path):
+    # mountinfo escapes space, tab, newline and backslash as \ooo
+    return re.sub(r"\\([0-7]{3})", lambda m: chr(int(m.group(1), 8)), path)
+
+@cached
+def mounts():
+    '''
+    Mounted filesystems from /proc/self/mountinfo, in mount order:
+    [{"Device": "/dev/sda1", "Mounted on": "/media/pi/BASEBAND", "Type": "ext4", "Options": "rw,noatime", "Dev": "8:1"}, ...]
+    '''
+    out = []
+    with open("/proc/self/mountinfo") as f:
+        for line in f:
+            pre, post = line.rstrip("\n").split(" - ", 1)
+            pre = pre.split()
+            post = post.split()
+            out.append({"Device": _unescape(post[1]), "Mounted on": _unescape(pre[4]), "Type": post[0],
+                        "Options": pre[5], "Dev": pre[2]})
+    return out
+
+def _read(path, default=None):
+    try:
+        with open(path) as f:
+            return f.read().strip()
+    except OSError:
+        return default
+
+@cached
+def block_devices():
+    '''
+    Whole-disk block devices from /sys/block, sorted by name like lsblk:
+    [{"Name": "sda", "Size": bytes, "Model": "My Book 25EE", "Removable": bool,
+      "Partitions": [{"Name": "sda1", "Size": bytes}, ...]}, ...]
+    '''
+    out = []
+    for name in sorted(os.listdir("/sys/block")):
+        base = os.path.join("/sys/block", name)
+        parts = []
+        for sub in sorted(os.listdir(base)):
+            if sub.startswith(name) and os.path.exists(os.path.join(base, sub, "partition")):
+                parts.append({"Name": sub, "Size": int(_read(os.path.join(base, sub, "size"), "0"))*SECTOR_BYTES})
+        model = " ".join(_read(os.path.join(base, "device", "model"), "").split())
+        out.append({"Name": name, "Size": int(_read(os.path.join(base, "size"), "0"))*SECTOR_BYTES, "Model": model,
+                    "Removable": _read(os.path.join(base, "removable")) == "1", "Partitions": parts})
+    return out
+
+@cached
+def disk_serial(name):
+    '''
+    Serial number of whole disk name (e.g. "sda"), or None. Taken from the nearest device up the
+    sysfs tree that has one (the USB device for USB drives, the controller for NVMe/MMC), else
+    from the SCSI unit serial number page.
+    '''
+    path = os.path.realpath(os.path.join("/sys/block", name, "device"))
+    while path.startswith("/sys/devices/"):
+        serial = _read(os.path.join(path, "serial"))
+        if serial:
+            return serial
+        path = os.path.dirname(path)
+    try:
+        with open(os.path.join("/sys/block", name, "device", "vpd_pg80"), "rb") as f:
+            page = f.read()
+        return page[4:4+page[3]].decode(errors="replace").strip() or None
+    except (OSError, IndexError):
+        return None
+
+def device_at(mount_point):
+    '''
+    Device mounted at mount_point (e.g. /dev/sda1), or None.
+    '''
+    for m in mounts():
+        if m["Mounted on"] == mount_point:
+            return m["Device"]
+    return None
+
+def disk_of(device):
+    '''
+    Whole disk name of a partition device, e.g. "/dev/sda1" -> "sda", or None.
+    '''
+    name = os.path.basename(device)
+    for disk in block_devices():
+        if disk["Name"] == name or any(p["Name"] == name for p in disk["Partitions"]):
+            return disk["Name"]
+    return None
+
+def disk_model(name):
+    '''
+    Model of whole disk name (e.g. "sda"), "" if unknown.
+    '''
+    return next((d["Model"] for d in block_devices() if d["Name"] == name), "")
+
+def df(mountpoint):
+    '''
+    Sizes in bytes for a mounted filesystem, computed the way df does.
+    Returns {"Blocks", "Used", "Available", "Use%"}.
+    '''
+    st = os.statvfs(mountpoint)
+    blocks = st.f_blocks*st.f_frsize
+    used = (st.f_blocks-st.f_bfree)*st.f_frsize
+    avail = st.f_bavail*st.f_frsize
+    # df rounds Use% up, over the space available to unprivileged users
+    pct = -(-100*used//(used+avail)) if used+avail > 0 else 0
+    return {"Blocks": blocks, "Used": used, "Available": avail, "Use%": pct}
+
+def mountpoint_of(device):
+    '''
+    First mount point of device (e.g. /dev/sda1), or None.
+    '''
+    for m in mounts():
+        if m["Device"] == device:
+            return m["Mounted on"]
+    return None
+
+@cached
+def _ifreq(interface, request):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        return fcntl.ioctl(sock.fileno(), request, struct.pack("256s", interface.encode()[:15]))
+    except OSError:
+        return None
+    finally:
+        sock.close()
+
+def interface_address(interface):
+    '''
+    IPv4 address of a network interface as a dotted string, or None.
+    '''
+    res = _ifreq(interface, SIOCGIFADDR)
+    return socket.inet_ntoa(res[20:24]) if res else None
+
+def interface_flags(interface):
+    '''
+    Interface flags as an int, or None. These come from SIOCGIFFLAGS, as ifconfig's flags= does;
+    /sys/class/net/*/flags leaves out kernel-maintained bits such as IFF_RUNNING.
+    '''
+    res = _ifreq(interface, SIOCGIFFLAGS)
+    return struct.unpack("H", res[16:18])[0] if res else None
+
+@cached
+def interfaces():
+    '''
+    Network interfaces from /sys/class/net: {name: {"mac": "0x..." or None, "flags": int, "ip": str or None}}.
+    Like ifconfig's ether line, mac is only given for ethernet interfaces (so None for lo).
+    '''
+    out = {}
+    for name in sorted(os.listdir("/sys/class/net")):
+        base = os.path.join("/sys/class/net", name)
+        mac = _read(os.path.join(base, "address"))
+        if _read(os.path.join(base, "type")) != str(ARPHRD_ETHER):
+            mac = None
+        out[name] = {"mac": "0x"+mac.replace(":", "") if mac else None,
+                     "flags": interface_flags(name),
+                     "ip": interface_address(name)}
+    return out
+
+def benchmark(n=1000):
+    '''
+    Seconds per call of df/lsblk forks against the inventory, uncached and cached.
+    '''
+    out = {}
+    t1 = time.perf_counter()
+    for i in range(max(n//100, 1)):
+        subprocess.check_output(["df", "-k"])
+    out["df fork"] = (time.perf_counter()-t1)/max(n//100, 1)
+    t1 = time.perf_counter()
+    for i in range(n):
+        invalidate()
+        mounts()
+        block_devices()
+    out["mounts+block_devices"] = (time.perf_counter()-t1)/n
+    t1 = time.perf_counter()
+    for i in range(n):
+        mounts()
+        block_devices()
+    out["cached"] = (time.perf_counter()-t1)/n
+    return out
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Show the drive/mount/network inventory and time it against forking df")
+    parser.add_argument("-n", "--ncall", type=int, default=1000, help="Calls to time")
+    args = parser.parse_args()
+
+    for dev in block_devices():
+        print(dev["Name"], dev["Size"], repr(dev["Model"]), [(p["Name"], p["Size"], mountpoint_of("/dev/"+p["Name"])) for p in dev["Partitions"]])
+    for name, info in interfaces().items():
+        print(name, info)
+    for what, dt in benchmark(args.ncall).items():
+        print("{}: {:.1f} us per call".format(what, 1e6*dt))
@@ -0,0 +1,260 @@
+import argparse
+import socketserver
+import struct
+import threading
+import time
+import numpy as np
+
+from channel_plan import REORDER_MAP_BYTES
+from fpga_config import BramShadow, ConfigPlan, KatcpPipeline, arp_table, katcp_escape, katcp_unescape
+
+REGISTERS = ["packetiser_sel", "packetiser_spec_per_pkt", "packetiser_bytes_per_spec", "packetiser_tvg4bit_enable",
+             "dest_ip", "dest_port", "in_gbe_enable", "in_gbe_reset", "in_packet_reset", "in_sw_sync", "in_counter_reset",
+             "fft_shift", "xcorr_acc_len", "fft_of", "tx_of_cnt", "sync_cnt", "pfb_fft_of", "acc_cnt", "xadc",
+             "snapshot_adc0_ctrl", "snapshot_adc0_status", "snapshot_adc3_ctrl", "snapshot_adc3_status"]
+BRAMS = {"packetiser_one_bit_reorder_map1": REORDER_MAP_BYTES[1],
+         "packetiser_two_bit_reorder_map1": REORDER_MAP_BYTES[2],
+         "packetiser_four_bit_reorder_map1": REORDER_MAP_BYTES[4],
+         "two_bit_quant_coeffs": 4*2048,
+         "four_bit_quant_coeffs": 4*2048,
+         "one_gbe": 0x4000,
+         "pol00": 8*2048, "pol11": 8*2048, "pol01r": 8*2048, "pol01i": 8*2048,
+         "snapshot_adc0_bram": 8192, "snapshot_adc3_bram": 8192}
+SNAPSHOT_DONE = 1 << 31
+
+class KatcpSim:
+    '''
+    Simulated SNAP katcp server (tcpborphserver subset) for testing and benchmarking configuration without hardware.
+
+    Implements ?read ?write ?wordread ?wordwrite ?listdev ?progdev ?fpgastatus ?watchdog on the registers
+    and BRAMs above. Writing a snapshot_adcN_ctrl register fills snapshot_adcN_bram with fresh int8 ADC
+    samples and sets snapshot_adcN_status to SNAPSHOT_DONE | nbytes. acc_cnt and sync_cnt count up
+    every acc_period seconds.
+
+    latency: seconds spent on every request (FPGA bus access time)
+    rtt: seconds added once per chunk received from a client (network round trip)
+    '''
+    def __init__(self, host="127.0.0.1", port=7147, latency=0.0, rtt=0.0, acc_period=1.0, adc_rms=8.0):
+        self.latency = latency
+        self.rtt = rtt
+        self.acc_period = acc_period
+        self.adc_rms = adc_rms
+        self.devices = {name: bytearray(4) for name in REGISTERS}
+        self.devices.update({name: bytearray(size) for name, size in BRAMS.items()})
+        self.lock = threading.Lock()
+        self.nrequest = 0
+        self.nchunk = 0
+        self.requests = [] # (name, args) log of every request
+        self.t0 = time.time()
+        self._rng = np.random.default_rng(0)
+        sim = self
+
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                self.wfile.write(b"#version-connect katcp-protocol 5.0-IM\n#version-connect katcp-library katcp_sim 0.1\n")
+                buf = b""
+                while True:
+                    chunk = self.request.recv(65536)
+                    if not chunk:
+                        break
+                    sim.nchunk += 1
+                    if sim.rtt:
+                        time.sleep(sim.rtt)
+                    buf += chunk
+                    lines = buf.split(b"\n")
+                    buf = lines.pop()
+                    out = [sim.handle_line(line.rstrip(b"\r")) for line in lines if line.strip()]
+                    if out:
+                        self.wfile.write(b"".join(out))
+
+        socketserver.ThreadingTCPServer.allow_reuse_address = True
+        self.server = socketserver.ThreadingTCPServer((host, port), Handler)
+        self.server.daemon_threads = True
+        self.host, self.port = self.server.server_address
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def device(self, name):
+        with self.lock:
+            return bytes(self._read(name, 0, len(self.devices[name])))
+
+    def read_int(self, name):
+        return struct.unpack(">I", self.device(name)[:4])[0]
+
+    def _read(self, name, offset, length):
+        if name in ("acc_cnt", "sync_cnt"):
+            struct.pack_into(">I", self.devices[name], 0, int((time.time()-self.t0)/self.acc_period) & 0xffffffff)
+        dev = self.devices[name]
+        if offset < 0 or offset+length > len(dev):
+            raise IndexError("{} bytes at {} out of range for {} ({} bytes)".format(length, offset, name, len(dev)))
+        return dev[offset:offset+length]
+
+    def _write(self, name, offset, data):
+        dev = self.devices[name]
+        if offset < 0 or offset+len(data) > len(dev):
+            raise IndexError("{} bytes at {} out of range for {} ({} bytes)".format(len(data), offset, name, len(dev)))
+        dev[offset:offset+len(data)] = data
+        if name.startswith("snapshot_adc") and name.endswith("_ctrl"):
+            base = name[:-len("_ctrl")]
+            bram = self.devices[base+"_bram"]
+            samples = np.clip(np.round(self._rng.normal(0, self.adc_rms, len(bram))), -128, 127).astype(np.int8)
+            bram[:] = samples.tobytes()
+            struct.pack_into(">I", self.devices[base+"_status"], 0, SNAPSHOT_DONE | len(bram))
+
+    def handle_line(self, line):
+        if not line.startswith(b"?"):
+            return b""
+        parts = line[1:].split(b" ")
+        name = parts[0]
+        mid = b""
+        if b"[" in name:
+            name, mid = name.split(b"[", 1)
+            mid = b"[" + mid
+        name = name.decode()
+        args = [katcp_unescape(a) for a in parts[1:]]
+        reply = b"!" + name.encode() + mid
+        self.nrequest += 1
+        self.requests.append((name, args))
+        if self.latency:
+            time.sleep(self.latency)
+        try:
+            with self.lock:
+                if name == "read":
+                    data = self._read(args[0].decode(), int(args[1]), int(args[2]))
+                    return reply + b" ok " + katcp_escape(bytes(data)) + b"\n"
+                elif name == "write":
+                    self._write(args[0].decode(), int(args[1]), args[2])
+                    return reply + b" ok\n"
+                elif name == "wordread":
+                    data = self._read(args[0].decode(), 4*int(args[1], 0), 4)
+                    return reply + b" ok 0x%08x\n" % struct.unpack(">I", data)[0]
+                elif name == "wordwrite":
+                    self._write(args[0].decode(), 4*int(args[1], 0), struct.pack(">I", int(args[2], 0) & 0xffffffff))
+                    return reply + b" ok\n"
+                elif name == "listdev":
+                    informs = b"".join(b"#listdev " + n.encode() + b"\n" for n in sorted(self.devices))
+                    return informs + reply + b" ok %d\n" % len(self.devices)
+                elif name in ("progdev", "fpgastatus", "watchdog"):
+                    return reply + b" ok\n"
+        except (IndexError, KeyError, ValueError) as e:
+            return reply + b" fail " + katcp_escape(str(e)) + b"\n"
+        return reply + b" invalid unknown\\_request\n"
+
+def tvg_plan(bits=4, nchan=64, mac=0x0123456789ab):
+    '''
+    A ConfigPlan like the one tvg_test.py sends, plus the legacy ARP table write, for benchmarking.
+    '''
+    import channel_plan
+    plan = ConfigPlan()
+    sel = {1: 0, 2: 1, 4: 2}[bits]
+    chans = channel_plan.channel_plan("0:{}".format(nchan), bits).chans
+    for reg, value in [("packetiser_tvg4bit_enable", 1), ("packetiser_sel", sel), ("dest_ip", 0xc0a80264), ("dest_port", 4321)]:
+        plan.write_int(reg, value)
+    plan.write("packetiser_four_bit_reorder_map1", chans.tobytes())
+    plan.write("four_bit_quant_coeffs", np.full(2048, 1 << 20, dtype=">I").tobytes())
+    for i in range(256):
+        plan.write("one_gbe", struct.pack(">Q", mac), offset=0x3000+8*i)
+    plan.pulse("in_packet_reset")
+    plan.pulse("in_sw_sync")
+    plan.write_int("packetiser_spec_per_pkt", 10)
+    plan.write_int("packetiser_bytes_per_spec", len(chans))
+    plan.pulse("in_gbe_reset")
+    plan.write_int("in_gbe_enable", 1)
+    return plan
+
+def benchmark(latency=0.0, rtt=0.001):
+    '''
+    Time tvg_plan() sent one request per round trip (like separate write_int/fpga.write calls with
+    read-back) against ConfigPlan.run(). Returns (sequential seconds, batched seconds).
+    '''
+    sim = KatcpSim(port=0, latency=latency, rtt=rtt).start()
+    try:
+        plan = tvg_plan()
+        pipe = KatcpPipeline(sim.host, sim.port)
+        # one write and one read-back per original call, each its own round trip
+        t1 = time.time()
+        for i in range(256):
+            pipe.call([("write", ("one_gbe", 0x3000+8*i, struct.pack(">Q", 0x0123456789ab)))])
+            pipe.call([("read", ("one_gbe", 0x3000+8*i, 8))])
+        for dev, offset, data, verify, mergeable in plan.ops:
+            if dev == "one_gbe":
+                continue
+            pipe.call([("write", (dev, offset, bytes(data)))])
+            pipe.call([("read", (dev, offset, len(data)))])
+        t_seq = time.time()-t1
+        t1 = time.time()
+        plan.run(pipe)
+        t_batch = time.time()-t1
+        pipe.close()
+        assert sim.device("one_gbe")[0x3000:0x3800] == arp_table(0x0123456789ab)
+    finally:
+        sim.stop()
+    return t_seq, t_batch
+
+def reconfig_benchmark(rtt=0.001, nchange=16, nrep=20):
+    '''
+    Time a mid-observation reconfiguration (nchange coefficients and one reorder map entry
+    changed) written as full BRAM rewrites with read-back against writes through a BramShadow.
+    Returns (full seconds, shadow seconds, bytes sent through the shadow).
+    '''
+    sim = KatcpSim(port=0, rtt=rtt).start()
+    try:
+        pipe = KatcpPipeline(sim.host, sim.port)
+        rng = np.random.default_rng(0)
+        coeffs = np.full(2048, 1 << 20, dtype=">I")
+        chans = np.repeat(np.arange(256, 256+2048), 2).astype(">H")
+        shadow = BramShadow()
+        ConfigPlan().write("four_bit_quant_coeffs", coeffs.tobytes()).write("packetiser_four_bit_reorder_map1", chans.tobytes()).run(pipe, shadow=shadow)
+        t_full = t_shadow = 0.0
+        for i in range(nrep):
+            coeffs[rng.integers(0, 2048, nchange)] = rng.integers(1 << 18, 1 << 22, nchange)
+            chans[rng.integers(0, len(chans))] = rng.integers(0, 2048)
+            plan = ConfigPlan().write("four_bit_quant_coeffs", coeffs.tobytes()).write("packetiser_four_bit_reorder_map1", chans.tobytes())
+            t1 = time.time()
+            plan.run(pipe)
+            t_full += time.time()-t1
+            # that rewrite went behind the shadow's back; record it so the next delta is against what the BRAMs hold
+            shadow.update("four_bit_quant_coeffs", coeffs.tobytes())
+            shadow.update("packetiser_four_bit_reorder_map1", chans.tobytes())
+            coeffs[rng.integers(0, 2048, nchange)] = rng.integers(1 << 18, 1 << 22, nchange)
+            plan = ConfigPlan().write("four_bit_quant_coeffs", coeffs.tobytes()).write("packetiser_four_bit_reorder_map1", chans.tobytes())
+            shadow.nsent = 0
+            t1 = time.time()
+            plan.run(pipe, shadow=shadow)
+            t_shadow += time.time()-t1
+            assert sim.device("four_bit_quant_coeffs") == coeffs.tobytes()
+            assert sim.device("packetiser_four_bit_reorder_map1") == chans.tobytes()
+        pipe.close()
+    finally:
+        sim.stop()
+    return t_full/nrep, t_shadow/nrep, shadow.nsent
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run a simulated SNAP katcp server, or benchmark configuration against one")
+    parser.add_argument("-i", "--ip", type=str, default="127.0.0.1", help="Address to listen on")
+    parser.add_argument("-p", "--port", type=int, default=7147, help="Port to listen on")
+    parser.add_argument("-l", "--latency", type=float, default=0.0, help="Seconds of latency per request")
+    parser.add_argument("-r", "--rtt", type=float, default=0.0, help="Seconds of latency per network round trip")
+    parser.add_argument("--bench", action="store_true", help="Benchmark sequential vs batched configuration and exit")
+    args = parser.parse_args()
+
+    if args.bench:
+        t_seq, t_batch = benchmark(args.latency, args.rtt if args.rtt else 0.001)
+        print("sequential: {:.3f} s, batched: {:.3f} s ({:.0f}x)".format(t_seq, t_batch, t_seq/t_batch))
+        t_full, t_shadow, nsent = reconfig_benchmark(args.rtt if args.rtt else 0.001)
+        print("reconfiguration: full rewrite {:.1f} ms, through BramShadow {:.1f} ms ({} bytes)".format(1e3*t_full, 1e3*t_shadow, nsent))
+    else:
+        sim = KatcpSim(args.ip, args.port, args.latency, args.rtt)
+        print("Simulated SNAP listening on {}:{}".format(sim.host, sim.port))
+        try:
+            sim.server.serve_forever()
+        except KeyboardInterrupt:
+            sim.stop()
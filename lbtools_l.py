@@ -1,7 +1,9 @@
-import datetime
+import array
 import usb.core                 # https://github.com/pyusb/pyusb
-import struct
 import os
+import time
+
+from ubx import UbxParser
 
 # copied from new_daq
 
@@ -157,10 +159,9 @@ def lb_read(ntry=1000, timeout=1000):
             usb_safe_cleanup(dev,interface)
             return tstamp, auxdat, gpstime
 
-    packet = None
-    nhead = 4
-    offset1 = 10
-    offset2 = 46
+    # frames are 100 bytes, so a NAV-PVT always spans several 64-byte reads
+    parser = UbxParser()
+    rec = None
 
     for j in range(ntry):
         try:
@@ -176,22 +177,11 @@ def lb_read(ntry=1000, timeout=1000):
             lb_set()
             return tstamp, auxdat, gpstime
 
-        if len(data) < nhead:
-            continue
-        # Look for nav-pvt packet somewhere in the line
-        for i in range(len(data)-nhead):
-            # Look for nav-pvt packet somewhere in the line
-            # Skip the bytes for packet id, class id, length, and gps time of week of the nav epoch
-             if data[i:i+nhead].tolist() == [0xb5, 0x62, 0x01, 0x07]:
-                # Check if nav-pvt packet appears too close to the end
-                if len(data) < i+offset2:
-                    break
-                # ...otherwise snarf the bits we care about
-                packet = data[i+offset1:i+offset2]
-                break
-        if packet:
+        recs = parser.feed_navpvt(data)
+        if recs:
+            rec = recs[-1]
             break
-    if packet is None:
+    if rec is None:
         print("lb_read: read failed")
         #usb.util.release_interface(dev, interface)
         #usb.util.dispose_resources(dev)
@@ -200,58 +190,161 @@ def lb_read(ntry=1000, timeout=1000):
         return tstamp, auxdat, gpstime
 
     try:
-        year = struct.unpack('<H', packet[0:2])
-        year = year[0]
-
-        month = struct.unpack('<B', packet[2:3])
-        month = month[0]
-
-        day = struct.unpack('<B', packet[3:4])
-        day = day[0]
-
-        hour = struct.unpack('<B', packet[4:5])
-        hour = hour[0]
-
-        minute = struct.unpack('<B', packet[5:6])
-        minute = minute[0]
-
-        second = struct.unpack('<B', packet[6:7])
-        second = second[0]
-    except:
-        print("lb_read(): bad tstamp unpack")
-        return tstamp, auxdat, gpstime
-
-    try:
-        datetime.datetime(year, month, day, hour, minute, second)
-    except:
+        return rec.lb_tuple()
+    except ValueError:
         print("lb_read: bad datetime object")
         return tstamp, auxdat, gpstime
 
-    try:
-        validity = packet[7]
-        validity = "{0:b}".format(validity)  # format as binary string to get the bitfield
-        validity = (4-len(validity))*'0'+validity # use the 4 bits of validity to check for a good reading
-
-        nano = struct.unpack('<l', packet[12:16])
-        nano = nano[0]*10**-9
-
-        lon = struct.unpack('<l', packet[20:24])
-        lon = lon[0]*10**-7
-
-        lat = struct.unpack('<l', packet[24:28])
-        lat = lat[0]*10**-7
+#====================================================================
+class LeoBodnarGPS:
+    """
+    Long-lived session with the Leo Bodnar mini GPS.
 
-        alt = struct.unpack('<l', packet[32:36])
-        alt = alt[0]*10**-3
-    except:
-        print("lb_read: bad auxdat unpack")
-        return tstamp, auxdat, gpstime
+    The device is found, detached from the kernel driver, claimed and set to
+    report nav-data once, then kept open. Reads go into one reusable 64-byte
+    buffer. A read timeout is just counted; only a real USB error closes the
+    session and reopens it (with a device reset, like lb_set).
 
-    tstamp = (datetime.datetime(year,month,day,hour,minute,second)-datetime.datetime(1970,1,1)).total_seconds()
-    auxdat = (nano, validity, lon, lat, alt)
-    gpstime = datetime.datetime(year, month, day, hour, minute, second)
+    Reads are fed to a ubx.UbxParser, so NAV-PVT frames split across reads
+    are still decoded and checksummed. read_pvt() returns ubx.NavPvt records,
+    read() the same (tstamp, auxdat, gpstime) tuple as lb_read().
+    """
+    VENDOR_LB = 0x1DD2     # Leo Bodnar's Vendor ID
+    PRODUCT_MGPS = 0x2211  # Mini GPS product ID
+    INTERFACE_MGPS = 0     # 0-based
+    ENDPOINT_IN = 0x81
+    SET_NAVPVT = [8, 6, 1, 8, 0, 0x01, 0x07, 10]  # magic command from lb_set
+
+    def __init__(self, timeout=1000, ntry=1000, reconnect_wait=1.0):
+        self.timeout = timeout  # USB read timeout in milliseconds
+        self.ntry = ntry        # reads per read() before giving up
+        self.reconnect_wait = reconnect_wait
+        self.dev = None
+        self._buf = array.array('B', bytes(64))
+        self._view = memoryview(self._buf)
+        self.parser = UbxParser()
+        self.nread = 0
+        self.ntimeout = 0
+        self.nerror = 0
+        self.nreconnect = 0
+
+    def __enter__(self):
+        self.open()
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def open(self, reset=False):
+        dev = usb.core.find(idVendor=self.VENDOR_LB, idProduct=self.PRODUCT_MGPS)
+        if dev is None:
+            raise IOError("LeoBodnarGPS: failed to find USB device")
+        if reset:
+            dev.reset()
+        #linux only command to detach kernal:
+        if dev.is_kernel_driver_active(self.INTERFACE_MGPS):
+            dev.detach_kernel_driver(self.INTERFACE_MGPS)
+        desconfig = dev[0]
+        try:
+            configuration = dev.get_active_configuration()
+        except usb.core.USBError:
+            configuration = None
+        if configuration is None or configuration.bConfigurationValue != desconfig.bConfigurationValue:
+            dev.set_configuration(desconfig)
+        usb.util.claim_interface(dev, self.INTERFACE_MGPS)
+        try:
+            dev.ctrl_transfer(0x21, 9, 0x0300, 0, self.SET_NAVPVT)
+        except usb.core.USBError:
+            usb_safe_cleanup(dev, self.INTERFACE_MGPS)
+            raise
+        self.dev = dev
+
+    def close(self):
+        if self.dev is not None:
+            usb_safe_cleanup(self.dev, self.INTERFACE_MGPS)
+            self.dev = None
+
+    def reconnect(self):
+        """
+        Close, reset and reopen the device. Returns True on success.
+        """
+        self.close()
+        self.nreconnect += 1
+        time.sleep(self.reconnect_wait)
+        try:
+            self.open(reset=True)
+        except (IOError, usb.core.USBError) as e:
+            print("LeoBodnarGPS: reconnect failed:", e)
+            return False
+        return True
+
+    def read_chunk(self):
+        """
+        One USB read into the session buffer. Returns a memoryview of the
+        bytes read (valid until the next read), empty on timeout, or None if
+        the device is gone and could not be reopened.
+        """
+        if self.dev is None:
+            try:
+                self.open()
+            except (IOError, usb.core.USBError) as e:
+                print("LeoBodnarGPS: open failed:", e)
+                return None
+        try:
+            n = self.dev.read(self.ENDPOINT_IN, self._buf, self.timeout)
+        except usb.core.USBTimeoutError:
+            self.ntimeout += 1
+            return self._view[:0]
+        except usb.core.USBError as e:
+            print("LeoBodnarGPS: read error", e)
+            self.nerror += 1
+            if not self.reconnect():
+                return None
+            return self._view[:0]
+        self.nread += 1
+        return self._view[:n]
+
+    def read_pvt(self):
+        """
+        Read until a NAV-PVT frame completes and return it as a ubx.NavPvt
+        (the latest if one read completed several), or None on failure.
+        """
+        for j in range(self.ntry):
+            data = self.read_chunk()
+            if data is None:
+                break
+            recs = self.parser.feed_navpvt(data)
+            if recs:
+                return recs[-1]
+        print("LeoBodnarGPS.read: read failed")
+        return None
+
+    def read(self):
+        """
+        Read GPS time stamp, like lb_read() but on the open session.
+        """
+        rec = self.read_pvt()
+        if rec is None:
+            return None, None, None
+        try:
+            return rec.lb_tuple()
+        except ValueError:
+            print("LeoBodnarGPS.read: bad datetime object")
+            return None, None, None
+
+    def record(self, fname, nread):
+        """
+        Save nread raw reads to fname, for replaying into ubx benchmarks.
+        """
+        with open(fname, "wb") as f:
+            for j in range(nread):
+                data = self.read_chunk()
+                if data is None:
+                    break
+                f.write(data)
 
-    return tstamp, auxdat, gpstime
+    def stats(self):
+        return {"nframe": self.parser.nframe, "nbad": self.parser.nbad, "nread": self.nread, "ntimeout": self.ntimeout, "nerror": self.nerror, "nreconnect": self.nreconnect}
 
 #====================================================================
 def set_clock_lb(current_year=2021):
@@ -278,3 +371,26 @@ def set_clock_lb(current_year=2021):
     to_exec='sudo date -s " %s "' % mytime.ctime()
     os.system(to_exec)
     return True
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Time GPS reads from the Leo Bodnar with a persistent session")
+    parser.add_argument("-n", "--nread", type=int, default=100, help="Number of reads")
+    parser.add_argument("--legacy", action="store_true", help="Also time the same number of lb_read() calls")
+    parser.add_argument("--record", type=str, default=None, help="Instead save the raw byte stream of nread reads to this file")
+    args = parser.parse_args()
+
+    with LeoBodnarGPS() as gps:
+        if args.record is not None:
+            gps.record(args.record, args.nread)
+            raise SystemExit
+        t1 = time.perf_counter()
+        for i in range(args.nread):
+            tstamp, auxdat, gpstime = gps.read()
+        dt = time.perf_counter()-t1
+        print("session: {:.3f} ms per read, last {} {}, {}".format(1e3*dt/args.nread, gpstime, auxdat, gps.stats()))
+    if args.legacy:
+        t1 = time.perf_counter()
+        for i in range(args.nread):
+            lb_read()
+        print("lb_read: {:.3f} ms per read".format(1e3*(time.perf_counter()-t1)/args.nread))
@@ -0,0 +1,241 @@
+import argparse
+import collections
+import ctypes
+import ctypes.util
+import errno
+import os
+import select
+import subprocess
+import time
+import numpy as np
+
+import inventory
+
+# Mount options for sequential baseband writes: no access time updates, and a long journal commit
+# interval so the journal isn't forced every 5 s (files are fdatasync'd on close anyway).
+# Filesystems not listed get only noatime, which every filesystem accepts.
+MOUNT_OPTIONS = {"ext4": "noatime,commit=60",
+                 "ext3": "noatime,commit=60",
+                 "btrfs": "noatime,commit=60",
+                 "xfs": "noatime,logbufs=8",
+                 "f2fs": "noatime"}
+DEFAULT_OPTIONS = "noatime"
+# Filesystems whose kernel driver takes the fstype name as is, so mount(2) can be called directly.
+# Others (ntfs via ntfs-3g, exfat-fuse, ...) need the mount command and its /sbin/mount.<type> helpers.
+KERNEL_FS = {"ext4", "ext3", "ext2", "xfs", "btrfs", "vfat", "f2fs"}
+
+# mount(2) flags
+MS_RDONLY = 1
+MS_NOATIME = 1024
+MNT_DETACH = 2
+
+# superblock magic: (offset, bytes) -> type, for when udev hasn't recorded the filesystem type
+MAGIC = [(1080, b"\x53\xef", "ext4"), (0, b"XFSB", "xfs"), (0x10040, b"_BHRfS_M", "btrfs"), (3, b"EXFAT   ", "exfat"),
+         (3, b"NTFS    ", "ntfs"), (82, b"FAT32   ", "vfat"), (54, b"FAT16   ", "vfat"), (54, b"FAT12   ", "vfat")]
+
+_libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+_libc.mount.argtypes = [ctypes.c_char_p, ctypes.c_char_p, ctypes.c_char_p, ctypes.c_ulong, ctypes.c_char_p]
+_libc.umount2.argtypes = [ctypes.c_char_p, ctypes.c_int]
+
+class MountError(OSError):
+    pass
+
+def fs_type(device):
+    '''
+    Filesystem type of a block device from the udev database, else from its superblock, else None.
+    '''
+    try:
+        rdev = os.stat(device).st_rdev
+        with open("/run/udev/data/b{}:{}".format(os.major(rdev), os.minor(rdev))) as f:
+            for line in f:
+                if line.startswith("E:ID_FS_TYPE="):
+                    return line.strip().split("=", 1)[1] or None
+    except OSError:
+        pass
+    try:
+        with open(device, "rb") as f:
+            head = f.read(0x10048)
+    except OSError:
+        return None # not readable without privileges
+    for off, magic, fstype in MAGIC:
+        if head[off:off+len(magic)] == magic:
+            return fstype
+    return None
+
+def _devno(device):
+    try:
+        rdev = os.stat(device).st_rdev
+        return "{}:{}".format(os.major(rdev), os.minor(rdev))
+    except OSError:
+        return None
+
+def find_mount(device=None, mount_point=None):
+    '''
+    mountinfo entry (see inventory.mounts) matching device and/or mount_point, or None. The device
+    matches by name, resolved symlink or device number, so /dev/disk/by-id paths work.
+    '''
+    inventory.invalidate()
+    devno = _devno(device) if device is not None else None
+    real = os.path.realpath(device) if device is not None else None
+    for m in inventory.mounts():
+        if mount_point is not None and m["Mounted on"] != os.path.abspath(mount_point):
+            continue
+        if device is not None and m["Device"] not in (device, real) and m["Dev"] != devno:
+            continue
+        return m
+    return None
+
+def wait_mounts(pred, timeout):
+    '''
+    Wait until pred() is true, waking whenever the mount table changes (poll on /proc/self/mountinfo),
+    for up to timeout seconds. Returns the last value of pred().
+    '''
+    t1 = time.monotonic()
+    with open("/proc/self/mountinfo") as f:
+        poller = select.poll()
+        poller.register(f, select.POLLPRI | select.POLLERR)
+        while True:
+            f.read() # consume the change so the next poll waits for a new one
+            value = pred()
+            left = t1+timeout-time.monotonic()
+            if value or left <= 0:
+                return value
+            poller.poll(1000*left)
+            f.seek(0)
+
+class MountManager:
+    '''
+    Mount and unmount with checked results, confirmed against /proc/self/mountinfo.
+
+    As root with a filesystem type in KERNEL_FS, mount(2)/umount2(2) are called directly (falling
+    back to the mount command if the kernel has no driver for it). Otherwise mount,
+    umount and udisksctl run through `sudo -n` with subprocess.run, so a missing sudo rule fails
+    at once instead of hanging on a password prompt. Failures raise MountError with the command's
+    error message.
+
+    Every operation's latency is kept in self.latency (name -> recent seconds) for stats().
+    '''
+    def __init__(self, options=None, timeout=60, sudo=None, nhist=256):
+        self.options = dict(MOUNT_OPTIONS, **(options or {}))
+        self.timeout = timeout
+        self.root = os.geteuid() == 0
+        self.sudo = sudo if sudo is not None else not self.root
+        self.latency = collections.defaultdict(lambda: collections.deque(maxlen=nhist))
+
+    def _run(self, cmd):
+        if self.sudo:
+            cmd = ["sudo", "-n"]+cmd
+        try:
+            proc = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, timeout=self.timeout)
+        except (OSError, subprocess.TimeoutExpired) as e:
+            raise MountError("{} failed: {}".format(" ".join(cmd), e))
+        if proc.returncode != 0:
+            msg = (proc.stderr or proc.stdout).decode(errors="replace").strip()
+            raise MountError("{} failed ({}): {}".format(" ".join(cmd), proc.returncode, msg))
+
+    def _mount(self, device, mount_point, fstype, options):
+        if self.root and fstype in KERNEL_FS:
+            flags = 0
+            data = []
+            for opt in options.split(","):
+                if opt == "noatime":
+                    flags |= MS_NOATIME
+                elif opt == "ro":
+                    flags |= MS_RDONLY
+                elif opt:
+                    data.append(opt)
+            if _libc.mount(device.encode(), mount_point.encode(), fstype.encode(), flags, ",".join(data).encode()) == 0:
+                return
+            err = ctypes.get_errno()
+            if err != errno.ENODEV:
+                raise MountError(err, "mount {} on {}: {}".format(device, mount_point, os.strerror(err)))
+            # no kernel driver for fstype, let mount find a helper
+        cmd = ["mount"]
+        if fstype is not None:
+            cmd += ["-t", fstype]
+        self._run(cmd+["-o", options, device, mount_point])
+
+    def mount(self, device, mount_point, options=None):
+        '''
+        Mount device on mount_point (created if needed) with options (default by filesystem type).
+        If the filesystem rejects the tuned options, retries with plain noatime. Returns the mount point.
+        '''
+        t1 = time.perf_counter()
+        fstype = fs_type(device)
+        if options is None:
+            options = self.options.get(fstype, DEFAULT_OPTIONS)
+        if not os.path.isdir(mount_point):
+            try:
+                os.makedirs(mount_point)
+            except PermissionError:
+                self._run(["mkdir", "-p", mount_point])
+        try:
+            self._mount(device, mount_point, fstype, options)
+        except MountError:
+            if options == DEFAULT_OPTIONS:
+                raise
+            self._mount(device, mount_point, fstype, DEFAULT_OPTIONS)
+        if not wait_mounts(lambda: find_mount(device, mount_point), 1.0):
+            raise MountError("{} not in mountinfo at {} after mount".format(device, mount_point))
+        self.latency["mount"].append(time.perf_counter()-t1)
+        return mount_point
+
+    def unmount(self, target, lazy=False):
+        '''
+        Unmount a device or mount point and confirm it's gone from mountinfo.
+        '''
+        t1 = time.perf_counter()
+        m = find_mount(mount_point=target) or find_mount(device=target)
+        if m is None:
+            return
+        if self.root:
+            if _libc.umount2(m["Mounted on"].encode(), MNT_DETACH if lazy else 0) != 0:
+                err = ctypes.get_errno()
+                raise MountError(err, "umount {}: {}".format(target, os.strerror(err)))
+        else:
+            self._run(["umount"]+(["-l"] if lazy else [])+[m["Mounted on"]])
+        if not wait_mounts(lambda: find_mount(mount_point=m["Mounted on"]) is None, 1.0):
+            raise MountError("{} still in mountinfo after umount".format(target))
+        self.latency["unmount"].append(time.perf_counter()-t1)
+
+    def power_off(self, disk):
+        '''
+        Spin down and power off a whole disk (e.g. /dev/sda) with udisksctl.
+        '''
+        t1 = time.perf_counter()
+        self._run(["udisksctl", "power-off", "-b", disk])
+        inventory.invalidate()
+        self.latency["power_off"].append(time.perf_counter()-t1)
+
+    def wait_for_mount(self, device, timeout):
+        '''
+        Mount point of device once something (e.g. an automounter) mounts it, or None after timeout.
+        '''
+        m = wait_mounts(lambda: find_mount(device), timeout)
+        return m["Mounted on"] if m else None
+
+    def stats(self):
+        out = {}
+        for name, dts in self.latency.items():
+            dts = np.array(dts)
+            out[name] = {"n": len(dts), "mean_s": float(dts.mean()), "p90_s": float(np.percentile(dts, 90)), "max_s": float(dts.max())}
+        return out
+
+manager = MountManager() # shared by the albatros_daq_utils and muxtools helpers
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Mount and unmount a drive repeatedly and report the latency")
+    parser.add_argument("device", type=str, help="Partition to mount, e.g. /dev/sda1")
+    parser.add_argument("mount_point", type=str, help="Where to mount it")
+    parser.add_argument("-n", "--ncycle", type=int, default=5, help="Mount/unmount cycles")
+    parser.add_argument("-o", "--options", type=str, default=None, help="Mount options (default by filesystem type)")
+    args = parser.parse_args()
+
+    print("{} is {}".format(args.device, fs_type(args.device)))
+    for i in range(args.ncycle):
+        manager.mount(args.device, args.mount_point, args.options)
+        if i == 0:
+            print("mounted with {}".format(find_mount(args.device, args.mount_point)["Options"]))
+        manager.unmount(args.mount_point)
+    for name, st in manager.stats().items():
+        print("{}: {}".format(name, st))
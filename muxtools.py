@@ -3,6 +3,9 @@ import time
 import os
 import subprocess
 import albatros_daq_utils as utils
+import hotplug
+import inventory
+import mount_manager
 
 gpio_warnings=False
 
@@ -99,7 +102,7 @@ def muxen(state):
     #set the mux state
     GPIO.output(MUXEN, gv[state])
 
-def mount_drive(id, drive_models, mount_point, timeout=120, dt=2, max_toggles=3, logger=None):
+def mount_drive(id, drive_models, mount_point, timeout=120, dt=2, max_toggles=3, select_wait=10, logger=None):
     '''
     Mounts MUX drive #id to mount_point. 
     The drive's model must match one of the models given in the drive_models list to be found and mounted.
@@ -112,21 +115,25 @@ def mount_drive(id, drive_models, mount_point, timeout=120, dt=2, max_toggles=3,
     mount_point: str
         path where drive will be mounted
     timeout: int
-        amount of time (in seconds) to wait before giving up
+        amount of time (in seconds) to wait for the drive to show up before toggling the MUX lines
     dt: int
-        downtime between querying lsblk and doing mux stuff
+        time to wait for an automounter before mounting the drive ourselves
     max_toggles: int
         maximum number of times to toggle MUX on/off to try to find drive if it failed to show up in lsblk search
+    select_wait: float
+        seconds to let the MUX address lines settle before powering the drive
     logger: (optional) logger instance to pass messages to
     '''
 
+    watcher = hotplug.DriveWatcher(drive_models) # before powering up, so the drive's events aren't missed
     select_drive(id)
-    time.sleep(10)
+    time.sleep(select_wait)
+    # the previous slot's drive is gone by now; one still attached is this slot's (e.g. after a restart)
+    watcher.accept_present()
     poweren(1)
     time.sleep(0.5)
     muxen(1)
     utils.lprint("Drive {}: MUX enabled.".format(id), logger)
-    time.sleep(20) # drive may take some time to spin up
 
     utils.lprint("Drive {}: Waiting for drive...".format(id), logger)
     toggles = 0
@@ -134,17 +141,15 @@ def mount_drive(id, drive_models, mount_point, timeout=120, dt=2, max_toggles=3,
     # Loop over toggles of the MUX enable lines (needed sometimes to make drive show up)
     while toggles < max_toggles:
         t1 = time.time()
-        partitions = []
-        # Timeout looping to wait for partitions info to show up in lsblk
-        while (time.time()-t1 < timeout) and (len(partitions) == 0):
-            try:
-                partitions = utils.get_lsblk(drive_models)
-            except:
-                utils.lprint('Error finding drive {}.'.format(id), logger, 40)
-                return None
-            time.sleep(dt)
-        
-        if len(partitions) == 0:
+        # Wakes as soon as the drive and its partitions appear, however long it takes to spin up
+        try:
+            partitions = watcher.wait_for_drive(timeout)
+        except:
+            utils.lprint('Error finding drive {}.'.format(id), logger, 40)
+            watcher.close()
+            return None
+
+        if partitions is None:
             # Drive not found in lsblk. Toggle the enable lines in the hopes it will appear.
             toggles += 1
             utils.lprint('Drive {}: Did not find drive in lsblk. Toggling MUX lines. ({})'.format(id, toggles), logger, 30)
@@ -158,49 +163,55 @@ def mount_drive(id, drive_models, mount_point, timeout=120, dt=2, max_toggles=3,
             time.sleep(0.5)   
             # go around again in outer while loop
         else:
-            max_size_partition = max(partitions[0], key=lambda x: x["Size"])
+            max_size_partition = max(partitions, key=lambda x: x["Size"])
             dev = max_size_partition["Name"] # e.g. /dev/sda1
             utils.lprint('Drive {}: Found {} on {} after {} s.'.format(id, max_size_partition["Model"], dev, round(time.time()-t1,3)), logger)
             success = True
             break
+    watcher.close()
 
     if success:
-        time.sleep(dt)
-        # Check if drive automounted.
-        mp=utils.get_mountpoint(dev) # mp means mount point
+        # Give an automounter up to dt to mount the drive.
+        mp=mount_manager.manager.wait_for_mount(dev, dt) # mp means mount point
         if mp is not None:
             utils.lprint('Drive {}: {} automounted at {}.'.format(id, dev, mp), logger)
             return mp  #get here if the drive is now mounted
         # Otherwise, mount drive manually.
         utils.lprint('Drive {}: Mounting...'.format(id), logger)
+        t1=time.time()
         try:
-            utils.safe_mount(dev, mount_point)
-        except:
-            logger.warning('Exception on drive mount OS call')
+            mp=utils.safe_mount(dev, mount_point)
+        except mount_manager.MountError as e:
+            utils.lprint('Drive {}: Failed to mount {}: {}'.format(id, dev, e), logger, 40)
             return None
-        # time.sleep(dt) #wait before polling df
-        t1=time.time()
-        while time.time()-t1 < timeout:
-            mp=utils.get_mountpoint(dev)
-            if mp is not None:
-                utils.lprint('Drive {}: {} mounted at {} after {} s.'.format(id, dev, mp, round(time.time()-t1,3)), logger)
-                return mp
-            time.sleep(dt)
-        utils.lprint('Drive {}: Timeout mounting drive.', logger, 30)
+        utils.lprint('Drive {}: {} mounted at {} after {} s.'.format(id, dev, mp, round(time.time()-t1,3)), logger)
+        return mp
     else:
         utils.lprint('Drive {}: Drive failed to show up in lsblk after {} toggles!'.format(id, toggles), logger, 30)
     return None
 
-def free_drive(dev='/dev/sda1'):
-    mp=utils.get_mountpoint(dev)
-    if mp is not None:
-        os.system('sudo umount '+dev)
-        dd=dev[:-1]
-        os.system('sudo udisksctl power-off -b '+dd)
+def free_drive(dev='/dev/sda1', logger=None):
+    '''
+    Unmount dev, power off its disk and switch off the MUX. With dev None (e.g. after a failed
+    mount) only the MUX is switched off.
+    Returns False (leaving the MUX on) if the drive couldn't be unmounted.
+    '''
+    if dev is not None and mount_manager.find_mount(dev) is not None:
+        try:
+            mount_manager.manager.unmount(dev)
+        except mount_manager.MountError as e:
+            utils.lprint('Failed to unmount {}: {}'.format(dev, e), logger, 40)
+            return False
+        disk=inventory.disk_of(dev)
+        try:
+            mount_manager.manager.power_off('/dev/'+disk if disk else dev[:-1])
+        except mount_manager.MountError as e:
+            utils.lprint('Failed to power off {}: {}'.format(dev, e), logger, 30)
     time.sleep(0.5)
     muxen(0)
     time.sleep(0.5)
     poweren(0)
+    return True
 
 ###################################################
 # OLD STUFF BELOW!!!
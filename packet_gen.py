@@ -0,0 +1,135 @@
+import argparse
+import configparser
+import random
+import socket
+import struct
+import time
+import numpy as np
+
+import albatros_daq_utils as utils
+import channel_plan
+from baseband_decode import HEADER_BYTES, pack_spectra, quantize
+
+class PacketGenerator:
+    '''
+    Synthetic SNAP packetiser: byte-exact payloads for a channel plan, bit mode and spec_per_pkt.
+
+    The data of packet k is pool[k % npool], so long runs cost no encoding on the send path and
+    expected(k) reproduces exactly what was sent for comparison against a capture.
+    pattern "noise" is complex gaussian noise of rms `rms` quantized to the bit mode,
+    "ramp" is a deterministic pattern (re = (spectrum+column) mod the level count, im = -re) usable
+    as a reference for the test vector generator in tvg_test.py.
+    '''
+    def __init__(self, plan, spec_per_pkt=None, pattern="noise", rms=2.0, npool=64, seed=0):
+        self.plan = plan
+        self.bits = plan.bits
+        self.bytes_per_spec = plan.bytes_per_spec
+        self.spec_per_pkt = spec_per_pkt if spec_per_pkt else channel_plan.plan_packets(plan).spec_per_pkt
+        self.pkt_bytes = HEADER_BYTES+self.bytes_per_spec*self.spec_per_pkt
+        self.npool = npool
+        shape = (npool*self.spec_per_pkt, plan.nchan)
+        if pattern == "noise":
+            rng = np.random.default_rng(seed)
+            pols = [quantize(rng.normal(0, rms, shape)+1j*rng.normal(0, rms, shape), self.bits) for pol in range(2)]
+        elif pattern == "ramp":
+            levels = {4: np.arange(-7, 8), 2: np.array([-2, -1, 1, 2]), 1: np.array([-1, 1])}[self.bits]
+            re = levels[np.add.outer(np.arange(shape[0]), np.arange(shape[1])) % len(levels)].astype(np.int8)
+            pol = np.stack([re, -re], axis=-1)
+            pols = [pol, pol[:, ::-1]]
+        else:
+            raise ValueError("pattern must be noise or ramp, got {!r}".format(pattern))
+        data = pack_spectra(pols[0], pols[1], self.bits).reshape(npool, -1)
+        self.pool = np.zeros((npool, self.pkt_bytes), dtype=np.uint8)
+        self.pool[:, HEADER_BYTES:] = data
+        self._rows = [memoryview(self.pool[i]) for i in range(npool)]
+
+    def packet(self, k):
+        '''
+        Payload of packet k (spectrum counter k*spec_per_pkt), as a memoryview into the pool that is
+        only valid until the next call for the same pool row.
+        '''
+        row = self._rows[k % self.npool]
+        struct.pack_into(">I", row, 0, (k*self.spec_per_pkt) & 0xffffffff)
+        return row
+
+    def expected(self, k0, npkt):
+        '''
+        Bytes of packets k0 .. k0+npkt-1 back-to-back, as they would appear in a capture.
+        '''
+        out = self.pool[np.arange(k0, k0+npkt) % self.npool].copy()
+        out[:, :HEADER_BYTES] = ((np.arange(k0, k0+npkt)*self.spec_per_pkt) & 0xffffffff).astype(">u4").view(np.uint8).reshape(-1, 4)
+        return out.tobytes()
+
+    def send(self, ip, port, pps=0, npkt=None, duration=None, k0=0, loss=0.0, reorder=0.0, seed=0,
+             report_interval=0, logger=None):
+        '''
+        Send packets k0, k0+1, ... to ip:port at pps packets/s (0 for as fast as possible) until npkt
+        packets or duration seconds. Each packet is dropped with probability loss, and swapped with the
+        next one with probability reorder. Returns a dict of counts and the achieved rates.
+        '''
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        addr = (ip, port) # not connect()ed, so ICMP port unreachable doesn't abort a run with no listener
+        rng = random.Random(seed)
+        nsent = ndrop = nswap = 0
+        k = k0
+        t1 = t_report = time.perf_counter()
+        n_report = 0
+        try:
+            while (npkt is None or k-k0 < npkt) and (duration is None or time.perf_counter()-t1 < duration):
+                if loss and rng.random() < loss:
+                    ndrop += 1
+                elif reorder and rng.random() < reorder and (npkt is None or k+1-k0 < npkt):
+                    sock.sendto(self.packet(k+1), addr)
+                    sock.sendto(self.packet(k), addr)
+                    nswap += 1
+                    nsent += 2
+                    k += 1
+                else:
+                    sock.sendto(self.packet(k), addr)
+                    nsent += 1
+                k += 1
+                now = time.perf_counter()
+                if pps > 0:
+                    # sleep only when well ahead of schedule, sleep() is too coarse to pace single packets
+                    delay = t1+(k-k0)/pps-now
+                    if delay > 1e-3:
+                        time.sleep(delay)
+                if report_interval and now-t_report >= report_interval:
+                    utils.lprint("{:.0f} pkt/s, {:.2f} MB/s".format((nsent-n_report)/(now-t_report),
+                                 (nsent-n_report)*self.pkt_bytes/(now-t_report)/1e6), logger)
+                    t_report, n_report = now, nsent
+        finally:
+            sock.close()
+        dt = time.perf_counter()-t1
+        return {"npkt": k-k0, "nsent": nsent, "ndrop": ndrop, "nswap": nswap, "seconds": dt,
+                "pps": nsent/dt if dt > 0 else 0.0, "MBps": nsent*self.pkt_bytes/dt/1e6 if dt > 0 else 0.0}
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Send synthetic packetiser UDP packets to a local port")
+    parser.add_argument("-i", "--ip", type=str, default="127.0.0.1", help="Destination IP address")
+    parser.add_argument("-p", "--port", type=int, default=4321, help="Destination UDP port")
+    parser.add_argument("-c", "--config", type=str, default=None, help="Take channels from the [albatros3] section of this config file")
+    parser.add_argument("--channels", type=str, default="0:8", help="Channel ranges, e.g. \"256:512 600:640\" (ignored with --config)")
+    parser.add_argument("-b", "--bits", type=int, default=4, help="Baseband bit mode (1, 2 or 4)")
+    parser.add_argument("-s", "--spec-per-pkt", type=int, default=None, help="Spectra per packet (default: channel_plan.plan_packets)")
+    parser.add_argument("--pattern", type=str, default="noise", help="Data pattern, noise or ramp")
+    parser.add_argument("--pps", type=float, default=0, help="Packets/s (0 for as fast as possible, -1 for the real SNAP rate)")
+    parser.add_argument("-n", "--npkt", type=int, default=None, help="Number of packets to send")
+    parser.add_argument("-t", "--duration", type=float, default=10, help="Seconds to send for")
+    parser.add_argument("--loss", type=float, default=0, help="Fraction of packets to drop")
+    parser.add_argument("--reorder", type=float, default=0, help="Fraction of packets to swap with the next one")
+    parser.add_argument("--report-interval", type=float, default=1, help="Seconds between rate reports (0 for none)")
+    args = parser.parse_args()
+
+    channels = args.channels
+    if args.config is not None:
+        config_file = configparser.ConfigParser()
+        config_file.read(args.config)
+        channels = config_file.get("albatros3", "channels")
+    gen = PacketGenerator(channel_plan.channel_plan(channels, args.bits), args.spec_per_pkt, args.pattern)
+    pps = channel_plan.SPEC_RATE/gen.spec_per_pkt if args.pps < 0 else args.pps
+    print("{}-bit, {} bytes/spec, {} spec/pkt, {} byte packets to {}:{}".format(
+        gen.bits, gen.bytes_per_spec, gen.spec_per_pkt, gen.pkt_bytes, args.ip, args.port))
+    res = gen.send(args.ip, args.port, pps, args.npkt, args.duration, loss=args.loss, reorder=args.reorder,
+                   report_interval=args.report_interval)
+    print("Sent {nsent} packets ({ndrop} dropped, {nswap} swapped) in {seconds:.2f} s: {pps:.0f} pkt/s, {MBps:.2f} MB/s".format(**res))
@@ -0,0 +1,221 @@
+import json
+import os
+import socket
+import threading
+import time
+import numpy as np
+
+import albatros_daq_utils as utils
+
+class PacketStats:
+    '''
+    Sequence and rate statistics over the packetiser spectrum counter, O(1) per packet.
+
+    Packets are numbered k = spec_num//spec_per_pkt. The highest k seen so far is tracked together
+    with a window of the last `window` packet numbers that have arrived:
+      - k > highest+1: the packets in between are counted lost (until they turn up late)
+      - k inside the window and not seen yet: reordered, it is taken back off the lost count (never
+        more than the gaps since tracking last restarted put on it)
+      - k inside the window and already seen: duplicate
+      - k older than the window, or back at or before the packet tracking last restarted at after
+        the sequence has moved on from it: the counter was reset (e.g. in_packet_reset, which
+        restarts it from the same value), tracking restarts at k
+    update_batch() handles an in-order batch with a couple of numpy calls and only walks packets one
+    by one when something unusual happened in the batch.
+    '''
+    def __init__(self, spec_per_pkt, window=4096, ewma_tau=10.0):
+        self.spec_per_pkt = spec_per_pkt
+        self.window = window
+        self.ewma_tau = ewma_tau
+        self._seen = bytearray(window)
+        self._highest = None
+        self._lowest = None # k tracking last restarted at
+        self._missing = 0   # gap packets since then that may still turn up
+        self.npkt = 0
+        self.nbytes = 0
+        self.nlost = 0
+        self.nreorder = 0
+        self.ndup = 0
+        self.nreset = 0
+        self.max_gap = 0
+        self.t_start = time.time()
+        self._t_last = self.t_start
+        self._npkt_last = 0
+        self._nbytes_last = 0
+        self.pps = 0.0
+        self.bps = 0.0
+        self.pps_avg = 0.0
+        self.bps_avg = 0.0
+
+    def _restart(self, k):
+        self._seen[:] = bytes(self.window)
+        self._highest = k
+        self._lowest = k
+        self._missing = 0
+        self._seen[k % self.window] = 1
+
+    def update(self, spec_num, nbytes=0):
+        self.npkt += 1
+        self.nbytes += nbytes
+        k = int(spec_num)//self.spec_per_pkt
+        hi = self._highest
+        if hi is None:
+            self._restart(k)
+            return
+        w = self.window
+        if k > hi:
+            gap = k-hi-1
+            if gap:
+                self.nlost += gap
+                self._missing += gap
+                self.max_gap = max(self.max_gap, gap)
+                if gap >= w:
+                    self._seen[:] = bytes(w)
+                else:
+                    for j in range(hi+1, k):
+                        self._seen[j % w] = 0
+            self._seen[k % w] = 1
+            self._highest = k
+        elif hi-k < w and (k > self._lowest or hi == self._lowest):
+            if self._seen[k % w]:
+                self.ndup += 1
+            else:
+                self._seen[k % w] = 1
+                self.nreorder += 1
+                if self._missing > 0:
+                    self._missing -= 1
+                    self.nlost -= 1
+        else:
+            self.nreset += 1
+            self._restart(k)
+
+    def update_batch(self, spec_num, nbytes=0):
+        '''
+        Update with an array of spectrum counters (in arrival order) carrying nbytes in total.
+        '''
+        n = len(spec_num)
+        if n == 0:
+            return
+        k = np.asarray(spec_num, dtype=np.int64)//self.spec_per_pkt
+        hi = self._highest
+        if hi is not None and k[0] == hi+1 and k[-1]-k[0] == n-1 and (n == 1 or np.all(np.diff(k) == 1)):
+            # common case: the batch simply continues the sequence
+            w = self.window
+            if n >= w:
+                self._seen[:] = b"\x01"*w
+            else:
+                lo, top = (hi+1) % w, (k[-1] % w)+1
+                if lo < top:
+                    self._seen[lo:top] = b"\x01"*n
+                else:
+                    self._seen[lo:] = b"\x01"*(w-lo)
+                    self._seen[:top] = b"\x01"*top
+            self._highest = int(k[-1])
+            self.npkt += n
+            self.nbytes += nbytes
+            return
+        per_pkt = nbytes//n
+        for s in spec_num:
+            self.update(s, per_pkt)
+
+    def tick(self, now=None):
+        '''
+        Update instantaneous (since the last tick) and exponentially averaged rates.
+        '''
+        if now is None:
+            now = time.time()
+        dt = now-self._t_last
+        if dt <= 0:
+            return
+        self.pps = (self.npkt-self._npkt_last)/dt
+        self.bps = (self.nbytes-self._nbytes_last)/dt
+        alpha = 1-np.exp(-dt/self.ewma_tau)
+        if self._t_last == self.t_start:
+            self.pps_avg, self.bps_avg = self.pps, self.bps
+        else:
+            self.pps_avg += alpha*(self.pps-self.pps_avg)
+            self.bps_avg += alpha*(self.bps-self.bps_avg)
+        self._t_last = now
+        self._npkt_last = self.npkt
+        self._nbytes_last = self.nbytes
+
+    def snapshot(self):
+        expected = self.npkt-self.ndup+self.nlost
+        return {"time": self._t_last,
+                "npkt": self.npkt,
+                "nbytes": self.nbytes,
+                "nlost": self.nlost,
+                "loss_frac": self.nlost/expected if expected > 0 else 0.0,
+                "nreorder": self.nreorder,
+                "ndup": self.ndup,
+                "nreset": self.nreset,
+                "max_gap": self.max_gap,
+                "pps": self.pps,
+                "MBps": self.bps/1e6,
+                "pps_avg": self.pps_avg,
+                "MBps_avg": self.bps_avg/1e6}
+
+def write_json(fname, stats):
+    '''
+    Atomically replace fname with stats as JSON, so readers never see a half written file.
+    '''
+    tmp = fname+".tmp"
+    with open(tmp, "w") as f:
+        json.dump(stats, f)
+    os.replace(tmp, fname)
+
+class StatsReporter:
+    '''
+    Background thread that every `interval` seconds ticks the rates of one or more stats sources,
+    logs a one-line summary and exports the counters.
+
+    sources: dict of name -> object with tick() and snapshot() (e.g. PacketStats), or a callable returning a dict
+    json_file: optional path, rewritten atomically every interval
+    udp_addr: optional (host, port) to send each JSON snapshot to as one datagram
+    '''
+    def __init__(self, sources, interval=10, json_file=None, udp_addr=None, logger=None):
+        self.sources = sources
+        self.interval = interval
+        self.json_file = json_file
+        self.udp_addr = udp_addr
+        self.logger = logger
+        self._sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM) if udp_addr is not None else None
+        self._stop = threading.Event()
+        self._thread = None
+
+    def report(self):
+        out = {}
+        for name, src in self.sources.items():
+            if callable(src):
+                out[name] = src()
+            else:
+                src.tick()
+                out[name] = src.snapshot()
+        pkt = out.get("packets")
+        if pkt is not None:
+            utils.lprint("{:.0f} pkt/s, {:.2f} MB/s, lost {} ({:.2e}), reordered {}, dup {}, resets {}".format(
+                pkt["pps"], pkt["MBps"], pkt["nlost"], pkt["loss_frac"], pkt["nreorder"], pkt["ndup"], pkt["nreset"]), self.logger)
+        else:
+            utils.lprint(json.dumps(out), self.logger)
+        if self.json_file is not None:
+            write_json(self.json_file, out)
+        if self._sock is not None:
+            try:
+                self._sock.sendto(json.dumps(out).encode(), self.udp_addr)
+            except OSError:
+                pass
+        return out
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.report()
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
@@ -0,0 +1,190 @@
+import argparse
+import functools
+import time
+import numpy as np
+
+import albatros_daq_utils as utils
+import channel_plan
+from baseband_decode import quantize, unpack_spectra
+from fpga_config import BramShadow, ConfigPlan, KatcpPipeline
+
+COEFF_BRAMS = {2: "two_bit_quant_coeffs", 4: "four_bit_quant_coeffs"}
+NCHAN = 2048
+# Quantizer coefficients are unsigned fixed point: the PFB output is multiplied by
+# coeff/2**COEFF_FRAC_BITS before rounding to the 2-bit/4-bit levels.
+COEFF_FRAC_BITS = 17
+COEFF_MAX = 2**32-1
+
+@functools.lru_cache(maxsize=4)
+def quant_model(bits, nsigma=600):
+    '''
+    Response of the packetiser quantizer (baseband_decode.quantize) to a zero-mean Gaussian real
+    component of rms sigma, in quantizer units. Returns read-only arrays (sigmas, rms of the
+    quantized values, efficiency), where efficiency is the squared correlation between input and
+    output, i.e. the fraction of signal-to-noise kept.
+    '''
+    if bits not in COEFF_BRAMS:
+        raise ValueError("quantizer coefficients exist only for 2 and 4 bits, got {}".format(bits))
+    sigmas = np.geomspace(0.05, 50, nsigma)
+    u = np.linspace(-8, 8, 8001)
+    w = np.exp(-0.5*u**2)
+    w /= w.sum()
+    q = quantize(sigmas[:, None]*u[None, :]+0j, bits)[..., 0].astype(np.float64)
+    q2 = (q**2)@w
+    xq = (q*u)@w
+    eff = np.divide(xq**2, q2, out=np.zeros_like(q2), where=q2 > 0)
+    out = (sigmas, np.sqrt(q2), eff)
+    for arr in out:
+        arr.flags.writeable = False
+    return out
+
+def optimal_rms(bits):
+    '''
+    Input rms (quantizer units) that keeps the most signal-to-noise through the quantizer.
+    '''
+    sigmas, rms, eff = quant_model(bits)
+    return float(sigmas[np.argmax(eff)])
+
+def coeffs_from_power(power, acclen, bits, frac_bits=COEFF_FRAC_BITS):
+    '''
+    Coefficients that put every channel at optimal_rms, from correlator autocorrelations
+    (pol00/pol11, accumulated over acclen spectra) of the quantizer input. nan where a channel
+    has no power.
+    '''
+    sigma = np.sqrt(np.asarray(power, dtype=np.float64)/(2*acclen)) # per real component
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return np.where(sigma > 0, optimal_rms(bits)*2**frac_bits/sigma, np.nan)
+
+def coeffs_from_baseband(pol0, pol1, channels, current, bits):
+    '''
+    Coefficients from a quick look at quantized baseband: pol0/pol1 int8 (nspec, nchan, 2) as
+    unpack_spectra(..., dtype=np.int8) returns them, for the channel numbers in channels. The rms
+    of the quantized values is mapped back through quant_model to the input rms, and the current
+    coefficient is scaled to bring that to optimal_rms. Returns a full-length array, nan for
+    channels that aren't in the data. Saturated channels are only pulled back as far as the model
+    can resolve, so heavily clipped channels converge over a few runs.
+    '''
+    sigmas, rms, eff = quant_model(bits)
+    q2 = (np.mean(np.square(pol0, dtype=np.float64), axis=(0, -1))+np.mean(np.square(pol1, dtype=np.float64), axis=(0, -1)))/2
+    sigma = np.interp(np.sqrt(q2), rms, sigmas)
+    out = np.full(len(current), np.nan)
+    with np.errstate(divide="ignore"):
+        out[channels] = np.where(q2 > 0, np.asarray(current, dtype=np.float64)[channels]*optimal_rms(bits)/sigma, np.nan)
+    return out
+
+class QuantAutotune:
+    '''
+    Keeps the 2-bit/4-bit quantizer coefficients at their optimum as RFI and gains drift.
+
+    The coefficients are read from the BRAM once into a fpga_config.BramShadow. Each tune computes
+    new coefficients for every channel (or only `chans`) from correlator power or a baseband quick
+    look, keeps the old value where the change is under `tolerance` (fractional), and sends the
+    table through the shadow, so only the words that changed are written and read back.
+
+    The absolute scale rests on frac_bits (COEFF_FRAC_BITS is not confirmed against the firmware),
+    so with dry_run the new coefficients are worked out and logged but nothing is written.
+    '''
+    def __init__(self, pipe, bits, chans=None, acclen=393216, tolerance=0.05, frac_bits=COEFF_FRAC_BITS, max_gap=64, dry_run=False, logger=None):
+        if bits not in COEFF_BRAMS:
+            raise ValueError("quantizer coefficients exist only for 2 and 4 bits, got {}".format(bits))
+        self.pipe = pipe
+        self.bits = bits
+        self.bram = COEFF_BRAMS[bits]
+        self.chans = np.arange(NCHAN) if chans is None else np.asarray(chans)
+        self.acclen = acclen
+        self.tolerance = tolerance
+        self.frac_bits = frac_bits
+        self.dry_run = dry_run
+        self.logger = logger
+        self.shadow = BramShadow(max_gap=max_gap)
+        self.coeffs = self.read()
+        self.ntune = 0
+        self.nwrite = 0
+        self.nword = 0
+
+    def read(self):
+        return np.frombuffer(self.shadow.load(self.pipe, self.bram, 4*NCHAN), dtype=">u4").astype(np.int64)
+
+    def update(self, new):
+        '''
+        Write the coefficients in new (float array, nan = leave alone) that moved by more than the
+        tolerance. Returns the number of channels changed (that would change, with dry_run).
+        '''
+        new = np.asarray(new, dtype=np.float64)
+        target = self.coeffs.copy()
+        cand = new[self.chans]
+        cur = self.coeffs[self.chans]
+        with np.errstate(divide="ignore", invalid="ignore"):
+            move = np.isfinite(cand) & ~(np.abs(cand/cur-1) <= self.tolerance)
+        target[self.chans[move]] = np.clip(np.round(cand[move]), 1, COEFF_MAX).astype(np.int64)
+        if self.dry_run:
+            nchanged = int(np.count_nonzero(target != self.coeffs))
+            ratio = target[self.chans]/np.maximum(self.coeffs[self.chans], 1)
+            utils.lprint("QuantAutotune (dry run): would change {} coefficients, new/current median {:.3f}, range {:.3f} to {:.3f}".format(
+                nchanged, np.median(ratio), ratio.min(), ratio.max()), self.logger)
+            self.ntune += 1
+            return nchanged
+        writes = ConfigPlan().write(self.bram, target.astype(">u4").tobytes()).run(self.pipe, shadow=self.shadow)
+        self.nwrite += len(writes)
+        self.nword += sum(len(data) for dev, offset, data in writes)//4
+        nchanged = int(np.count_nonzero(target != self.coeffs))
+        self.coeffs = target
+        self.ntune += 1
+        utils.lprint("QuantAutotune: {} coefficients changed in {} writes".format(nchanged, len(writes)), self.logger, 20 if nchanged else 10)
+        return nchanged
+
+    def tune_from_correlator(self, data):
+        '''
+        Tune from a correlator_readout readout with pol00 and pol11 (the quantizer sees both pols
+        with one coefficient, so their mean power is used).
+        '''
+        power = (data["pols"]["pol00"].astype(np.float64)+data["pols"]["pol11"].astype(np.float64))/2
+        return self.update(coeffs_from_power(power, self.acclen, self.bits, self.frac_bits))
+
+    def tune_from_baseband(self, raw, plan):
+        '''
+        Tune from raw baseband spectra (nspec, bytes_per_spec) packed with channel_plan.ChannelPlan plan.
+        '''
+        pol0, pol1 = unpack_spectra(raw, plan.bits, dtype=np.int8)
+        return self.update(coeffs_from_baseband(pol0, pol1, plan.channels, self.coeffs, self.bits))
+
+    def run(self, readout, interval=600.0, n=None):
+        '''
+        Tune from a fresh correlator_readout.CorrelatorReadout accumulation every interval seconds, n times or forever.
+        '''
+        count = 0
+        while n is None or count < n:
+            if count:
+                time.sleep(interval)
+            self.tune_from_correlator(readout.read())
+            count += 1
+
+    def stats(self):
+        return {"ntune": self.ntune, "nwrite": self.nwrite, "nword": self.nword,
+                "coeff_min": int(self.coeffs[self.chans].min()), "coeff_max": int(self.coeffs[self.chans].max())}
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Tune the quantizer coefficients from correlator power, once or periodically (a dry run unless --apply)")
+    parser.add_argument("-c", "--config", type=str, required=True, help="Config file (snap_ip, snap_port, bits, channels, accumulation_length)")
+    parser.add_argument("--section", type=str, default="albatros2", help="Config section")
+    parser.add_argument("-t", "--interval", type=float, default=600, help="Seconds between tunes")
+    parser.add_argument("-n", "--ntune", type=int, default=1, help="Tunes (0 for forever)")
+    parser.add_argument("--tolerance", type=float, default=0.05, help="Fractional change below which a coefficient is left alone")
+    parser.add_argument("--frac-bits", type=int, default=COEFF_FRAC_BITS, help="Fractional bits of the coefficients (check against the firmware)")
+    parser.add_argument("--apply", action="store_true", help="Write the new coefficients (default: dry run, only report what would change)")
+    parser.add_argument("--model", action="store_true", help="Print the quantizer model optimum and exit")
+    args = parser.parse_args()
+
+    get = lambda name: utils.get_config_parameter(args.config, name, args.section)
+    bits = int(get("bits"))
+    if args.model:
+        sigmas, rms, eff = quant_model(bits)
+        i = np.argmax(eff)
+        print("{} bits: optimal input rms {:.3f}, quantized rms {:.3f}, efficiency {:.4f}".format(bits, sigmas[i], rms[i], eff[i]))
+    else:
+        from correlator_readout import CorrelatorReadout
+        pipe = KatcpPipeline(get("snap_ip"), int(get("snap_port")))
+        chans = channel_plan.channel_plan(get("channels"), bits).channels
+        tuner = QuantAutotune(pipe, bits, chans, int(get("accumulation_length")), args.tolerance, args.frac_bits, dry_run=not args.apply)
+        tuner.run(CorrelatorReadout(pipe, ["pol00", "pol11"], []), args.interval, args.ntune or None)
+        print(tuner.stats())
@@ -0,0 +1,352 @@
+import argparse
+import bz2
+import concurrent.futures
+import gzip
+import lzma
+import os
+import time
+import numpy as np
+
+import albatros_daq_utils as utils
+
+# scio files: int32 header [ndim (negative if rows are first differences), dims..., type code],
+# then rows appended in native byte order. Compressed files get the codec's extension and are
+# read the same way through a decompressing stream.
+TYPE_CODES = {8: np.float64, 4: np.float32, -4: np.int32, -8: np.int64, 104: np.uint32, 108: np.uint64}
+CODECS = {"bzip2": ".bz2", "gzip": ".gz", "xz": ".xz", "zstd": ".zst", "lz4": ".lz4"}
+CHUNK = 1024*1024
+
+def type_code(dtype):
+    dtype = np.dtype(dtype)
+    for code, t in TYPE_CODES.items():
+        if np.dtype(t) == dtype.newbyteorder("="):
+            return code
+    raise ValueError("scio can't store {}".format(dtype))
+
+def codec_of(fname):
+    '''
+    Codec name from a file's extension, None if uncompressed.
+    '''
+    for codec, ext in CODECS.items():
+        if fname.endswith(ext):
+            return codec
+    return None
+
+def open_codec(fname, codec, mode="rb", level=None):
+    '''
+    Binary file object that (de)compresses fname on the fly. zstd and lz4 need the zstandard and
+    lz4 packages, which are only imported when used.
+    '''
+    if codec is None:
+        return open(fname, mode)
+    if codec == "bzip2":
+        return bz2.open(fname, mode, compresslevel=level or 9)
+    if codec == "gzip":
+        return gzip.open(fname, mode, compresslevel=level or 6)
+    if codec == "xz":
+        return lzma.open(fname, mode, preset=level)
+    if codec == "zstd":
+        import zstandard
+        if "r" in mode:
+            return zstandard.ZstdDecompressor().stream_reader(open(fname, "rb"), closefd=True)
+        return zstandard.ZstdCompressor(level=level or 3).stream_writer(open(fname, "wb"), closefd=True)
+    if codec == "lz4":
+        import lz4.frame
+        return lz4.frame.open(fname, mode, compression_level=level or 0)
+    raise ValueError("unknown codec {}, expected one of {}".format(codec, ", ".join(CODECS)))
+
+def compress_file(fname, codec, level=None, remove=True):
+    '''
+    Compress fname to fname+extension (through a temporary file, so a crash never leaves a partial
+    compressed file) and delete the original. Runs in a worker process. Returns (fname, raw bytes,
+    compressed bytes, seconds).
+    '''
+    t1 = time.perf_counter()
+    out = fname+CODECS[codec]
+    tmp = out+".tmp"
+    with open(fname, "rb") as fin, open_codec(tmp, codec, "wb", level) as fout:
+        while True:
+            chunk = fin.read(CHUNK)
+            if not chunk:
+                break
+            fout.write(chunk)
+    with open(tmp, "rb") as f:
+        os.fsync(f.fileno())
+    os.replace(tmp, out)
+    fd = os.open(os.path.dirname(os.path.abspath(out)), os.O_RDONLY)
+    try:
+        os.fsync(fd) # make the rename durable before the original goes
+    finally:
+        os.close(fd)
+    nraw = os.path.getsize(fname)
+    if remove:
+        os.remove(fname)
+    return fname, nraw, os.path.getsize(out), time.perf_counter()-t1
+
+class ScioFile:
+    '''
+    Append-only scio file. The header is written with the first row, whose shape and dtype fix
+    those of the rest. With diff, each row after the first is stored as its difference from the
+    previous one, which for slowly varying spectra leaves small numbers that compress well.
+    Rows are flushed to the OS as they are appended, so a crash loses at most the row in flight.
+    '''
+    def __init__(self, fname, diff=False):
+        self.fname = fname
+        self.diff = diff
+        self.nrow = 0
+        self._last = None
+        self._f = open(fname, "wb")
+
+    def append(self, row):
+        row = np.asarray(row)
+        row = row.astype(row.dtype.newbyteorder("="), copy=False)
+        if self.nrow == 0:
+            header = [-row.ndim if self.diff else row.ndim]+list(row.shape)+[type_code(row.dtype)]
+            self._f.write(np.array(header, dtype=np.int32).tobytes())
+            self.shape, self.dtype = row.shape, row.dtype
+        elif row.shape != self.shape:
+            raise ValueError("{}: row shape {} doesn't match {}".format(self.fname, row.shape, self.shape))
+        if self.diff:
+            out = row if self._last is None else row-self._last
+            self._last = row.copy()
+        else:
+            out = row
+        self._f.write(out.astype(self.dtype, copy=False).tobytes())
+        self._f.flush()
+        self.nrow += 1
+
+    def close(self):
+        self._f.close()
+
+def _read(f, nbytes):
+    # decompressing streams may return short reads before the end
+    chunks = []
+    while nbytes > 0:
+        chunk = f.read(nbytes)
+        if not chunk:
+            break
+        chunks.append(chunk)
+        nbytes -= len(chunk)
+    return b"".join(chunks)
+
+def iter_rows(fname, nrow=1):
+    '''
+    Yield the rows of a scio file (compressed or not) in blocks of nrow, undoing the first
+    differences as it goes. Only one block is decompressed in memory at a time. A partial last
+    row (file still being written) is skipped.
+    '''
+    with open_codec(fname, codec_of(fname), "rb") as f:
+        ndim = int(np.frombuffer(_read(f, 4), dtype=np.int32)[0])
+        diff = ndim < 0
+        ndim = abs(ndim)
+        head = np.frombuffer(_read(f, 4*(ndim+1)), dtype=np.int32)
+        shape = tuple(int(n) for n in head[:ndim])
+        dtype = np.dtype(TYPE_CODES[int(head[ndim])])
+        row_bytes = dtype.itemsize*int(np.prod(shape))
+        last = None
+        while True:
+            buf = _read(f, row_bytes*nrow)
+            n = len(buf)//row_bytes
+            if n == 0:
+                return
+            rows = np.frombuffer(buf, dtype=dtype, count=n*row_bytes//dtype.itemsize).reshape((n,)+shape)
+            if diff:
+                rows = np.cumsum(rows, axis=0, dtype=dtype)
+                if last is not None:
+                    rows += last
+                last = rows[-1].copy()
+            yield rows
+            if len(buf) < row_bytes*nrow:
+                return
+
+def read_scio(fname):
+    '''
+    Whole scio file as one array of rows.
+    '''
+    blocks = list(iter_rows(fname, 1024))
+    return np.concatenate(blocks) if blocks else None
+
+class SpectraWriter:
+    '''
+    Dump correlator readouts (see correlator_readout.CorrelatorReadout) as scio files: one file
+    per pol and register plus time.scio, in directory/<first 5 digits of ctime>/<ctime>/, with a
+    new directory every file_time seconds. Pols and registers are stored as int64 rows, first
+    differenced if diff. time.scio is never differenced so timestamps stay exact.
+
+    When a directory is finished its files are compressed with `compress` (bzip2, gzip, xz, zstd,
+    lz4 or None) in a pool of nproc worker processes, so compression never holds up the readout
+    loop. A backlog of compressions is logged: it means the workers are slower than the data.
+    Temporary files left in directory by a compression that was cut short (e.g. a crash) are
+    removed on start, and their originals compressed again.
+    '''
+    def __init__(self, directory, pols, registers, diff=True, compress="bzip2", level=None, file_time=3600.0, nproc=1, logger=None):
+        self.directory = directory
+        self.pols = list(pols)
+        self.registers = list(registers)
+        self.diff = diff
+        self.compress = compress
+        self.level = level
+        self.file_time = file_time
+        self.logger = logger
+        self.pool = concurrent.futures.ProcessPoolExecutor(nproc) if compress else None
+        self.nproc = nproc
+        self.files = {}
+        self.subdir = None
+        self._t0 = None
+        self._last_ctime = 0
+        self._pending = []
+        self.nrow = 0
+        self.ncompressed = 0
+        self.raw_bytes = 0
+        self.compressed_bytes = 0
+        self.compress_seconds = 0.0
+        self._recover()
+
+    def _recover(self):
+        for root, dirs, names in os.walk(self.directory):
+            for name in names:
+                if not name.endswith(".tmp"):
+                    continue
+                tmp = os.path.join(root, name)
+                codec = codec_of(tmp[:-4])
+                utils.lprint("SpectraWriter: removing stale {}".format(tmp), self.logger, 30)
+                os.remove(tmp)
+                orig = tmp[:-4-len(CODECS[codec])] if codec else None
+                if orig and self.pool is not None and os.path.exists(orig):
+                    self._pending.append(self.pool.submit(compress_file, orig, codec, self.level))
+
+    def _open(self, t):
+        # directory names have 1 s resolution, so never reuse a ctime when directories rotate quickly
+        self._last_ctime = max(int(t), self._last_ctime+1)
+        ctime = str(self._last_ctime)
+        self.subdir = os.path.join(self.directory, ctime[:5], ctime)
+        os.makedirs(self.subdir, exist_ok=True)
+        self.files = {name: ScioFile(os.path.join(self.subdir, name+".scio"), self.diff) for name in self.pols+self.registers}
+        self.files["time"] = ScioFile(os.path.join(self.subdir, "time.scio"))
+        self._t0 = t # file_time is measured in readout time, not wall-clock
+        utils.lprint("SpectraWriter: writing to {}".format(self.subdir), self.logger)
+
+    def _rotate(self):
+        for f in self.files.values():
+            f.close()
+            if self.pool is not None:
+                self._pending.append(self.pool.submit(compress_file, f.fname, self.compress, self.level))
+        self.files = {}
+        self._reap()
+
+    def _reap(self, wait=False):
+        left = []
+        for fut in self._pending:
+            if not wait and not fut.done():
+                left.append(fut)
+                continue
+            try:
+                fname, nraw, ncomp, dt = fut.result()
+            except Exception as e:
+                utils.lprint("SpectraWriter: compression failed: {}".format(e), self.logger, 40)
+                continue
+            self.ncompressed += 1
+            self.raw_bytes += nraw
+            self.compressed_bytes += ncomp
+            self.compress_seconds += dt
+        self._pending = left
+        if len(left) > 4*self.nproc*(len(self.pols)+len(self.registers)+1):
+            utils.lprint("SpectraWriter: {} files waiting for compression, workers are falling behind".format(len(left)), self.logger, 30)
+
+    def write(self, data):
+        '''
+        Append one readout {"time", "pols": {pol: array}, "registers": {reg: int}}.
+        '''
+        if not self.files or data["time"]-self._t0 >= self.file_time:
+            if self.files:
+                self._rotate()
+            self._open(data["time"])
+        for pol in self.pols:
+            self.files[pol].append(data["pols"][pol].astype(np.int64))
+        for reg in self.registers:
+            self.files[reg].append(np.array([data["registers"][reg]], dtype=np.int64))
+        self.files["time"].append(np.array([data["time"]]))
+        self.nrow += 1
+
+    def close(self):
+        if self.files:
+            self._rotate()
+        if self.pool is not None:
+            self._reap(wait=True)
+            self.pool.shutdown()
+
+    def stats(self):
+        return {"nrow": self.nrow, "ncompressed": self.ncompressed, "pending": len(self._pending),
+                "ratio": self.raw_bytes/self.compressed_bytes if self.compressed_bytes else None,
+                "compress_MBps": self.raw_bytes/self.compress_seconds/1e6 if self.compress_seconds else None}
+
+def fake_spectra(nrow, nchan=2048, seed=0):
+    '''
+    nrow int64 rows of slowly drifting accumulated power with noise, like a correlator dump.
+    '''
+    rng = np.random.default_rng(seed)
+    shape = 1e10*(1+0.5*np.sin(np.linspace(0, 6, nchan)))
+    drift = 1+0.01*np.sin(np.arange(nrow)/50)[:, None]
+    return (shape*drift*(1+1e-3*rng.standard_normal((nrow, nchan)))).astype(np.int64)
+
+def benchmark(directory, nrow=600, codecs=("bzip2", "gzip", "xz", "zstd", "lz4")):
+    '''
+    Compression ratio and speed of an hour of 6 s dumps (one pol) per codec, with and without
+    first differences. Returns {(codec, diff): (ratio, MB/s)}.
+    '''
+    rows = fake_spectra(nrow)
+    os.makedirs(directory, exist_ok=True)
+    out = {}
+    for diff in (False, True):
+        for codec in codecs:
+            fname = os.path.join(directory, "bench.scio")
+            f = ScioFile(fname, diff)
+            for row in rows:
+                f.append(row)
+            f.close()
+            try:
+                fname, nraw, ncomp, dt = compress_file(fname, codec)
+            except ImportError as e:
+                utils.lprint("{}: {}".format(codec, e), level=30)
+                os.remove(fname)
+                continue
+            back = read_scio(fname+CODECS[codec])
+            assert np.array_equal(back, rows)
+            os.remove(fname+CODECS[codec])
+            out[(codec, diff)] = (nraw/ncomp, nraw/dt/1e6)
+    return out
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Dump correlator spectra to scio files, read one back, or benchmark the compressors")
+    parser.add_argument("-c", "--config", type=str, default=None, help="Config file (snap_ip, snap_port, pols, registers, dump_spectra_output_directory, diff_scio_files, compress_scio_files)")
+    parser.add_argument("--section", type=str, default="albatros2", help="Config section")
+    parser.add_argument("-t", "--file-time", type=float, default=3600, help="Seconds per directory of files")
+    parser.add_argument("-j", "--nproc", type=int, default=1, help="Compression worker processes")
+    parser.add_argument("--read", type=str, default=None, help="Print a summary of a scio file instead")
+    parser.add_argument("--bench", type=str, default=None, help="Benchmark compression in this directory instead")
+    args = parser.parse_args()
+
+    if args.read is not None:
+        for i, rows in enumerate(iter_rows(args.read)):
+            print(i, rows.shape, rows.dtype, rows.min(), rows.max())
+    elif args.bench is not None:
+        for (codec, diff), (ratio, mbps) in benchmark(args.bench).items():
+            print("{:6} diff={!s:5}: ratio {:.2f}, {:.1f} MB/s".format(codec, diff, ratio, mbps))
+    else:
+        from correlator_readout import CorrelatorReadout
+        from fpga_config import KatcpPipeline
+        get = lambda name: utils.get_config_parameter(args.config, name, args.section)
+        compress = get("compress_scio_files")
+        compress = None if compress.lower() in ("", "none", "false") else compress
+        pols, regs = get("pols").split(), get("registers").split()
+        readout = CorrelatorReadout(KatcpPipeline(get("snap_ip"), int(get("snap_port"))), pols, regs)
+        writer = SpectraWriter(get("dump_spectra_output_directory"), pols, regs, get("diff_scio_files") == "True", compress,
+                               file_time=args.file_time, nproc=args.nproc)
+        try:
+            for data in readout.stream():
+                writer.write(data)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            writer.close()
+            print(readout.stats(), writer.stats())
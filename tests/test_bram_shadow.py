@@ -0,0 +1,64 @@
+import numpy as np
+import pytest
+
+from fpga_config import BramShadow, ConfigPlan, KatcpPipeline
+from katcp_sim import KatcpSim
+
+COEFFS = "four_bit_quant_coeffs"
+REORDER = "packetiser_four_bit_reorder_map1"
+
+@pytest.fixture
+def sim():
+    sim = KatcpSim(port=0).start()
+    yield sim
+    sim.stop()
+
+@pytest.fixture
+def pipe(sim):
+    pipe = KatcpPipeline(sim.host, sim.port)
+    yield pipe
+    pipe.close()
+
+def test_diffed_updates_leave_intended_table(sim, pipe):
+    rng = np.random.default_rng(1)
+    coeffs = np.full(2048, 1 << 20, dtype=">I")
+    chans = np.repeat(np.arange(256, 256+2048), 2).astype(">H")
+    shadow = BramShadow()
+    ConfigPlan().write(COEFFS, coeffs.tobytes()).write(REORDER, chans.tobytes()).run(pipe, shadow=shadow)
+    for i in range(10):
+        coeffs[rng.integers(0, len(coeffs), 16)] = rng.integers(1 << 18, 1 << 22, 16)
+        chans[rng.integers(0, len(chans), 3)] = rng.integers(0, 2048, 3)
+        shadow.nsent = 0
+        writes = ConfigPlan().write(COEFFS, coeffs.tobytes()).write(REORDER, chans.tobytes()).run(pipe, shadow=shadow)
+        assert sim.device(COEFFS) == coeffs.tobytes()
+        assert sim.device(REORDER) == chans.tobytes()
+        assert shadow.nsent == sum(len(data) for dev, offset, data in writes)
+        assert shadow.nsent < coeffs.nbytes+chans.nbytes
+
+def test_unchanged_table_sends_nothing(sim, pipe):
+    coeffs = np.arange(2048, dtype=">I")
+    shadow = BramShadow()
+    shadow.write(pipe, COEFFS, coeffs.tobytes())
+    nreq = len(sim.requests)
+    assert shadow.write(pipe, COEFFS, coeffs.tobytes()) == []
+    assert len(sim.requests) == nreq
+    assert sim.device(COEFFS) == coeffs.tobytes()
+
+def test_load_and_invalidate_after_write_behind_shadow(sim, pipe):
+    coeffs = np.arange(2048, dtype=">I")
+    shadow = BramShadow()
+    shadow.write(pipe, COEFFS, coeffs.tobytes())
+    # rewritten without the shadow, e.g. by another script
+    other = coeffs.copy()
+    other[100:110] = 7
+    ConfigPlan().write(COEFFS, other.tobytes()).run(pipe)
+    shadow.invalidate(COEFFS)
+    shadow.write(pipe, COEFFS, coeffs.tobytes())
+    assert sim.device(COEFFS) == coeffs.tobytes()
+    # a loaded image gives a minimal delta straight away
+    fresh = BramShadow()
+    fresh.load(pipe, COEFFS, coeffs.nbytes)
+    coeffs[5] = 1234
+    writes = fresh.write(pipe, COEFFS, coeffs.tobytes())
+    assert [(offset, len(data)) for dev, offset, data in writes] == [(20, 4)]
+    assert sim.device(COEFFS) == coeffs.tobytes()
@@ -0,0 +1,49 @@
+import copy
+import os
+import time
+
+import pytest
+
+from hotplug import DriveWatcher, ReplayMonitor, selftest
+
+# Previous mux slot's drive, still in the table when the watcher is created
+STALE = {"sda": {"Size": 4000787030016, "Model": "My Book 25EE", "Partitions": {"sda1": 4000785981440}}}
+NEW_SIZE = (15628052480-2048)*512 # sda1 of the drive added in mux_switch.jsonl
+RECORDING = os.path.join(os.path.dirname(__file__), "data", "mux_switch.jsonl")
+
+@pytest.mark.parametrize("speed", [1.0, 0])
+def test_replay_mux_switch_finds_new_drive(speed):
+    watcher = DriveWatcher(["My Book"], ReplayMonitor(RECORDING, speed), disks=copy.deepcopy(STALE))
+    t1 = time.monotonic()
+    parts = watcher.wait_for_drive(timeout=5)
+    assert parts == [{"Name": "/dev/sda1", "Size": NEW_SIZE, "Model": "My Book 25EE"}]
+    if speed:
+        assert time.monotonic()-t1 >= 0.3 # not before the new drive's events
+    assert watcher.nevent == 8
+
+def test_stale_drive_is_not_matched():
+    watcher = DriveWatcher(["My Book"], ReplayMonitor([]), settle=0.01, disks=copy.deepcopy(STALE))
+    assert watcher.wait_for_drive(timeout=0.2) is None
+    assert watcher.wait_for_drive(timeout=0.2, fresh=False)[0]["Name"] == "/dev/sda1"
+
+def test_selftest():
+    selftest(speed=0)
+
+def test_already_present_drive_after_accept():
+    # DAQ restarted with the selected drive already powered: no events at all
+    watcher = DriveWatcher(["My Book"], ReplayMonitor([]), disks=copy.deepcopy(STALE))
+    watcher.accept_present()
+    t1 = time.monotonic()
+    parts = watcher.wait_for_drive(timeout=5)
+    assert time.monotonic()-t1 < 1
+    assert parts == [{"Name": "/dev/sda1", "Size": 4000785981440, "Model": "My Book 25EE"}]
+
+def test_accept_present_applies_queued_removal_first():
+    # the previous slot's drive is already gone when accept_present() runs, the new one comes later
+    events = ReplayMonitor(RECORDING).events
+    events = [(0.0 if event["ACTION"] == "remove" else t, event) for t, event in events]
+    watcher = DriveWatcher(["My Book"], ReplayMonitor(events), disks=copy.deepcopy(STALE))
+    watcher.accept_present()
+    assert "sda" not in watcher.disks
+    parts = watcher.wait_for_drive(timeout=5)
+    assert parts[0]["Size"] == NEW_SIZE
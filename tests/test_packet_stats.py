@@ -0,0 +1,33 @@
+import numpy as np
+
+from packet_stats import PacketStats
+
+def test_reset_to_restart_point():
+    stats = PacketStats(10)
+    for s in range(0, 1000, 10):
+        stats.update(s)
+    for s in range(0, 500, 10):
+        stats.update(s)
+    snap = stats.snapshot()
+    assert (snap["nreset"], snap["ndup"], snap["nreorder"], snap["nlost"]) == (1, 0, 0, 0)
+
+def test_reset_inside_window():
+    stats = PacketStats(1)
+    for k in range(100, 200):
+        stats.update(k)
+    for k in range(50):
+        stats.update(k)
+    assert (stats.nreset, stats.nreorder, stats.nlost) == (1, 0, 0)
+
+def test_batch_reset_to_restart_point():
+    stats = PacketStats(1)
+    stats.update_batch(np.arange(100))
+    stats.update_batch(np.arange(200))
+    snap = stats.snapshot()
+    assert (snap["npkt"], snap["nreset"], snap["ndup"], snap["nlost"]) == (300, 1, 0, 0)
+
+def test_loss_reorder_and_duplicate():
+    stats = PacketStats(1)
+    for k in [0, 1, 2, 5, 4, 3, 3, 6, 9]:
+        stats.update(k)
+    assert (stats.nlost, stats.nreorder, stats.ndup, stats.nreset, stats.max_gap) == (2, 2, 1, 0, 2)
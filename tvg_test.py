@@ -29,6 +29,8 @@ import time
 import re
 from snap_reset import snap_reset
 import albatros_daq_utils as utils
+import channel_plan
+from fpga_config import ConfigPlan, KatcpPipeline
 
 # other
 from dataclasses import dataclass  # Python3.7, think struct
@@ -58,6 +60,9 @@ chans=utils.get_channels_from_str(channels, bits) # TODO: tidy bits convention
 channels_coeffs=config_file.get("albatros3","channel_coeffs")
 coeffs=utils.get_coeffs_from_str(channels_coeffs) # TODO: decide on bits convention
 coeffs=coeffs[:1<<6] # hack
+# pick spec per packet and check the stream fits on 1 GbE before anything is written to the board
+geom=channel_plan.plan_packets(len(chans), bits=bits)
+print(f"{geom.spec_per_pkt} spec/pkt, {geom.pkt_bytes} byte packets, {geom.pkt_rate:.0f} pkt/s, {100*geom.link_util:.1f}% of 1 GbE")
 dest_ip, dest_port, dest_mac = utils.read_ifconfig(interface="eth0")
 if dest_port is not None:
     dest_port = int(dest_port)
@@ -159,85 +164,68 @@ def set_channel_order(fpga, chans, bit_mode:BitMode):
     fpga.write(channel_map, chans.astype(">H").tobytes(), offset=0)
     return True
 
-# REGISTERS -- enable stuff
-print("Enable TVG, packetizer sel, dest_port, dest_ip...",end=" ")
-fpga.registers.packetiser_tvg4bit_enable.write_int(1) # Enable the TVG
-fpga.registers.packetiser_sel.write_int(bit_mode.value) # Select bit mode0:1bit, 1:2bit, 2:4bit 
-fpga.registers.dest_ip.write_int(str2ip(dest_ip))
-fpga.registers.dest_port.write_int(dest_port)
-print("Done")
-print("tvg4bit_enable:", fpga.registers.packetiser_tvg4bit_enable.read()['data']['reg'])
-print("packetiser_sel:", fpga.registers.packetiser_sel.read()['data']['reg'])
-print("dest_ip:", fpga.registers.dest_ip.read()['data']['reg'])
-print("dest_port:", fpga.registers.dest_port.read()['data']['reg'])
-print()
+# Register and BRAM writes are collected into plans and sent over a pipelined katcp connection:
+# each plan is one round trip for the writes plus one for the readback, instead of one (or two) per write.
+pipe = KatcpPipeline(snap_ip, snap_port)
 
-fpga.write("packetiser_four_bit_reorder_map1", np.array([0,1,2,3,4,5,6,7]).astype(">H").tobytes(), offset=0)
-#fpga.write("packetiser_four_bit_reorder_map1", 
-#        (np.arange(0,256)//2).astype(">H").tobytes(), 
+# REGISTERS -- enable stuff
+print("Enable TVG, packetizer sel, dest_port, dest_ip, channel order and coeffs...",end=" ")
+setup = ConfigPlan()
+setup.write_int("packetiser_tvg4bit_enable", 1) # Enable the TVG
+setup.write_int("packetiser_sel", bit_mode.value) # Select bit mode0:1bit, 1:2bit, 2:4bit
+setup.write_int("dest_ip", str2ip(dest_ip))
+setup.write_int("dest_port", dest_port)
+setup.write("packetiser_four_bit_reorder_map1", np.array([0,1,2,3,4,5,6,7]).astype(">H").tobytes(), offset=0)
+#setup.write("packetiser_four_bit_reorder_map1",
+#        (np.arange(0,256)//2).astype(">H").tobytes(),
 #        offset=0)
-
 # CHANNELS -- set channel order
-set_channel_order(fpga, chans, bit_mode)
-set_channel_coeffs(fpga, coeffs, bit_mode)
-
-# Packet reset
-print("Packet counter reset LOW, HIGH, LOW...",end=" ")
-fpga.registers.in_packet_reset.write_int(0)
-sleep(0.1)
-fpga.registers.in_packet_reset.write_int(1)
-sleep(0.1)
-fpga.registers.in_packet_reset.write_int(0)
+set_channel_order(setup, chans, bit_mode)
+set_channel_coeffs(setup, coeffs, bit_mode)
+setup.run(pipe) # raises ConfigVerifyError if anything didn't read back as written
 print("Done")
+print(pipe.read_ints(["packetiser_tvg4bit_enable", "packetiser_sel", "dest_ip", "dest_port"]))
+print()
 
-# REGISTERS -- Sync pulse (resets stuff)
-print("Sync pulse LOW, HIGH, LOW...",end=" ")
-fpga.registers.in_sw_sync.write_int(0) # sync pulse
-sleep(0.1) # dogmatically sleep between pulse reset
-fpga.registers.in_sw_sync.write_int(1) 
-sleep(0.1) # dogmatically sleep between pulse reset
-fpga.registers.in_sw_sync.write_int(0) 
+# Packet counter reset and sync pulse (resets stuff). Requests on one connection are executed in
+# order, so the pulses need no sleeps in between, but the firmware needs time to settle after the
+# sync and around the GBE reset, so those waits stay.
+print("Packet reset and sync pulses...",end=" ")
+ConfigPlan().pulse("in_packet_reset", (0, 1, 0)).pulse("in_sw_sync", (0, 1, 0)).run(pipe)
 print("Done")
-
 print("Sleep 3...",end=" ")
 sleep(3)
 print("Done")
 
-# REGISTERS -- disable GBE
-print("Disabling GBE: LOW",end=" ")
-fpga.registers.in_gbe_enable.write_int(0)
-print("Done")
-sleep(1)
-
-# REGISTERS -- Set spec per packet and bytes per spec
-print("\nspec per pkt",fpga.registers.packetiser_spec_per_pkt.read()['data']['reg']) # hack
-print("bytes per spec",fpga.registers.packetiser_bytes_per_spec.read()['data']['reg']) # hack
-print("Setting spec per pkt and bytes per spec...",end=" ")
-fpga.registers.packetiser_spec_per_pkt.write_int(10)
-fpga.registers.packetiser_bytes_per_spec.write_int(len(chans)) # TODO: verify this
-print("done")
-print("spec per pkt",fpga.registers.packetiser_spec_per_pkt.read()['data']['reg']) # hack
-print("bytes per spec",fpga.registers.packetiser_bytes_per_spec.read()['data']['reg']) # hack
-
-# REGISTERS -- Reset GBE
-print("Reset GBE: LOW, HIGH, LOW...",end=" ")
-fpga.registers.in_gbe_reset.write_int(0) 
-sleep(1)
-fpga.registers.in_gbe_reset.write_int(1) 
-sleep(1)
-fpga.registers.in_gbe_reset.write_int(0) 
+# REGISTERS -- disable GBE while the packet geometry changes
+print("Disabling GBE, setting spec per pkt and bytes per spec...",end=" ")
+ConfigPlan().write_int("in_gbe_enable", 0).run(pipe)
 sleep(1)
+geom_plan = ConfigPlan()
+geom_plan.write_int("packetiser_spec_per_pkt", geom.spec_per_pkt)
+geom_plan.write_int("packetiser_bytes_per_spec", len(chans)) # TODO: verify this
+geom_plan.run(pipe)
 print("Done")
-
-# REGISTERS -- Enable GBE
-print("Enabling GBE: HIGH (must stay high)...",end=" ")
-fpga.registers.in_gbe_enable.write_int(1)
+print(pipe.read_ints(["packetiser_spec_per_pkt", "packetiser_bytes_per_spec"]))
+
+# REGISTERS -- Reset GBE LOW, HIGH, LOW, then enable it (must stay high)
+print("Reset GBE: LOW, HIGH, LOW, then enable...",end=" ")
+for value in (0, 1, 0):
+    ConfigPlan().write_int("in_gbe_reset", value).run(pipe)
+    sleep(1)
+ConfigPlan().write_int("in_gbe_enable", 1).run(pipe)
 print("Done")
-sleep(1)
-
-
-
 
+# Then wait until the transmit overflow counter stops moving.
+last = [None]
+def tx_settled(value):
+    settled = value == last[0]
+    last[0] = value
+    return settled
+ok, tx_of = pipe.poll("tx_of_cnt", tx_settled, timeout=5, interval=0.1)
+print("GbE transmit overflowing" if not ok else f"tx_of_cnt settled at {tx_of}")
+print(f"Configuration took {pipe.nround} katcp round trips for {pipe.nrequest} requests")
+pipe.close()
 
 
 ## An idea I was toying with:
@@ -0,0 +1,203 @@
+import argparse
+import calendar
+import datetime
+import itertools
+import struct
+import time
+from typing import NamedTuple
+
+# UBX frame: 0xb5 0x62, class, id, little-endian payload length, payload, CK_A, CK_B
+SYNC = b"\xb5\x62"
+NAV_PVT = (0x01, 0x07)
+NAVPVT_BYTES = 92
+MAX_PAYLOAD = 1024 # longer lengths are treated as a false sync
+# whole NAV-PVT payload (u-blox 8 protocol), decoded in one go
+NAVPVT_STRUCT = struct.Struct("<IHBBBBBBIiBBBBiiiiIIiiiiiIIHB5xihH")
+
+class NavPvt(NamedTuple):
+    '''
+    Decoded NAV-PVT message. Angles in degrees, heights in m, nano in ns (can be negative).
+    '''
+    itow: int      # GPS time of week of the navigation epoch, ms
+    year: int
+    month: int
+    day: int
+    hour: int
+    minute: int
+    second: int
+    valid: int     # bit 0 validDate, 1 validTime, 2 fullyResolved, 3 validMag
+    tacc: int      # time accuracy estimate, ns
+    nano: int      # fraction of second, ns
+    fix_type: int  # 0 none, 2 2D, 3 3D, 5 time only
+    flags: int     # bit 0 gnssFixOK
+    num_sv: int
+    lon: float
+    lat: float
+    height: float  # above ellipsoid
+    alt: float     # above mean sea level (what lb_read reports as alt)
+
+    @property
+    def time_valid(self):
+        return self.valid & 0x7 == 0x7
+
+    @property
+    def fix_ok(self):
+        return bool(self.flags & 1)
+
+    def unix_time(self):
+        '''
+        UTC seconds since 1970 including the nano field.
+        '''
+        return calendar.timegm((self.year, self.month, self.day, self.hour, self.minute, self.second)) + self.nano*1e-9
+
+    def lb_tuple(self):
+        '''
+        Same (tstamp, auxdat, gpstime) as lbtools_l.lb_read().
+        '''
+        gpstime = datetime.datetime(self.year, self.month, self.day, self.hour, self.minute, self.second)
+        tstamp = float(calendar.timegm(gpstime.timetuple()))
+        validity = "{0:b}".format(self.valid)
+        validity = (4-len(validity))*'0'+validity
+        return tstamp, (self.nano*1e-9, validity, self.lon, self.lat, self.alt), gpstime
+
+def checksum(frame):
+    '''
+    8-bit Fletcher checksum (CK_A, CK_B) over class, id, length and payload.
+    '''
+    prefix = list(itertools.accumulate(frame))
+    return prefix[-1] & 0xff, sum(prefix) & 0xff
+
+def parse_navpvt(payload):
+    f = NAVPVT_STRUCT.unpack_from(payload)
+    return NavPvt(f[0], f[1], f[2], f[3], f[4], f[5], f[6], f[7], f[8], f[9], f[10], f[11], f[13],
+                  f[14]*1e-7, f[15]*1e-7, f[16]*1e-3, f[17]*1e-3)
+
+class UbxParser:
+    '''
+    Incremental UBX framer over a byte stream delivered in arbitrary chunks (e.g. 64-byte USB reads).
+
+    Bytes are kept in a rolling buffer, so a frame split across chunks is completed by the next
+    feed(). Sync is found with bytearray.find, frames with a bad checksum or absurd length are
+    skipped by resyncing two bytes further on.
+    '''
+    def __init__(self):
+        self._buf = bytearray()
+        self.nframe = 0
+        self.nbad = 0  # checksum or length failures
+        self.nskip = 0 # bytes discarded outside frames (NMEA, noise)
+
+    def feed(self, data):
+        '''
+        Add bytes and return the complete frames now available, as [(class, id, payload bytes), ...].
+        '''
+        buf = self._buf
+        buf += data
+        out = []
+        pos = 0
+        n = len(buf)
+        while True:
+            i = buf.find(SYNC, pos)
+            if i < 0:
+                # a trailing 0xb5 may be the first half of a sync split across chunks
+                keep = n-1 if n > pos and buf[n-1] == SYNC[0] else n
+                self.nskip += keep-pos
+                pos = keep
+                break
+            self.nskip += i-pos
+            pos = i
+            if n < i+6:
+                break
+            length = buf[i+4] | (buf[i+5] << 8)
+            if length > MAX_PAYLOAD:
+                self.nbad += 1
+                pos = i+2
+                continue
+            end = i+8+length
+            if n < end:
+                break
+            if checksum(buf[i+2:end-2]) == (buf[end-2], buf[end-1]):
+                out.append((buf[i+2], buf[i+3], bytes(buf[i+6:end-2])))
+                self.nframe += 1
+                pos = end
+            else:
+                self.nbad += 1
+                pos = i+2
+        del buf[:pos]
+        return out
+
+    def feed_navpvt(self, data):
+        '''
+        Like feed() but return only the decoded NAV-PVT records.
+        '''
+        return [parse_navpvt(payload) for cls, mid, payload in self.feed(data)
+                if (cls, mid) == NAV_PVT and len(payload) >= NAVPVT_BYTES]
+
+def iter_navpvt(chunks):
+    '''
+    Yield NavPvt records from an iterable of byte chunks.
+    '''
+    parser = UbxParser()
+    for chunk in chunks:
+        yield from parser.feed_navpvt(chunk)
+
+def frame(cls, mid, payload):
+    body = bytes([cls, mid]) + struct.pack("<H", len(payload)) + payload
+    return SYNC + body + bytes(checksum(body))
+
+def synth_stream(nrec=1000, t0=1700000000, noise=b"$GPGGA,,,,,,0,00,99.99,,,,,,*48\r\n"):
+    '''
+    A recorded-like byte stream: nrec one-second NAV-PVT frames separated by NMEA text.
+    '''
+    out = []
+    for j in range(nrec):
+        t = time.gmtime(t0+j)
+        payload = NAVPVT_STRUCT.pack(1000*(j % 604800), t.tm_year, t.tm_mon, t.tm_mday, t.tm_hour, t.tm_min, t.tm_sec,
+                                     0x37, 25, 123456-j, 3, 1, 0, 9, -731234567, 451234567, 120000, 100500,
+                                     2000, 3000, 0, 0, 0, 0, 0, 0, 0, 150, 0, 0, 0, 0)
+        out.append(noise + frame(*NAV_PVT, payload))
+    return b"".join(out)
+
+def legacy_scan(data):
+    '''
+    The per-chunk scan lb_read does, for comparison: returns the 36 bytes from year to alt or None.
+    '''
+    for i in range(len(data)-4):
+        if list(data[i:i+4]) == [0xb5, 0x62, 0x01, 0x07]:
+            if len(data) < i+46:
+                return None
+            return data[i+10:i+46]
+    return None
+
+def benchmark(stream, chunk=64, nrep=3):
+    '''
+    Parse stream in chunk-byte pieces with UbxParser and with the legacy scan.
+    Returns (records, records/s, legacy records, legacy chunks/s).
+    '''
+    chunks = [stream[i:i+chunk] for i in range(0, len(stream), chunk)]
+    best = best_legacy = None
+    for rep in range(nrep):
+        t1 = time.perf_counter()
+        nrec = sum(1 for rec in iter_navpvt(chunks))
+        dt = time.perf_counter()-t1
+        best = dt if best is None else min(best, dt)
+        t1 = time.perf_counter()
+        nlegacy = sum(1 for c in chunks if legacy_scan(c) is not None)
+        dt = time.perf_counter()-t1
+        best_legacy = dt if best_legacy is None else min(best_legacy, dt)
+    return nrec, nrec/best, nlegacy, len(chunks)/best_legacy
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the UBX NAV-PVT parser on a recorded (or synthetic) byte stream")
+    parser.add_argument("stream", type=str, nargs="?", default=None, help="Raw bytes recorded from the GPS (see lbtools_l --record)")
+    parser.add_argument("-c", "--chunk", type=int, default=64, help="Bytes per read")
+    parser.add_argument("-n", "--nrec", type=int, default=10000, help="Records in the synthetic stream")
+    args = parser.parse_args()
+
+    if args.stream is None:
+        stream = synth_stream(args.nrec)
+    else:
+        with open(args.stream, "rb") as f:
+            stream = f.read()
+    nrec, rate, nlegacy, legacy_rate = benchmark(stream, args.chunk)
+    print("UbxParser: {} NAV-PVT records, {:.3e} records/s ({:.3e} MB/s)".format(nrec, rate, rate*len(stream)/max(nrec, 1)/1e6))
+    print("legacy scan: {} records found, {:.3e} chunks/s".format(nlegacy, legacy_rate))